@@ -572,6 +572,21 @@ CREATE TABLE `task_instance_parameter` (
   `parameter_xml` mediumtext NOT NULL,
   PRIMARY KEY (`task_instance`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+CREATE TABLE `task_instance_step_profile` (
+  `task_instance` bigint(20) NOT NULL,
+  `step_id` varchar(36) NOT NULL DEFAULT '',
+  `function_name` varchar(64) NOT NULL DEFAULT '',
+  `exec_count` int(11) NOT NULL DEFAULT '0',
+  `wall_ms` bigint(20) NOT NULL DEFAULT '0',
+  `max_wall_ms` int(11) NOT NULL DEFAULT '0',
+  `db_ms` bigint(20) NOT NULL DEFAULT '0',
+  `remote_ms` bigint(20) NOT NULL DEFAULT '0',
+  `output_bytes` bigint(20) NOT NULL DEFAULT '0',
+  `histogram` text,
+  PRIMARY KEY (`task_instance`,`step_id`,`function_name`),
+  KEY `IX_task_instance_step_profile_step_id` (`step_id`),
+  CONSTRAINT `FK_task_instance_step_profile_task_instance` FOREIGN KEY (`task_instance`) REFERENCES `task_instance` (`task_instance`) ON DELETE CASCADE ON UPDATE NO ACTION
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 CREATE TABLE `task_step` (
   `step_id` varchar(36) NOT NULL DEFAULT '',
   `task_id` varchar(36) NOT NULL DEFAULT '',
@@ -2368,6 +2368,11 @@ class taskMethods:
         sNumRows = str(runlog.numrows) if runlog.numrows else "0"
         return json.dumps({"log": uiCommon.packJSON(sLog), "summary": uiCommon.packJSON(sSummary), "totalrows": sNumRows})
 
+    def wmGetTaskStepProfile(self):
+        sTaskID = uiCommon.getAjaxArg("sTaskID")
+        sp = task.TaskStepProfile(sTaskID)
+        return sp.AsJSON()
+
     def wmGetTaskLogfile(self):
         instance = uiCommon.getAjaxArg("sTaskInstance")
         logfile = ""
@@ -82,6 +82,7 @@ endpoints = {
              "get_task_parameters": "catoapi.taskMethods/get_task_parameters",
              "get_task_plans": "catoapi.taskMethods/get_task_plans",
              "get_task_schedules": "catoapi.taskMethods/get_task_schedules",
+             "get_task_step_profile": "catoapi.taskMethods/get_task_step_profile",
              "get_token": "catoapi.sysMethods/get_token",
              "import_backup": "catoapi.sysMethods/import_backup",
              "list_assets": "catoapi.sysMethods/list_assets",
@@ -204,6 +204,39 @@ Returns: A [Task Log Object](restapi/api-response-objects.html#TaskLog){:target=
         else:
             return R(response=obj.AsXML())
 
+    def get_task_step_profile(self, args):
+        """Gets how long each step of a Task takes, across all of it's Task Instances.
+
+Required Arguments: 
+
+* `task` - Either the Task ID or Name.
+* `version` - The Task Version.  (Unnecessary if 'task' is an ID.)
+
+Returns: For each step that has run - the number of times it ran, the average, median (p50), p95 and maximum time in milliseconds, how much of that was spent in the database or waiting on a remote system, and the bytes of output it got back.  Slowest first.
+"""
+        required_params = ["task"]
+        has_required, resp = api.check_required_params(required_params, args)
+        if not has_required:
+            return resp
+
+        ver = args["version"] if "version" in args else ""
+
+        # find the task
+        t = task.Task()
+        t.FromNameVersion(args["task"], ver, False)
+
+        if not api.is_object_allowed(t.ID, catocommon.CatoObjectTypes.Task):
+            return R(err_code=R.Codes.Forbidden, err_msg="You do not have access to the details of this Task.")
+
+        obj = task.TaskStepProfile(t.ID)
+
+        if args.get("output_format") == "json":
+            return R(response=obj.AsJSON())
+        elif args.get("output_format") == "text":
+            return R(response=obj.AsText(args.get("output_delimiter"), args.get("header")))
+        else:
+            return R(response=obj.AsXML())
+
     def run_task(self, args):
         """Runs a Task.
 
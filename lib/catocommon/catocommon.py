@@ -25,7 +25,6 @@ import calendar
 import sys
 from datetime import datetime
 import time
-from bson.objectid import ObjectId
 
 from catoconfig import catoconfig
 from catodb import catodb
@@ -91,6 +90,21 @@ def new_mongo_conn():
     return db
 
 
+_shared_mongo = {}
+
+
+def shared_mongo_conn():
+    """
+    The same as new_mongo_conn, but one connection for the whole process, made the first time it's needed.
+    For long running services - pymongo pools it's own sockets and is thread safe.
+    Don't disconnect it... (if something does, pymongo just reconnects on the next request).
+    """
+    db = _shared_mongo.get("db")
+    if db is None:
+        db = _shared_mongo.setdefault("db", new_mongo_conn())
+    return db
+
+
 def mongo_get_collection(db, collection_name):
     """ 
     Ensures a Mongo collection exists, creates it if it doesn't, and returns a pointer.
@@ -429,6 +443,7 @@ def jsonSerializeHandler(obj):
         return float(obj)
 
     # Mongo results will often have the ObjectId type
+    from bson.objectid import ObjectId
     if isinstance(obj, ObjectId):
         return str(obj)
 
@@ -495,11 +510,7 @@ def lookup_shared_cred(alias):
     return ret
 
 
-def add_task_instance(task_id, user_id, debug_level, parameter_xml, account_id=None, plan_id=None, schedule_id=None, submitted_by_instance=None, cloud_id=None, options=None):
-    """This *should* be the only place where rows are added to task_instance."""
-    # stringify the options dict
-    options = ObjectOutput.AsJSON(options) if options else None
-
+def _task_instance_debug_level(debug_level):
     # going into the database, the debug level must be set to one of the python logger levels. (10 based)
     # it'll default to INFO (20) if anything goes wrong
     try:
@@ -509,6 +520,15 @@ def add_task_instance(task_id, user_id, debug_level, parameter_xml, account_id=N
     except:
         logger.warning("Debug Level [%s] could not be normalized.  Setting to INFO (20)" % (debug_level))
         debug_level = 20
+    return debug_level
+
+
+def add_task_instance(task_id, user_id, debug_level, parameter_xml, account_id=None, plan_id=None, schedule_id=None, submitted_by_instance=None, cloud_id=None, options=None):
+    """This *should* be the only place where rows are added to task_instance."""
+    # stringify the options dict
+    options = ObjectOutput.AsJSON(options) if options else None
+
+    debug_level = _task_instance_debug_level(debug_level)
 
     db = new_conn()
     sql = """insert into task_instance (
@@ -558,6 +578,84 @@ def add_task_instance(task_id, user_id, debug_level, parameter_xml, account_id=N
     return task_instance
 
 
+# rows per insert statement in add_task_instances
+BULK_INSERT_ROWS = 500
+
+
+def add_task_instances(instances, user_id, debug_level, account_id=None, plan_id=None, schedule_id=None, submitted_by_instance=None, cloud_id=None, options=None):
+    """
+    Same as add_task_instance, for a whole list of task instances at once.
+
+    instances is a list of (task_id, parameter_xml).  Everything else is the same for all of them.
+    They're added on one connection, in one transaction, with multi-row inserts - all or nothing.
+
+    Returns the new task_instance ids, in the same order as instances.
+    """
+    if not instances:
+        return []
+
+    options = ObjectOutput.AsJSON(options) if options else None
+    debug_level = _task_instance_debug_level(debug_level)
+
+    db = new_conn()
+    # connections are autocommit, so each insert would be committed on it's own -
+    # and the poller could start a child before it's parameters are written
+    db.conn.autocommit(0)
+    try:
+        # InnoDB gives the rows of a multi-row insert consecutive ids, so they're known from the first one...
+        # unless auto increment is in 'interleaved' mode (2), or steps by more than 1 (master-master
+        # replication), then it's one insert per row (still one transaction).
+        try:
+            consecutive = (str(db.select_col("select @@innodb_autoinc_lock_mode")) != "2"
+                and int(db.select_col("select @@auto_increment_increment")) == 1)
+        except Exception:
+            consecutive = False
+
+        sql = """insert into task_instance (task_status, submitted_dt, task_id, debug_level, submitted_by, schedule_instance,
+            schedule_id, submitted_by_instance, account_id, cloud_id, options) values """
+        row_sql = "('Submitted', now(), %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+        task_instances = []
+        for ii in range(0, len(instances), BULK_INSERT_ROWS if consecutive else 1):
+            batch = instances[ii:ii + BULK_INSERT_ROWS] if consecutive else instances[ii:ii + 1]
+            params = []
+            for task_id, parameter_xml in batch:
+                params.extend([task_id, debug_level, user_id, plan_id, schedule_id, submitted_by_instance, account_id, cloud_id, options])
+            db.tran_exec(sql + ",".join([row_sql] * len(batch)), params)
+
+            # the id of the first row inserted (for a single row, the same as the cursor's lastrowid)
+            first = db.conn.insert_id()
+            if not first:
+                raise Exception("An error occured - unable to get the task_instance id.")
+            if consecutive:
+                task_instances.extend(range(first, first + len(batch)))
+            else:
+                task_instances.append(first)
+
+        # and the parameters, for the ones that have any
+        prows = [(ti, inst[1]) for ti, inst in zip(task_instances, instances) if inst[1]]
+        for ii in range(0, len(prows), BULK_INSERT_ROWS):
+            batch = prows[ii:ii + BULK_INSERT_ROWS]
+            params = []
+            for row in batch:
+                params.extend(row)
+            db.tran_exec("insert into task_instance_parameter (task_instance, parameter_xml) values " +
+                ",".join(["(%s, %s)"] * len(batch)), params)
+
+        db.tran_commit()
+    except Exception:
+        db.tran_rollback()
+        raise
+    finally:
+        try:
+            db.conn.autocommit(1)
+        finally:
+            db.close()
+
+    logger.info("Added [%d] Task Instances, [%s] to [%s]." % (len(task_instances), task_instances[0], task_instances[-1]))
+    return task_instances
+
+
 def get_security_log(oid=None, otype=0, user=None, logtype="Security", action=None, search=None, num_records=100, _from=None, _to=None):
     whereclause = "(1=1)"
     if oid:
@@ -61,6 +61,41 @@ def read_config():
     cfg["uicache"] = "/var/cato/ui"
     cfg["tmpdir"] = "/tmp"
 
+    # task engine log writer
+    cfg["te_audit_batch_size"] = "200"
+    cfg["te_audit_flush_interval"] = "1"
+    cfg["te_audit_queue_size"] = "10000"
+    # seconds between database checks while waiting on other task instances
+    cfg["te_wait_poll_interval"] = "5"
+    # 'batch' or 'row', how command output is parsed into step variables
+    cfg["te_buffer_parse"] = "batch"
+    # command output bigger than this (bytes) goes to a file instead of memory, 0 never does
+    cfg["te_spill_threshold"] = "4194304"
+    # and only this much of it goes to the task log
+    cfg["te_spill_log_limit"] = "65536"
+    # shared ssh master connections on this node, 0 is off.  idle masters close after te_ssh_pool_idle seconds
+    cfg["te_ssh_pool_size"] = "0"
+    cfg["te_ssh_pool_idle"] = "300"
+    # branches a parallel command runs at once, unless the step says otherwise
+    cfg["te_parallel_max_concurrent"] = "4"
+    # record per step timing in task_instance_step_profile
+    cfg["te_step_profile"] = "true"
+    # idle keep-alive connections kept per host by the http command, and for how many seconds
+    cfg["te_http_pool_size"] = "4"
+    cfg["te_http_pool_idle"] = "60"
+
+    # poller task engine worker pool, 0 is off
+    cfg["poller_pool_size"] = "0"
+    cfg["poller_pool_recycle"] = "50"
+
+    # log records are written by a background thread, from a queue of log_queue_size records.
+    # when it's full, log_overflow 'block' waits, 'drop' throws away DEBUG and INFO records
+    cfg["log_async"] = "true"
+    cfg["log_queue_size"] = "10000"
+    cfg["log_overflow"] = "block"
+    # seconds an aborted Task Engine has to exit before it's killed
+    cfg["poller_kill_grace"] = "3"
+
     cfg["redirect_stdout"] = "false"
     cfg["write_http_logs"] = "false"
 
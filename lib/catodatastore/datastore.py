@@ -41,8 +41,7 @@ def find_document(_id=None, query={}, collection="default"):
         collection = "default"
 
     try:
-        # connection should be later cleaned up:
-        db = catocommon.new_mongo_conn()
+        db = catocommon.shared_mongo_conn()
         coll = db[collection]
         doc = coll.find_one(query)
         if doc:
@@ -56,10 +55,6 @@ def find_document(_id=None, query={}, collection="default"):
             raise DocumentNotFoundError('Document with id %s not found' % id)
     except Exception as ex:
         raise DatastoreError(ex)
-    finally:
-        # TODO: cleanup
-        #db.close()
-        pass
 
     return rdoc
 
@@ -97,10 +92,9 @@ def create_document(template, collection="default"):
             # a TypeError will occur.
             jsondoc = template
 
-    db = catocommon.new_mongo_conn()
+    db = catocommon.shared_mongo_conn()
     coll = db[collection]
     docid = coll.insert(jsondoc)
-    catocommon.mongo_disconnect(db)
     # needed to add a incremental backoff retry loop because of mongo's eventual consistancy
     ii = 1
     while True:
@@ -140,8 +134,7 @@ class Document(object):
         self.doc = None
 
         try:
-            # connection should be later cleaned up:
-            db = catocommon.new_mongo_conn()
+            db = catocommon.shared_mongo_conn()
             coll = db[collection]
             self._collection_obj = coll
             doc = coll.find_one(query, projection)
@@ -154,10 +147,6 @@ class Document(object):
                 self.doc = {}
         except Exception as ex:
             raise DatastoreError(ex)
-        finally:
-            # TODO: cleanup
-            #db.close()
-            pass
 
     def AsJSON(self):
         """ Returns a json python representation of Document, which
@@ -324,7 +313,7 @@ class Documents(object):
                 from bson.objectid import ObjectId
                 query["_id"] = ObjectId(_id)
 
-            db = catocommon.new_mongo_conn()
+            db = catocommon.shared_mongo_conn()
             coll = db[self.collection]
             cursor = coll.find(query)
             self.documents = []
@@ -395,7 +384,7 @@ class Collections(object):
         """
         try:
 
-            db = catocommon.new_mongo_conn()
+            db = catocommon.shared_mongo_conn()
             names = db.collection_names()
             # filter by sfilter
             self._names = filter(lambda x: x.find(cfilter) >= 0, names)
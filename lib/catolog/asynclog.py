@@ -0,0 +1,219 @@
+#########################################################################
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Logging on a background thread.
+
+An AsyncHandler wraps a regular handler (a file handler), and instead of formatting and
+writing the record itself it just puts it on a queue.  One thread per process takes them
+off the queue and hands them to the real handler, so a logger.debug() in the middle of a
+step never waits on the disk.
+
+The queue is bounded.  When it's full, the overflow policy decides:
+    block - wait for room, nothing is lost (the default)
+    drop - DEBUG and INFO records are thrown away, and a note with how many goes in the
+        log once there's room again.  WARNING and up still wait.
+
+The message is formatted on the writer thread too, unless the arguments could change
+before it gets there (a list, a dict, some object) - those are formatted right away.
+
+Whatever is queued is written out when the process exits, when a handler is closed,
+and on SIGTERM (the Poller aborting a task) before the process dies of it.
+"""
+
+import os
+import Queue
+import atexit
+import signal
+import logging
+import threading
+
+QUEUE_SIZE = 10000
+OVERFLOW = "block"
+
+# arguments that can safely wait to be formatted
+_IMMUTABLE = (basestring, int, long, float, bool, type(None))
+
+_writer = None
+_lock = threading.Lock()
+
+
+def configure(queue_size, overflow):
+    """Settings for the writer, they take effect when the writer thread is (re)started."""
+    global QUEUE_SIZE, OVERFLOW
+    QUEUE_SIZE = queue_size
+    OVERFLOW = overflow
+
+
+def _immutable(args):
+    for a in args:
+        if isinstance(a, tuple):
+            if not _immutable(a):
+                return False
+        elif not isinstance(a, _IMMUTABLE):
+            return False
+    return True
+
+
+def _prepare(record, formatter):
+    """Gets a record ready to be formatted later, on another thread."""
+    if record.exc_info:
+        # the traceback won't be around later
+        if not record.exc_text:
+            record.exc_text = (formatter or logging._defaultFormatter).formatException(record.exc_info)
+        record.exc_info = None
+    if not isinstance(record.msg, basestring) or not isinstance(record.args or (), tuple) or not _immutable(record.args or ()):
+        record.msg = record.getMessage()
+        record.args = None
+
+
+class _Writer(object):
+    """The queue, and the thread writing what's on it."""
+
+    def __init__(self, queue_size, overflow):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(queue_size)
+        self.overflow = overflow
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="catolog writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            handler, item = self.queue.get()
+            if handler is None:
+                # a flush() waiting for everything before it to be written
+                item.set()
+                continue
+            try:
+                if self.dropped:
+                    n, self.dropped = self.dropped, 0
+                    handler.handle(logging.LogRecord("catolog", logging.WARNING, __file__, 0,
+                        "%d log records were dropped, the log queue was full.", (n,), None))
+                handler.handle(item)
+            except Exception:
+                pass
+
+    def put(self, handler, record):
+        if threading.current_thread() is self.thread:
+            # logging from inside a handler... never wait on ourselves
+            handler.handle(record)
+        elif self.overflow == "drop" and record.levelno < logging.WARNING:
+            try:
+                self.queue.put_nowait((handler, record))
+            except Queue.Full:
+                self.dropped += 1
+        else:
+            self.queue.put((handler, record))
+
+    def flush(self, timeout):
+        if threading.current_thread() is self.thread or not self.thread.is_alive():
+            return False
+        done = threading.Event()
+        try:
+            self.queue.put((None, done), timeout=timeout)
+        except Queue.Full:
+            return False
+        return done.wait(timeout)
+
+
+def _get_writer():
+    global _writer
+    with _lock:
+        # a forked process doesn't have the parent's thread
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = _Writer(QUEUE_SIZE, OVERFLOW)
+        return _writer
+
+
+def flush(timeout=5):
+    """Waits (at most timeout seconds) until everything queued so far is written."""
+    w = _writer
+    if w and w.pid == os.getpid():
+        return w.flush(timeout)
+    return True
+
+
+class AsyncHandler(logging.Handler):
+    """Queues records for the target handler, which does the formatting and writing on the writer thread."""
+
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        try:
+            _prepare(record, self.target.formatter)
+            _get_writer().put(self.target, record)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        flush()
+
+    def close(self):
+        # anything still queued for this handler goes out before it's closed
+        flush()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+# called before the flush on a signal, see flush_on_signal
+_before_signal_flush = []
+
+
+def _signal_flush():
+    try:
+        for f in _before_signal_flush:
+            f()
+    finally:
+        flush(2)
+
+
+def _flush_and_die(signum, frame):
+    # nothing here can wait on a lock - the thread the signal interrupted could be holding it
+    # (in the middle of putting a record on the queue, say).  So the flushing is done on
+    # another thread, and we only wait so long for it.
+    t = threading.Thread(target=_signal_flush, name="catolog signal flush")
+    t.daemon = True
+    t.start()
+    t.join(3)
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def flush_on_signal(signums=(signal.SIGTERM,), before=None):
+    """
+    On these signals, write out the log before dying of them as usual.
+    Only where the process hasn't set it's own handler, and only from the main thread.
+
+    before is called first, for anything that has to go in the log too.
+    """
+    if before and before not in _before_signal_flush:
+        _before_signal_flush.append(before)
+    for signum in signums:
+        try:
+            if signal.getsignal(signum) == signal.SIG_DFL:
+                signal.signal(signum, _flush_and_die)
+        except ValueError:
+            pass
+
+
+atexit.register(flush)
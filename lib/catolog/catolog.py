@@ -26,6 +26,11 @@ from logging import handlers
 import sys
 import os.path
 from catoconfig import catoconfig
+from . import masker
+from . import asynclog
+
+# secrets added here are masked in everything written to the log, see masker.py
+MASKER = masker.Masker()
 
 # ALL Cato modules import this, and it should be one of the first imports.
 LOGFORMAT = "%(asctime)s - %(name)s - %(levelname)s :: %(message)s\n"
@@ -37,6 +42,36 @@ LOGFILE = ""
 DEBUG = 20
 CLIENTDEBUG = 20
 
+class MaskingFormatter(logging.Formatter):
+    """Masks the secrets in MASKER.  A record can say it's already masked with extra={"masked": True}."""
+
+    def format(self, record):
+        s = logging.Formatter.format(self, record)
+        if MASKER.secrets and not getattr(record, "masked", False):
+            s = MASKER.mask(s)
+        return s
+
+
+def flush_masked():
+    """Writes out whatever the stdout/stderr streams are holding back (see masker.MaskingStream)."""
+    for stream in (sys.stdout, sys.stderr):
+        if isinstance(stream, StreamToLogger):
+            stream.flush_masked()
+
+
+def flush():
+    """Writes out everything logged so far, including anything held back for masking."""
+    flush_masked()
+    asynclog.flush()
+
+
+def _file_handler(handler):
+    """With log_async on, the handler does it's writing on the log writer thread (see asynclog.py)."""
+    if catoconfig.CONFIG.get("log_async") == "true":
+        return asynclog.AsyncHandler(handler)
+    return handler
+
+
 def get_logger(name):
     """
     Will get a logger.  Handlers will be defined by a call to set_logfile.
@@ -58,11 +93,18 @@ def _redirect_stdout():
     """
     stdout_logger = logging.getLogger('STDOUT')
     stderr_logger = logging.getLogger('STDERR')
+
+    # set_logfile can be called more than once in a process (pooled Task Engine workers)
+    # so get rid of any handler pointing to the previous file
+    for l in (stdout_logger, stderr_logger):
+        for handler in l.handlers[:]:
+            l.removeHandler(handler)
+            handler.close()
     
     # a file handler only for these two streams
     # with a different format
-    formatter = logging.Formatter("%(msg)s")
-    fh = logging.FileHandler(LOGFILE)
+    formatter = MaskingFormatter("%(msg)s")
+    fh = _file_handler(logging.FileHandler(LOGFILE))
     fh.setFormatter(formatter)
 
     stdout_logger.propagate = 0
@@ -120,14 +162,20 @@ def set_logfile(logfile):
     # PROS - nothing will be streamed to stdout and need to be shoved off to dev/null
     # CONS - nothing will be streamed to stdout, so if you run the process in a terminal there's no output
     # I've flipped this on and off at least a dozen times... grrrrr...
-    for handler in root.handlers:
+    for handler in root.handlers[:]:
         root.removeHandler(handler)
+        handler.close()
 
-    formatter = logging.Formatter(LOGFORMAT)
+    formatter = MaskingFormatter(LOGFORMAT)
     # fh = logging.FileHandler(LOGFILE)
-    fh = handlers.TimedRotatingFileHandler(LOGFILE, when='d', interval=1, backupCount=30)
+    fh = _file_handler(handlers.TimedRotatingFileHandler(LOGFILE, when='d', interval=1, backupCount=30))
     fh.setFormatter(formatter)
     root.addHandler(fh)
+
+    if catoconfig.CONFIG.get("log_async") == "true":
+        asynclog.configure(int(catoconfig.CONFIG["log_queue_size"]), catoconfig.CONFIG["log_overflow"])
+    # so an abort doesn't lose the end of the log, or what the masker is holding back
+    asynclog.flush_on_signal(before=flush_masked)
     
     # we are redirecting stdout and stderr to the logging system.
     # but it'll have a different file handler and formatter
@@ -144,12 +192,24 @@ class StreamToLogger(object):
         self.logger = logger
         self.log_level = log_level
         # self.linebuf = ''
+        # when there are secrets, writes go through this so a secret split across two writes is still masked
+        self.masking = MASKER.stream(self._write)
     
     def flush(self):
+        # NOTE: pexpect flushes after every write, so this doesn't flush what masking is holding back
         pass
 
+    def flush_masked(self):
+        self.masking.flush()
 
     def write(self, buf):
+        if MASKER.secrets:
+            self.masking.write(buf)
+        else:
+            self.masking.flush()
+            self._write(buf)
+
+    def _write(self, buf):
         if buf and buf != "\n":
             msg = buf.rstrip()
             # this also can suppress HTTP messages from the built in web server
@@ -160,7 +220,7 @@ class StreamToLogger(object):
 #                        self.logger.log(logging.INFO, "".join(msg))
                         return
                 
-            self.logger.log(self.log_level, "".join(msg))
+            self.logger.log(self.log_level, "".join(msg), extra={"masked": True})
 
 logging.basicConfig(level=logging.DEBUG, format="%(msg)s")
 # logging.config.dictConfig({
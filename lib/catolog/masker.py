@@ -0,0 +1,174 @@
+#########################################################################
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Masks secrets (passwords and the like) in log output.
+
+The secrets are plain strings, NOT regular expressions - a password with a '.' or a '$' in it
+only matches itself.  Every occurrence of every secret is masked, and where two occurrences
+overlap (one secret inside another, for example) the whole overlapping stretch is masked.
+
+Adding a secret is just adding it to the list, nothing is rebuilt.  Each secret is found with
+str.find, which in CPython is a lot quicker than walking a multi-pattern automaton (or a big
+alternation regex) through the text one character at a time in python.
+
+A MaskingStream is for output that arrives in pieces, like an ssh session being logged as it's
+read.  A secret can be split across two pieces, so only whole lines are written - the unfinished
+line at the end of a piece is held back until the next piece comes, or the stream is flushed.
+(A line is only split if it gets longer than LINE_LIMIT, and then only the last few characters,
+one less than the longest secret, are held back.)
+"""
+
+import threading
+
+MASK = "********"
+# an unfinished line longer than this is written, except for the end that could be the start of a secret
+LINE_LIMIT = 8192
+
+
+class Masker(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.secrets = ()
+            self.usecrets = ()
+            self.max_len = 0
+            # a secret with a newline in it can be split across lines
+            self.multiline = False
+
+    def add(self, secret):
+        """Adds a secret, returns False if it was already there (or empty)."""
+        if not secret:
+            return False
+        if isinstance(secret, unicode):
+            usecret = secret
+            secret = secret.encode("utf8")
+        else:
+            usecret = secret.decode("utf8", "replace")
+
+        with self.lock:
+            if secret in self.secrets:
+                return False
+            # new tuples, so a mask() already running on another thread isn't bothered
+            self.secrets = self.secrets + (secret,)
+            self.usecrets = self.usecrets + (usecret,)
+            self.max_len = max(self.max_len, len(secret), len(usecret))
+            self.multiline = self.multiline or "\n" in secret
+        return True
+
+    def __len__(self):
+        return len(self.secrets)
+
+    def spans(self, text):
+        """The (start, end) of every stretch of text that needs masking, in order and not overlapping."""
+        secrets = self.usecrets if isinstance(text, unicode) else self.secrets
+        found = []
+        for s in secrets:
+            n = len(s)
+            p = text.find(s)
+            while p != -1:
+                found.append((p, p + n))
+                p = text.find(s, p + 1)
+
+        if len(found) < 2:
+            return found
+
+        found.sort()
+        spans = [found[0]]
+        for start, end in found[1:]:
+            last_start, last_end = spans[-1]
+            if start < last_end:
+                if end > last_end:
+                    spans[-1] = (last_start, end)
+            else:
+                spans.append((start, end))
+        return spans
+
+    def mask(self, text):
+        if not self.secrets or not text:
+            return text
+        spans = self.spans(text)
+        if not spans:
+            return text
+        return _apply(text, spans)
+
+    def stream(self, out):
+        """A MaskingStream that writes masked output to the function out."""
+        return MaskingStream(self, out)
+
+
+def _apply(text, spans):
+    pieces = []
+    pos = 0
+    for start, end in spans:
+        pieces.append(text[pos:start])
+        pieces.append(MASK)
+        pos = end
+    pieces.append(text[pos:])
+    return text[:0].join(pieces)
+
+
+class MaskingStream(object):
+
+    def __init__(self, masker, out):
+        self.masker = masker
+        self.out = out
+        self.held = None
+
+    def write(self, data):
+        if not data:
+            return
+        if self.held:
+            try:
+                data = self.held + data
+            except UnicodeDecodeError:
+                # str and unicode pieces that won't go together, just let the held part go
+                self.flush()
+        self.held = None
+
+        keep = max(self.masker.max_len - 1, 0)
+        spans = self.masker.spans(data)
+        # the start of a secret that isn't all here yet is in the last keep characters...
+        safe = max(len(data) - keep, 0)
+        if self.masker.multiline:
+            # ... and could be on an earlier line
+            cut = data.rfind("\n", 0, safe) + 1
+        else:
+            # ... on the unfinished line
+            cut = data.rfind("\n") + 1
+        if len(data) - cut > LINE_LIMIT:
+            cut = safe
+
+        # everything before cut is safe to write... unless a secret runs across it,
+        # then it waits with the rest so the whole secret can be found again next time
+        for start, end in spans:
+            if start < cut < end:
+                cut = start
+                break
+
+        if cut:
+            self.out(_apply(data[:cut], [s for s in spans if s[1] <= cut]))
+        self.held = data[cut:]
+
+    def flush(self):
+        if self.held:
+            held = self.held
+            self.held = None
+            self.out(self.masker.mask(held))
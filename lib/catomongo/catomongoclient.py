@@ -325,8 +325,9 @@ def query_doc(coll, jpath):
     # initially, using brute force approach:
     # 1. first get all docs,
     docs = coll.find()
-    # 2. then filter those that have a match of jpath
-    results = filter(lambda x: jsonpath.jsonpath(x, jpath), docs)
+    # 2. then filter those that have a match of jpath (compiled once for all of them)
+    jp = jsonpath.compile_path(jpath)
+    results = filter(lambda x: jp.find(x), docs)
     return results
 
 def save_doc(coll, doc):
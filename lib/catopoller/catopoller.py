@@ -18,6 +18,8 @@ import os
 import sys
 import time
 import signal
+import select
+import subprocess
 
 base_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
 lib_path = os.path.join(base_path, "lib")
@@ -26,6 +28,121 @@ sys.path.insert(0, lib_path)
 from catolog import catolog
 from catocommon import catoprocess
 from catosettings import settings
+from catoconfig import catoconfig
+from catotaskengine import completion
+
+
+class Worker(object):
+    """
+    One warm Task Engine process in the pool.  See catotaskengine/worker.py for the other side.
+    """
+    def __init__(self, home, max_tasks):
+        # started with 'python' just like the cato_task_engine script, so check_processing still finds it
+        cmd = ["python", "%s/services/bin/cato_task_engine" % (home), "--worker", str(max_tasks)]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        self.pid = self.proc.pid
+        # the task instance it's running, None if it's idle
+        self.task_instance = None
+        # it's running it's last task, don't give it any more
+        self.retiring = False
+
+    def start_task(self, task_instance):
+        self.task_instance = task_instance
+        self.proc.stdin.write("%d\n" % (task_instance))
+        self.proc.stdin.flush()
+
+    def read(self):
+        """Reads a message from the worker.  Returns False if the worker is gone."""
+        line = self.proc.stdout.readline()
+        if not line:
+            return False
+
+        parts = line.split()
+        if parts and parts[0] == "done":
+            self.task_instance = None
+            if "exit" in parts:
+                self.retiring = True
+        return True
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def stop(self):
+        try:
+            self.proc.stdin.close()
+        except Exception:
+            pass
+
+
+class WorkerPool(object):
+    """
+    Keeps a number of Task Engine processes warm, with everything already imported,
+    so starting a task doesn't pay for a shell and a cold interpreter.
+
+    Each worker runs one task at a time, and is replaced after max_tasks tasks.
+    """
+    def __init__(self, home, size, max_tasks, logger):
+        self.home = home
+        self.size = size
+        self.max_tasks = max_tasks
+        self.logger = logger
+        self.workers = []
+        self.fill()
+
+    def fill(self):
+        """Replaces any workers that have exited."""
+        for w in self.workers[:]:
+            if not w.is_alive():
+                if w.task_instance:
+                    self.logger.info("Worker %d exited while running Task Instance %d" % (w.pid, w.task_instance))
+                self.workers.remove(w)
+
+        while len(self.workers) < self.size:
+            w = Worker(self.home, self.max_tasks)
+            self.logger.info("Started Task Engine worker %d" % (w.pid))
+            self.workers.append(w)
+
+    def poll(self):
+        """Collects messages from the workers, and replaces any that are gone."""
+        # reap anything that has exited (or been killed), so it isn't a zombie that looks alive
+        for w in self.workers:
+            w.proc.poll()
+
+        busy = [w for w in self.workers if w.task_instance or w.retiring]
+        while busy:
+            readable, _, _ = select.select([w.proc.stdout for w in busy], [], [], 0)
+            if not readable:
+                break
+            for w in busy[:]:
+                if w.proc.stdout in readable:
+                    if not w.read():
+                        # closed, fill() will clean it up
+                        w.proc.wait()
+                        busy.remove(w)
+                    elif not w.task_instance and not w.retiring:
+                        busy.remove(w)
+
+        self.fill()
+
+    def idle(self):
+        return [w for w in self.workers if not w.task_instance and not w.retiring]
+
+    def occupancy(self):
+        """The number of workers running a task."""
+        return len([w for w in self.workers if w.task_instance])
+
+    def start_task(self, task_instance):
+        """Hands a task to an idle worker.  Returns the worker pid, or None if there's no idle worker."""
+        for w in self.idle():
+            try:
+                w.start_task(task_instance)
+                return w.pid
+            except IOError:
+                # it died on us, fill() will replace it
+                w.task_instance = None
+                w.retiring = True
+        return None
+
 
 class Poller(catoprocess.CatoService):
 
@@ -35,6 +152,12 @@ class Poller(catoprocess.CatoService):
     # roller over check_processing counter when it gets to the following
     rollover_counter = 5
 
+    # see WorkerPool, None means every task gets a new cato_task_engine process
+    pool = None
+
+    # pid -> when it gets a KILL, see kill_ce_pid
+    pending_kills = None
+
     def start_submitted_tasks(self, get_num):
 
         task_list = []
@@ -57,6 +180,14 @@ class Poller(catoprocess.CatoService):
                         where task_instance = %s"""
                     self.db.exec_db(sql, (task_instance))
 
+                    if self.pool:
+                        pid = self.pool.start_task(task_instance)
+                        if pid:
+                            self.logger.info("Task instance %d started in worker %d" % (task_instance, pid))
+                            continue
+                        # no worker to take it, (shouldn't happen, we only ask for as many as are idle)
+                        self.logger.info("No idle worker for Task Instance %d, starting a new process" % (task_instance))
+
                     cmd_line = "nohup %s/services/bin/cato_task_engine %d >> %s/te/%d.log 2>&1 &" % (self.home, task_instance, catolog.LOGPATH, task_instance)
 
                     ret = os.system(cmd_line)
@@ -78,15 +209,44 @@ class Poller(catoprocess.CatoService):
             completed_dt = now() where task_instance = %s"""
         self.db.exec_db(sql, (task_instance))
 
+        # the task engine was killed, so it can't tell whoever is waiting on it.  We will.
+        sql = "select submitted_by_instance from task_instance where task_instance = %s"
+        waiter = self.db.select_col(sql, (task_instance))
+        completion.notify(waiter, task_instance, "Cancelled")
+
     def kill_ce_pid(self, pid):
 
         self.logger.info("Killing process %s" % (pid))
+        pid = int(pid)
         try:
-            os.kill(int(pid), signal.SIGKILL)
-            #os.wait()
+            # TERM first, so it can write out the end of it's log
+            os.kill(pid, signal.SIGTERM)
         except Exception, e:
             self.logger.info("Attempt to kill process %s failed: %s" % (pid, str(e)))
-            
+            return
+
+        # no waiting around for it here, check_kills finishes it off on a later pass if it has to
+        self.pending_kills[pid] = time.time() + float(catoconfig.CONFIG["poller_kill_grace"])
+
+    def check_kills(self):
+        """KILLs any process that was sent a TERM by kill_ce_pid and is still around after the grace period."""
+        now = time.time()
+        for pid, deadline in self.pending_kills.items():
+            try:
+                # NOTE: a pool worker has to be reaped first (pool.poll) or it's zombie looks alive here
+                os.kill(pid, 0)
+            except OSError:
+                # it's gone
+                del self.pending_kills[pid]
+                continue
+
+            if now >= deadline:
+                self.logger.info("Process %s did not exit after a TERM, killing it" % (pid))
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                del self.pending_kills[pid]
 
     def check_processing(self):
 
@@ -155,6 +315,15 @@ class Poller(catoprocess.CatoService):
                     self.kill_ce_pid(row[1])
                 self.update_cancelled(row[0])
 
+    def startup(self):
+        catoprocess.CatoService.startup(self)
+        self.pending_kills = {}
+
+        pool_size = int(catoconfig.CONFIG["poller_pool_size"])
+        if pool_size > 0:
+            self.logger.info("Starting a pool of %d Task Engine workers" % (pool_size))
+            self.pool = WorkerPool(self.home, pool_size, int(catoconfig.CONFIG["poller_pool_recycle"]), self.logger)
+
     def main_process(self):
         """main process loop, parent class will call this"""
 
@@ -177,10 +346,20 @@ class Poller(catoprocess.CatoService):
             self.loop_counter += 1
         
 
+        if self.pool:
+            self.pool.poll()
+        self.check_kills()
+
         # don't kick off any new work if the poller isn't enabled.
         if self.poller_enabled:
-            ### TO DO - need to get process count from linux
-            process_count = 0
-            get_processes = self.max_processes - process_count
-    
-            self.start_submitted_tasks(get_processes)
+            if self.pool:
+                process_count = self.pool.occupancy()
+                get_processes = min(self.max_processes - process_count, len(self.pool.idle()))
+                self.logger.debug("Worker pool occupancy: %d of %d" % (process_count, len(self.pool.workers)))
+            else:
+                ### TO DO - need to get process count from linux
+                process_count = 0
+                get_processes = self.max_processes - process_count
+
+            if get_processes > 0:
+                self.start_submitted_tasks(get_processes)
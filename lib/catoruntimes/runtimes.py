@@ -18,11 +18,12 @@ import os
 import sys
 import ast
 import base64
+import copy as _copy
 import json
 import re
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
-import dateutil.parser as parser
-from bson.objectid import ObjectId
 
 base_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
 lib_path = os.path.join(base_path, "lib")
@@ -30,15 +31,26 @@ sys.path.insert(0, lib_path)
 
 from catolog import catolog
 
+
+# dateutil and bson take a while to import, and most tasks never use either
+def parsedate(*args, **kwargs):
+    import dateutil.parser
+    return dateutil.parser.parse(*args, **kwargs)
+
+
+def object_id(*args, **kwargs):
+    from bson.objectid import ObjectId
+    return ObjectId(*args, **kwargs)
+
 # eval_get requires a safe environment to support some explicit language features for the eval.
 # NOTE: some of these are limited in scope and have non-standard names.
 EVAL_ENVIRONMENT = {
                'datetime': datetime,
                'timedelta': timedelta,
-               'ObjectId': ObjectId,
+               'ObjectId': object_id,
                'b64encode': base64.b64encode,
                'b64decode': base64.b64decode,
-               'parsedate': parser.parse,
+               'parsedate': parsedate,
                'asjson': json.dumps,
                'fromjson': json.loads
                }
@@ -52,101 +64,245 @@ for f in [
 ]:
     EVAL_ENVIRONMENT[f] = eval(f)
 
+# compiled expressions by their text, see compile_expression()
+CODE_CACHE_SIZE = 1000
+_code_cache = OrderedDict()
+_code_lock = threading.Lock()
+
+
+def compile_expression(expression):
+    """
+    The compiled code for an eval expression, cached by it's text.
+    Names are still looked up when the code is evaluated, so one compile serves every evaluation.
+    Raises SyntaxError just like eval would.
+    """
+    with _code_lock:
+        try:
+            code = _code_cache.pop(expression)
+            _code_cache[expression] = code
+            return code
+        except KeyError:
+            pass
+
+    # eval() of a string ignores leading blanks, compile() doesn't
+    code = compile(expression.lstrip(" \t"), "<string>", "eval")
+    with _code_lock:
+        _code_cache[expression] = code
+        while len(_code_cache) > CODE_CACHE_SIZE:
+            _code_cache.popitem(last=False)
+    return code
+
+
+def _text(value):
+    """
+    Some values aren't kept as a string - command output that was spilled to a file (see
+    catotaskengine/spill.py) stays there until something actually asks for the value.
+    """
+    if getattr(value, "lazy_text", False):
+        return str(value)
+    return value
+
+
+class Variable(object):
+    """
+    One runtime variable.
+
+    values is the one and only copy of the data - the legacy array, as set by [[ ]] commands.
+    The python object the [$ $] syntax sees is only built from it when an expression
+    actually asks for it, and is thrown away as soon as the values change.
+    """
+    __slots__ = ("names", "values", "indexed", "obj", "has_obj")
+
+    def __init__(self, name):
+        # every case this variable has been set with, expressions are case sensitive
+        self.names = set([name])
+        self.values = []
+        # set with an index, so the object is a list
+        self.indexed = False
+        self.obj = None
+        self.has_obj = False
+
+    def changed(self):
+        self.obj = None
+        self.has_obj = False
+
+    def size(self):
+        """approximate bytes used by the values (and the object if it's been built)"""
+        n = sys.getsizeof(self.values) + sum(sys.getsizeof(v) for v in self.values)
+        if self.has_obj:
+            n += sys.getsizeof(self.obj)
+        return n
+
+
+class _Namespace(object):
+    """
+    The mapping eval_get and eval_set run against.  Objects are only built for the
+    variables an expression names.  Names that aren't runtime variables
+    (and the builtins in EVAL_ENVIRONMENT) fall through to the globals as usual.
+    """
+    def __init__(self, rt):
+        self.rt = rt
+
+    def __getitem__(self, name):
+        try:
+            return self.rt.objects[name]
+        except KeyError:
+            pass
+        var = self.rt.vars.get(name.upper())
+        if var is None or name not in var.names:
+            raise KeyError(name)
+        return self.rt._get_obj(var)
+
+    def __setitem__(self, name, value):
+        var = self.rt.vars.get(name.upper())
+        if var is not None and name in var.names:
+            var.obj = value
+            var.has_obj = True
+        else:
+            self.rt.objects[name] = value
+
+    def __delitem__(self, name):
+        raise KeyError(name)
+
+
 class Runtimes:
     def __init__(self):
 
         self.logger = catolog.get_logger("Runtimes")
 
-        # initialize the runtime array dictionary
-        self.data = {}
+        # the runtime variables, by upper case name
+        self.vars = {}
+
+        # objects that only exist in the new variable syntax, created by an expression and not a set
+        self.objects = {}
 
-        # for the new variable syntax feature
-        self.obj_data = {}
+        self.namespace = _Namespace(self)
+
+        # bumped every time a legacy array changes, so anything derived from a value
+        # (like a parsed xml document) can tell if it's stale
+        self.versions = {}
 
     def _objectify(self, s):
         """ attempt to parse a string into a python object """
-        self.logger.debug("_objectify got %s" % (s))
+        s = _text(s)
+        if not isinstance(s, basestring):
+            return s
         try:
             out = ast.literal_eval(s)
         except:
             out = s
-
-        self.logger.debug("_objectify resulted in %s" % (s))
         return out
 
-    def _fill(self, l, index):
-        """fills the array with nothing for specific number of indexes"""
-
-        length = len(l)
-
-        if index >= length:
-            l.extend(None for _ in range(length, index + 1))
-
+    def _get_obj(self, var):
+        """the object view of a variable, built the first time an expression needs it"""
+        if not var.has_obj:
+            if var.indexed:
+                var.obj = [self._objectify(v) for v in var.values]
+            else:
+                var.obj = self._objectify(var.values[0]) if var.values else ""
+            var.has_obj = True
+        return var.obj
+
+    def _var(self, name):
+        """gets (or creates) the variable for a name"""
+        key = name.upper()
+        var = self.vars.get(key)
+        if var is None:
+            var = Variable(name)
+            self.vars[key] = var
+            # a real variable now, it replaces any expression-only object
+            self.objects.pop(name, None)
+        elif name not in var.names:
+            var.names.add(name)
+            self.objects.pop(name, None)
+        return var
+
+    def _touch(self, name):
+        """bumps the version of a (legacy, upper case) array name"""
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def version(self, name):
+        """returns the current version of a named array, 0 if it's never been set"""
+        return self.versions.get(name.upper(), 0)
 
     def set(self, name, value, index=None):
         """sets a named array given a value and index. index is optional, creates the array if not exist"""
 
-        # NEW FEATURE
-        # notice there's no index - 1 here, for consistency with python arrays
-        objval = self._objectify(value)
-        if index is None:
-            self.obj_data[name] = objval
-        else:
-            if name not in self.obj_data:
-                self.obj_data[name] = [objval]
-            else:
-                self.obj_data[name].insert(index, objval)
+        var = self._var(name)
+        self._touch(name.upper())
+        var.changed()
 
-        # LEGACY METHOD
-        name = name.upper()
         if not index:
-            self.data[name] = [value]
+            var.values = [value]
+            var.indexed = False
         else:
+            var.indexed = True
             # task engine index starts at 1, python list starts at 0
             index = index - 1
-            try:
-                l_len = len(self.data[name])
-            except KeyError:
-                self.data[name] = []
-                l_len = len(self.data[name])
+            l = var.values
+            l_len = len(l)
             if index == l_len:
-                self.data[name].append(value)
+                # filling an array row by row is the common case
+                l.append(value)
             elif index > l_len:
-                self._fill(self.data[name], index)
-                self.data[name][index] = value
+                l.extend(None for _ in range(l_len, index))
+                l.append(value)
             else:
-                self.data[name][index] = value
-
+                l[index] = value
 
     def get(self, name, index=None):
         """gets a single value from named array"""
 
-        name = name.upper()
         if not index:
             index = 0
         else:
             # task engine index starts at 1, python list starts at 0
             index = index - 1
         try:
-            val = self.data[name][index]
+            val = self.vars[name.upper()].values[index]
             if val is None:
                 val = ""
         except (IndexError, KeyError):
             val = ""
 
-        return val
+        return _text(val)
+
+    def get_raw(self, name, index=None):
+        """
+        Same as get, but a value that isn't kept as a string comes back as it is.
+        For the few things that can read a spilled command output without loading all of it.
+        """
+        if not index:
+            index = 1
+        try:
+            val = self.vars[name.upper()].values[index - 1]
+        except (IndexError, KeyError):
+            val = None
+        return "" if val is None else val
 
     def show(self):
         """prints the full runtime structure, debugging"""
 
-        print self.data
+        print dict((k, v.values) for k, v in self.vars.iteritems())
+
+    def memory_report(self):
+        """
+        Returns a list of (name, number of values, approximate bytes) for every variable,
+        biggest first.  So you can tell what's taking up all the memory.
+        """
+        out = []
+        for k, v in self.vars.iteritems():
+            out.append((k, len(v.values), v.size()))
+        for k, v in self.objects.iteritems():
+            out.append((k, 1, sys.getsizeof(v)))
+        out.sort(key=lambda x: x[2], reverse=True)
+        return out
 
     def count(self, name):
         """returns the count of a named array, 0 if it does not exist"""
 
-        name = name.upper()
         try:
-            length = len(self.data[name])
+            length = len(self.vars[name.upper()].values)
         except KeyError:
             length = 0
 
@@ -155,49 +311,104 @@ class Runtimes:
     def get_all(self, name):
         """returns all values of a named array, list format. Empty list if array doesn't exist"""
 
-        name = name.upper()
         try:
-            return self.data[name][:]
+            return [_text(v) for v in self.vars[name.upper()].values]
         except KeyError:
             return []
 
     def set_all(self, name, vals=[]):
         """sets a named array provided a list"""
 
-        name = name.upper()
-        self.data[name] = vals
+        var = self._var(name)
+        self._touch(name.upper())
+        var.changed()
+        var.values = list(vals)
+        var.indexed = True
 
     def clear(self, name, index=None):
         """deletes all values of named array"""
 
-        name = name.upper()
+        key = name.upper()
+        self._touch(key)
 
         if not index:
             try:
-                del(self.data[name])
-            except:
+                del(self.vars[key])
+            except KeyError:
                 pass
         else:
             # task engine index starts at 1, python list starts at 0
             index = index - 1
             try:
-                self.data[name].pop(index)
+                var = self.vars[key]
+                var.values.pop(index)
+                var.changed()
             except:
                 pass
 
+    def copy(self):
+        """
+        A completely separate copy of every variable, for a parallel branch.
+        Objects an expression has changed are copied too, since they might not match the values any more.
+        """
+        rt = Runtimes()
+        for k, v in self.vars.iteritems():
+            nv = Variable(k)
+            nv.names = set(v.names)
+            nv.values = v.values[:]
+            nv.indexed = v.indexed
+            if v.has_obj:
+                nv.obj = _copy.deepcopy(v.obj)
+                nv.has_obj = True
+            rt.vars[k] = nv
+        rt.objects = _copy.deepcopy(self.objects)
+        rt.versions = dict(self.versions)
+        return rt
+
+    def _same(self, a, base, b):
+        """is variable a (from this Runtimes) the same as variable b (from base)?"""
+        if a.values != b.values or a.indexed != b.indexed:
+            return False
+        if a.has_obj:
+            return a.obj == base._get_obj(b)
+        return True
+
+    def merge(self, other, base):
+        """
+        Copies every change other made since it was copied from base (see copy()) into this Runtimes.
+        Returns the names of the variables that were changed.
+        """
+        changed = []
+        for k, v in other.vars.iteritems():
+            b = base.vars.get(k)
+            if b is None or not other._same(v, base, b):
+                self.vars[k] = v
+                for n in v.names:
+                    self.objects.pop(n, None)
+                self._touch(k)
+                changed.append(k)
+
+        for k in base.vars:
+            if k not in other.vars:
+                self.vars.pop(k, None)
+                self._touch(k)
+                changed.append(k)
+
+        for k, v in other.objects.iteritems():
+            if k not in base.objects or base.objects[k] != v:
+                self.objects[k] = v
+                changed.append(k)
+
+        return changed
+
     def exists(self, name):
         """does the variable array exist"""
 
-        name = name.upper()
-        try:
-            z = self.data[name]
-            return True
-        except KeyError:
-            return False
+        return name.upper() in self.vars
 
     def eval_set(self, expression, value):
         """
-        evaluates an expression to find a specific item in the obj_data collection
+        evaluates an expression to find a specific item in the runtime variables
         and sets it to a new value
         """
         if len(expression):
@@ -206,7 +417,7 @@ class Runtimes:
             self.logger.debug("update expression is:\n %s" % (expression))
             self.logger.debug("newval is:\n %s" % (newval))
             # exec is dangerous!
-            # so, we only allow it to run against our obj_data collection
+            # so, we only allow it to run against our runtime variables
 
             # this isn't perfect, but we have to assume if _objectify returned a basestring
             # then the value is a string.
@@ -219,22 +430,21 @@ class Runtimes:
             self.logger.debug("trying to execute:\n %s" % (setexpr))
 
             try:
-                exec(setexpr, {}, self.obj_data)
+                exec(setexpr, {}, self.namespace)
             except Exception as ex:
                 # write a log message, but fail safely by setting the value to ""
                 self.logger.error("Variable assignment is not valid.\n%s" % (str(ex)))
 
     def eval_get(self, expression):
-        """evaluates an expression to retrieve data from the obj_data collection"""
+        """evaluates an expression to retrieve data from the runtime variables"""
         if len(expression):
             expression = expression.strip()
             self.logger.debug("expression is:\n %s" % (expression))
-            # self.logger.debug("obj_data is:\n %s" % (self.obj_data))
             # NOTE: eval is dangerous!
-            # so, we only allow it to run against our obj_data collection
+            # so, we only allow it to run against our runtime variables
             # and a very strict environment
             try:
-                result = eval(expression, EVAL_ENVIRONMENT, self.obj_data)
+                result = eval(compile_expression(expression), EVAL_ENVIRONMENT, self.namespace)
                 
                 # here's a helper feature
                 # "task parameter" values are *always* a list, even if they only have one item.
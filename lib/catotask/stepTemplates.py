@@ -201,6 +201,8 @@ def GetStepTemplate(oStep):
         sHTML = Loop(oStep)
     elif sFunction.lower() == "while":
         sHTML = While(oStep)
+    elif sFunction.lower() == "foreach":
+        sHTML = Foreach(oStep)
     elif sFunction.lower() == "exists":
         sHTML = Exists(oStep)
     else:
@@ -300,6 +302,8 @@ def GetStepTemplate_View(oStep):
         sHTML = Loop_View(oStep)
     elif sFunction.lower() == "while":
         sHTML = While_View(oStep)
+    elif sFunction.lower() == "foreach":
+        sHTML = Foreach_View(oStep)
     elif sFunction.lower() == "exists":
         sHTML = Exists_View(oStep)
     elif sFunction.lower() == "new_connection":
@@ -3046,6 +3050,98 @@ def While_View(oStep):
 
     return sHTML
 
+def Foreach(oStep):
+    xd = oStep.FunctionXDoc
+
+    sArray = xd.findtext("array", "")
+    sItemVar = xd.findtext("item_var", "")
+    sResultVar = xd.findtext("result_var", "")
+    sMaxConcurrent = xd.findtext("max_concurrent", "")
+    sTimeout = xd.findtext("timeout", "")
+    sOnError = xd.findtext("on_error", "")
+
+    xAction = xd.find("action")
+
+    sHTML = ""
+
+    sHTML += "For each item in\n"
+    sHTML += "<input type=\"text\" " + CommonAttribs(oStep, True, "array", "w200px") + \
+        " help=\"The name of an array variable, or $name for a list.\" value=\"" + sArray + "\" />\n"
+
+    sHTML += " set\n"
+    sHTML += "<input type=\"text\" " + CommonAttribs(oStep, True, "item_var", "") + \
+        " validate_as=\"variable\" help=\"Variable the action gets the item in.\" value=\"" + sItemVar + "\" />\n"
+
+    sHTML += " and collect\n"
+    sHTML += "<input type=\"text\" " + CommonAttribs(oStep, False, "result_var", "") + \
+        " validate_as=\"variable\" help=\"Variable the action sets, collected into an array in item order.\" value=\"" + sResultVar + "\" />.<br />\n"
+
+    sHTML += "Run\n"
+    sHTML += "<input type=\"text\" " + CommonAttribs(oStep, False, "max_concurrent", "w50px") + \
+        " help=\"How many items to run at the same time.\" value=\"" + sMaxConcurrent + "\" />\n"
+    sHTML += " at a time, for at most\n"
+    sHTML += "<input type=\"text\" " + CommonAttribs(oStep, False, "timeout", "w50px") + \
+        " help=\"Seconds each item may run, checked before each step.\" value=\"" + sTimeout + "\" /> seconds each.\n"
+
+    sHTML += " If an item fails\n"
+    sHTML += "<select " + CommonAttribs(oStep, False, "on_error", "") + ">\n"
+    sHTML += "  <option " + SetOption("fail", sOnError) + " value=\"fail\">fail the step</option>\n"
+    sHTML += "  <option " + SetOption("continue", sOnError) + " value=\"continue\">continue</option>\n"
+    sHTML += "</select>\n"
+
+    sHTML += "<hr />\n"
+
+    # enable the dropzone for the Action
+    if xAction is not None:
+        xEmbeddedFunction = xAction.find("function")
+        # xEmbeddedFunction might be None, but we pass it anyway to get the empty zone drawn
+        sHTML += DrawDropZone(oStep, xEmbeddedFunction, "action", "Action:<br />", True)
+    else:
+        sHTML += "ERROR: Malformed XML for Step ID [" + oStep.ID + "].  Missing 'action' element."
+
+    return sHTML
+
+def Foreach_View(oStep):
+    xd = oStep.FunctionXDoc
+
+    sArray = xd.findtext("array", "")
+    sItemVar = xd.findtext("item_var", "")
+    sResultVar = xd.findtext("result_var", "")
+    sMaxConcurrent = xd.findtext("max_concurrent", "")
+    sTimeout = xd.findtext("timeout", "")
+
+    xAction = xd.find("action")
+
+    sHTML = ""
+
+    sHTML += "For each item in"
+    sHTML += "<span class=\"code\">" + sArray + "</span>"
+    sHTML += " set"
+    sHTML += "<span class=\"code\">" + sItemVar + "</span>"
+    if sResultVar:
+        sHTML += " and collect"
+        sHTML += "<span class=\"code\">" + sResultVar + "</span>"
+    if sMaxConcurrent:
+        sHTML += ", "
+        sHTML += "<span class=\"code\">" + sMaxConcurrent + "</span>"
+        sHTML += " at a time"
+    if sTimeout:
+        sHTML += ", for at most"
+        sHTML += "<span class=\"code\">" + sTimeout + "</span>"
+        sHTML += " seconds each"
+    sHTML += "."
+
+    sHTML += "<hr />"
+
+    # enable the dropzone for the Action
+    if xAction is not None:
+        xEmbeddedFunction = xAction.find("function")
+        sHTML += DrawEmbeddedReadOnlyStep(xEmbeddedFunction)
+    else:
+        sHTML += "ERROR: Malformed XML for Step ID [" + oStep.ID + "].  Missing 'action' element."
+
+    return sHTML
+
 def Exists(oStep):
     # the base xpath of this command (will be '' unless this is embedded)
     # NOTE: do not append the base_path on any CommonAttribs calls, it's done inside that function.
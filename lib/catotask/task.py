@@ -24,6 +24,7 @@ import traceback
 import json
 
 from catocommon import catocommon
+from catotaskengine import stepprofile
 from datetime import datetime
 from catoerrors import InfoException
 
@@ -935,7 +936,7 @@ class Task(object):
                     " set function_xml = replace(function_xml," \
                     " '" + drStepIDs["step_id"] + "'," \
                     " '" + drStepIDs["newstep_id"] + "')" \
-                    " where function_name in ('if','loop','exists','while')"
+                    " where function_name in ('if','loop','exists','while','foreach','parallel')"
                 db.tran_exec(sSQL)
 
         # finally, put the temp steps table in the real steps table
@@ -1725,6 +1726,67 @@ class TaskRunLog(object):
         # NOTE: the AsText method ONLY RETURNS THE LOG ROWS, not the result summary or row count.
         return catocommon.ObjectOutput.IterableAsText(self.log_rows, ['codeblock_name', 'step_order', 'function_name', 'log'], delimiter, headers)
 
+class TaskStepProfile(object):
+    """
+    How long each step of a Task takes, from the step profile of every instance of it.
+    p50/p95 come from the combined histograms, so they're estimates (within about 10%).
+    """
+    def __init__(self, sTaskID):
+        self.task_id = sTaskID
+        self.instances = 0
+        self.steps = []
+
+        db = catocommon.new_conn()
+        sSQL = """select p.step_id, p.function_name, p.task_instance, p.exec_count, p.wall_ms, p.max_wall_ms,
+            p.db_ms, p.remote_ms, p.output_bytes, p.histogram, s.codeblock_name, s.step_order
+            from task_instance_step_profile p
+            join task_instance ti on p.task_instance = ti.task_instance
+            left outer join task_step s on p.step_id = s.step_id
+            where ti.task_id = %s"""
+        rows = db.select_all_dict(sSQL, (sTaskID))
+        db.close()
+
+        instances = set()
+        steps = {}
+        for row in rows or []:
+            instances.add(row["task_instance"])
+            key = (row["step_id"], row["function_name"])
+            st = steps.get(key)
+            if not st:
+                st = steps[key] = {"step_id": row["step_id"], "function_name": row["function_name"],
+                                   "codeblock_name": row["codeblock_name"] or "", "step_order": row["step_order"],
+                                   "instances": 0, "exec_count": 0, "wall_ms": 0, "max_wall_ms": 0,
+                                   "db_ms": 0, "remote_ms": 0, "output_bytes": 0, "histogram": {}}
+            st["instances"] += 1
+            st["exec_count"] += row["exec_count"]
+            st["wall_ms"] += row["wall_ms"]
+            st["max_wall_ms"] = max(st["max_wall_ms"], row["max_wall_ms"])
+            st["db_ms"] += row["db_ms"]
+            st["remote_ms"] += row["remote_ms"]
+            st["output_bytes"] += row["output_bytes"]
+            stepprofile.decode_histogram(row["histogram"], st["histogram"])
+
+        for st in steps.itervalues():
+            hist = st.pop("histogram")
+            n = st["exec_count"]
+            st["avg_ms"] = int(round(float(st["wall_ms"]) / n)) if n else 0
+            st["p50_ms"] = stepprofile.percentile(hist, 50, st["max_wall_ms"])
+            st["p95_ms"] = stepprofile.percentile(hist, 95, st["max_wall_ms"])
+
+        self.instances = len(instances)
+        # slowest first, that's usually the point
+        self.steps = sorted(steps.values(), key=lambda st: st["wall_ms"], reverse=True)
+
+    def AsJSON(self):
+        return catocommon.ObjectOutput.AsJSON(self.__dict__)
+
+    def AsXML(self):
+        return catocommon.ObjectOutput.IterableAsXML(self.steps, "steps", "step")
+
+    def AsText(self, delimiter=None, headers=None):
+        return catocommon.ObjectOutput.IterableAsText(self.steps, ['codeblock_name', 'step_order', 'function_name', 'exec_count',
+            'avg_ms', 'p50_ms', 'p95_ms', 'max_wall_ms', 'db_ms', 'remote_ms', 'output_bytes'], delimiter, headers)
+
 class TaskInstance(object):
     """
     """
@@ -0,0 +1,168 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Buffered writer for the task_instance_log table.
+
+TaskEngine.insert_audit used to do a single row insert (with a commit) for every
+message.  A tight loop can log tens of thousands of them, and the round trips
+end up being most of the task run time.
+
+Here rows go on a bounded queue, and a background thread writes them in multi row
+inserts, on it's own database connection.  The thread opens the connection itself,
+so the Task Engine doesn't wait on it at startup.  A batch is written when it's big enough,
+when the oldest row has waited long enough, or when somebody calls flush().
+
+The Task Engine flushes at every step boundary and before every status change,
+so the log is always complete when a task finishes or errors.  Rows the writer couldn't
+write are handed back at the flush, and the Task Engine writes them on it's own connection -
+a problem with the task log never fails a step or keeps a status from being set.
+
+NOTE: entered_dt is still now() in the database, so a row can be stamped up to
+flush_interval seconds after it was logged.
+"""
+
+import time
+import threading
+import Queue
+
+from catolog import catolog
+
+INSERT_SQL = """insert into task_instance_log
+    (task_instance, step_id, entered_dt, connection_name, log, command_text)
+    values """
+ROW_SQL = "(%s, %s, now(), %s, %s, %s)"
+# rows per insert
+BATCH_SIZE = 200
+
+# queue markers
+_FLUSH = object()
+_STOP = object()
+
+
+class AuditWriter(object):
+
+    def __init__(self, exec_db, new_conn, batch_size=BATCH_SIZE, flush_interval=1.0, queue_size=10000):
+        """
+        exec_db is called as exec_db(sql, params, conn) to write a batch - normally TaskEngine.exec_db,
+        so a lost connection is retried the same way as everything else.
+        new_conn returns a database connection, which is owned by this writer.
+        """
+        self.logger = catolog.get_logger(__name__)
+        self.exec_db = exec_db
+        self.new_conn = new_conn
+        # opened by the writer thread, see _run()
+        self.conn = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # put() blocks when this is full, so a runaway task slows down instead of losing log rows
+        self.q = Queue.Queue(queue_size)
+
+        # the last error the writer thread hit, and the rows it couldn't write because of it.
+        # they're handed back by take_failed(), for the Task Engine to write itself
+        self.error = None
+        self.failed = []
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, name="AuditWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, row):
+        """Queues a row, a tuple of (task_instance, step_id, connection_name, log, command_text)."""
+        self.q.put(row)
+
+    def flush(self):
+        """
+        Blocks until everything written so far has been written, or tried.
+        Returns take_failed() - a failed write never raises, the task log is not worth failing a task over.
+        """
+        if self.q.unfinished_tasks:
+            self.q.put(_FLUSH)
+            self.q.join()
+        return self.take_failed()
+
+    def take_failed(self):
+        """(error, rows) - the rows that couldn't be written since the last time, and why.  error is None if all went well."""
+        with self.lock:
+            e, rows = self.error, self.failed
+            self.error = None
+            self.failed = []
+        return e, rows
+
+    def close(self):
+        """Flushes and stops the writer thread."""
+        if self.thread.is_alive():
+            self.q.put(_STOP)
+            self.thread.join()
+
+    def _write(self, rows):
+        if not rows:
+            return
+        sql = INSERT_SQL + ",".join([ROW_SQL] * len(rows))
+        params = []
+        for r in rows:
+            params.extend(r)
+        try:
+            if not self.conn:
+                # it couldn't connect before, see _run()
+                self.conn = self.new_conn()
+            self.exec_db(sql, params, self.conn)
+        except Exception as e:
+            self.logger.critical("Error writing %d rows to the task log.\n%s" % (len(rows), e))
+            with self.lock:
+                self.error = e
+                self.failed.extend(rows)
+
+    def _run(self):
+        try:
+            self.conn = self.new_conn()
+        except Exception as e:
+            # it tries again when there's something to write
+            self.logger.critical("Unable to connect the task log writer to the database.\n%s" % (e))
+
+        pending = []
+        # the number of queue items in pending, to mark done once they're written
+        taken = 0
+        deadline = None
+
+        while True:
+            try:
+                if pending:
+                    item = self.q.get(True, max(deadline - time.time(), 0))
+                else:
+                    item = self.q.get()
+            except Queue.Empty:
+                item = None
+
+            if item is not None:
+                taken += 1
+                if item is not _FLUSH and item is not _STOP:
+                    if not pending:
+                        deadline = time.time() + self.flush_interval
+                    pending.append(item)
+
+            if (item is None or item is _FLUSH or item is _STOP
+                or len(pending) >= self.batch_size or (pending and time.time() >= deadline)):
+                self._write(pending)
+                pending = []
+                for _ in range(taken):
+                    self.q.task_done()
+                taken = 0
+
+            if item is _STOP:
+                break
@@ -0,0 +1,199 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Batched parsing of a command's output into step variables, for TaskEngine.process_buffer.
+
+The row by row code splits every line again for each delimited variable, and works out
+every range and regex again for each row.  Here the rows are split once, each row's
+columns are split once (and only if a variable needs them), and every variable's spec
+is worked out once per step.  Then each variable is filled as a whole column.
+
+The results are the same as the row by row code, row for row.  Errors (like a bad
+range end) are raised at the same point they would be, the first time a row needs them.
+"""
+
+import re
+
+
+class Column(object):
+    """One step variable, compiled.  value(line, cols) returns the value for one row."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Delimited(Column):
+    def __init__(self, name, position):
+        Column.__init__(self, name)
+        self.pos = int(position) - 1
+        self.uses_columns = True
+
+    def value(self, line, cols):
+        try:
+            return cols()[self.pos]
+        except IndexError:
+            return ""
+
+
+class Range(Column):
+    def __init__(self, name, range_begin, prefix, range_end, suffix):
+        Column.__init__(self, name)
+        self.uses_columns = False
+        self.prefix = prefix
+        self.suffix = suffix
+
+        # None means find the prefix/suffix instead
+        self.begin = None
+        if len(range_begin):
+            self.begin = int(range_begin) - 1
+
+        # (end is a slice end, where None is the end of the string)
+        self.use_suffix = not len(range_end)
+        self.end = None
+        self.end_error = None
+        if not self.use_suffix:
+            try:
+                self.end = int(range_end)
+            except ValueError:
+                if "end" != range_end[0:3]:
+                    # not raised until a row actually gets this far, same as always
+                    self.end_error = "The end position %s must either be an integer or start with the word 'end'" % (range_end)
+                elif "end" != range_end:
+                    # end minus some integer
+                    try:
+                        self.end = int(range_end[3:])
+                    except ValueError as ex:
+                        self.end_error = ex
+
+    def value(self, line, cols):
+        if self.begin is None:
+            begin = line.find(self.prefix)
+            if begin == -1:
+                return ""
+            begin += len(self.prefix)
+        else:
+            begin = self.begin
+
+        if self.use_suffix:
+            end = line.find(self.suffix, begin + 1)
+            if end == -1:
+                return ""
+        else:
+            if self.end_error:
+                if isinstance(self.end_error, Exception):
+                    raise self.end_error
+                raise Exception(self.end_error)
+            end = self.end
+
+        return line[begin:end]
+
+
+class Regex(Column):
+    def __init__(self, name, pattern):
+        Column.__init__(self, name)
+        self.uses_columns = False
+        self.regex = re.compile(pattern, re.MULTILINE)
+
+    def value(self, line, cols):
+        match = self.regex.search(line)
+        if not match:
+            return ""
+        return match.group()
+
+
+class XPath(Column):
+    def __init__(self, name, path, lookup):
+        Column.__init__(self, name)
+        self.uses_columns = False
+        self.path = path
+        # TaskEngine.aws_get_result_var, which caches the parsed document for any other xpath columns
+        self.lookup = lookup
+
+    def value(self, line, cols):
+        if len(line):
+            return self.lookup(line, self.path)
+        return ""
+
+
+class Empty(Column):
+    """an unknown type, always an empty string - same as the row by row code"""
+    uses_columns = False
+
+    def value(self, line, cols):
+        return ""
+
+
+def compile_columns(variables, xpath_lookup):
+    """
+    Compiles the step_variables rows from get_node_list into Columns, in order.
+    (name, type, position, range_begin, prefix, range_end, suffix, regex, xpath)
+    """
+    columns = []
+    for v in variables:
+        name, typ = v[0], v[1]
+        if typ == "delimited":
+            columns.append(Delimited(name, v[2]))
+        elif typ == "range":
+            columns.append(Range(name, v[3], v[4], v[5], v[6]))
+        elif typ == "regex":
+            columns.append(Regex(name, v[7]))
+        elif typ == "xpath":
+            columns.append(XPath(name, v[8], xpath_lookup))
+        else:
+            columns.append(Empty(name))
+    return columns
+
+
+def parse(rows, columns, col_delimiter=None):
+    """
+    Fills every column for every row.
+
+    Returns a list of (name, values) in variable order.  When more than one variable has
+    the same name the last one wins, just like setting them row by row.
+    col_delimiter is a function returning the column delimiter, only called if a column needs it.
+    """
+    results = dict((id(c), []) for c in columns)
+
+    c_del = []
+
+    def get_c_del():
+        if not c_del:
+            c_del.append(col_delimiter())
+        return c_del[0]
+
+    for line in rows:
+        split = []
+
+        def cols():
+            # the row is split at most once, however many delimited columns there are
+            if not split:
+                split.append(line.split(get_c_del()))
+            return split[0]
+
+        for c in columns:
+            results[id(c)].append(c.value(line, cols))
+
+    out = []
+    seen = {}
+    for c in columns:
+        key = c.name.upper()
+        if key in seen:
+            out[seen[key]] = (c.name, results[id(c)])
+        else:
+            seen[key] = len(out)
+            out.append((c.name, results[id(c)]))
+    return out
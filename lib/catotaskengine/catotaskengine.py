@@ -16,6 +16,10 @@
 
 import sys
 import os
+import time
+
+# how long the imports below take, for the startup timing in the log
+_import_started = time.time()
 
 base_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
 lib_path = os.path.join(base_path, "lib")
@@ -23,11 +27,11 @@ sys.path.insert(0, lib_path)
 
 import logging
 import traceback
-import time
 import re
 import pwd
-import pexpect
 import json
+import shutil
+import hashlib
 
 from catolog import catolog
 from catoconfig import catoconfig
@@ -40,12 +44,32 @@ import base64
 from matheval import matheval
 from . import commands
 from . import classes
+from . import templates
+from . import doccache
+from . import auditlog
+from . import completion
+from . import bufferparse
+from . import spill
+from . import sshpool
+from . import stepprofile
+from . import registry
 from jsonpath import jsonpath
 
+# NOTE: pexpect is imported where it's used, a task that never connects to anything doesn't need it
+_import_seconds = time.time() - _import_started
+
 
 class TaskEngine():
 
     def __init__(self, process_name, task_instance):
+        global _import_seconds
+        # what startup is spending it's time on, written to the log at the end of startup()
+        self.startup_timer = stepprofile.StartupTimer()
+        if _import_seconds is not None:
+            # only the first Task Engine in a process did the imports
+            self.startup_timer.add("imports", _import_seconds)
+            _import_seconds = None
+
         self.host = os.uname()[1]
         self.platform = os.uname()[0]
         self.user = pwd.getpwuid(os.getuid())[0]
@@ -58,6 +82,8 @@ class TaskEngine():
 
         # see augment() for details about self.extension_modules
         self.extension_modules = []
+        # every command this Task Engine can run, built in startup()
+        self.command_registry = None
 
         # see augment() and sub_globals() for details about global_variables
         # TODO: Add _PUBLIC_IP, _PRIVATE_IP, _DATE
@@ -93,10 +119,14 @@ class TaskEngine():
         catolog.set_logfile(os.path.join(catolog.LOGPATH, "te", self.task_instance + ".log"))
 
         self.logger = catolog.get_logger(process_name)
+        self.startup_timer.mark("logfile")
 
 
         self.mysql_conns = {}
         self.cloud_conns = {}
+        # awspy connections, see get_aws_conn
+        self.aws_conns = {}
+        self.datastore = classes.Datastore()
         self.task_handles = {}
         self.connections = {}
         self.systems = {}
@@ -111,11 +141,45 @@ class TaskEngine():
         self.submitted_by_user = ""
         self.submitted_by_email = ""
         self.http_response = -1
-        self.sensitive = []
-        self.sensitive_re = None
+        # passwords and the like, masked in the task log and the logfile
+        # (it's the logfile's masker, a pooled process starts over for every task)
+        self.masker = catolog.MASKER
+        self.masker.clear()
         self.on_error = None
         self.parameter_xml = None
 
+        # compiled step xml for callers that only have the xml string, see get_step_plan()
+        self.step_plans = {}
+
+        # parsed xml documents used by xpath variable lookups, see get_xml_root()
+        self.doc_cache = doccache.DocumentCache()
+
+        # buffered task_instance_log writer, started in startup()
+        self.audit_writer = None
+
+        # the instance that submitted this one (if any), it's told when we finish
+        self.submitted_by_instance = None
+        # only created if we wait on other task instances, see wait_for_handles()
+        self.completion_listener = None
+
+        # command output too big to keep in memory, see spill.py
+        self.spill_buffers = []
+
+        # set on the copy of the engine that runs a parallel branch, see parallel.py
+        self.branch = None
+        # when a branch has to be finished by, checked before each step
+        self.deadline = None
+
+        # per step timing, see stepprofile.py.  the prof_ totals are for the step that's running
+        self.profiler = None
+        if catocommon.is_true(catoconfig.CONFIG["te_step_profile"]):
+            self.profiler = stepprofile.StepProfiler()
+        self.prof_db = 0.0
+        self.prof_remote = 0.0
+        self.prof_output = 0
+        self.profile_written = False
+        self.startup_timer.mark("init")
+
     # ## internal methods here
 
     def _xml_del_namespace(self, xml):
@@ -166,14 +230,17 @@ class TaskEngine():
             pass
 
     def execute_expect(self, c, cmd, pos="PROMPT>", neg=None, timeout=20):
+        import pexpect
 
         expect_list = [pos, pexpect.EOF, pexpect.TIMEOUT]
         if neg:
             expect_list.append(neg)
 
         c.timeout = timeout
+        start = time.time()
         c.sendline(cmd)
         index = c.expect(expect_list)
+        self.add_remote_wait(start)
         if index == 0:
             pass
         elif index == 1:
@@ -195,7 +262,129 @@ class TaskEngine():
             raise Exception(msg)
 
         # remove any trailing newline
-        return str(c.before).rstrip("\n")
+        buff = str(c.before).rstrip("\n")
+        self.prof_output += len(buff)
+        return buff
+
+    def execute_expect_streaming(self, c, cmd, pos="PROMPT>", neg=None, timeout=20):
+        """
+        The same as execute_expect, except the output is written to a SpillFile as it's read,
+        instead of piling up in c.before.  Returns a string, or a SpillBuffer if the output was big.
+
+        Only the last spill.MATCH_WINDOW characters are searched for the responses,
+        which is plenty for any prompt.
+        """
+        import pexpect
+        # pexpect compiles string patterns the same way
+        patterns = [re.compile(pos, re.DOTALL)]
+        if neg:
+            patterns.append(re.compile(neg, re.DOTALL))
+
+        out = self.new_spill_file()
+        try:
+            c.timeout = timeout
+            start = time.time()
+            c.sendline(cmd)
+            end_time = start + timeout
+
+            # anything already read but not yet matched is the start of our output
+            tail = c.buffer
+            c.buffer = ""
+            while True:
+                # the earliest match wins, ties go to the positive response - same as pexpect
+                found = None
+                for ii, p in enumerate(patterns):
+                    m = p.search(tail)
+                    if m and (found is None or m.start() < found[1].start()):
+                        found = (ii, m)
+                if found:
+                    break
+
+                if len(tail) > spill.MATCH_WINDOW:
+                    out.write(tail[:-spill.MATCH_WINDOW])
+                    tail = tail[-spill.MATCH_WINDOW:]
+
+                remaining = end_time - time.time()
+                try:
+                    if remaining <= 0:
+                        raise pexpect.TIMEOUT("")
+                    tail += c.read_nonblocking(c.maxread, remaining)
+                except pexpect.EOF:
+                    out.write(tail)
+                    msg = "The connection to closed unexpectedly."
+                    msg = msg + "\n" + self.summarize_output(self.keep_output(out.result()))
+                    raise Exception(msg)
+                except pexpect.TIMEOUT:
+                    msg = "%s\nCommand timed out after %s seconds." % (cmd, timeout)
+                    raise Exception(msg)
+
+            ii, m = found
+            self.add_remote_wait(start)
+            out.write(tail[:m.start()])
+            # whatever came after the match is left for next time, just like pexpect
+            c.buffer = tail[m.end():]
+            c.before = ""
+            c.after = m.group()
+            c.match = m
+
+            if ii == 1:
+                msg = "Negative response %s received ..." % (neg)
+                msg = cmd + "\n" + msg + "\n" + self.summarize_output(self.keep_output(out.result())) + m.group()
+                raise Exception(msg)
+
+            buff = self.keep_output(out.result())
+            self.prof_output += len(buff)
+            return buff
+        finally:
+            out.discard()
+
+    def add_remote_wait(self, start, output=None):
+        """For the step profile, the time since start was spent waiting on something remote, and output came back."""
+        self.prof_remote += time.time() - start
+        if output is not None:
+            self.prof_output += len(output)
+
+    def new_spill_file(self, exact=False):
+        d = os.path.join(catoconfig.CONFIG["tmpdir"], "cato_te_spill", str(self.task_instance))
+        return spill.SpillFile(d, int(catoconfig.CONFIG["te_spill_threshold"]), exact)
+
+    def keep_output(self, buff):
+        """
+        Tracks a SpillBuffer, so it's closed when the task is done.
+        A step that doesn't put one in a variable closes it sooner, with release_output().
+        """
+        if isinstance(buff, spill.SpillBuffer):
+            self.logger.info("Command output of %d bytes was written to %s" % (len(buff), buff.path))
+            self.spill_buffers.append(buff)
+        return buff
+
+    def release_output(self, buff):
+        """Closes a SpillBuffer and removes it's file.  Not for one that was put in a variable!"""
+        if isinstance(buff, spill.SpillBuffer):
+            buff.close()
+            try:
+                self.spill_buffers.remove(buff)
+            except ValueError:
+                pass
+
+    def summarize_output(self, buff):
+        """Spilled output is too big for the log, just the head and tail."""
+        if isinstance(buff, spill.SpillBuffer):
+            return spill.summarize(buff, int(catoconfig.CONFIG["te_spill_log_limit"]))
+        return buff
+
+    def use_streaming(self, step):
+        """Should this step stream it's output?  A step can say no with stream_output="false"."""
+        if not int(catoconfig.CONFIG["te_spill_threshold"]):
+            return False
+        return step.get_plan().root.attrib.get("stream_output", "true") != "false"
+
+    def release_spill(self):
+        for b in self.spill_buffers:
+            b.close()
+        self.spill_buffers = []
+        d = os.path.join(catoconfig.CONFIG["tmpdir"], "cato_te_spill", str(self.task_instance))
+        shutil.rmtree(d, ignore_errors=True)
 
 
     def remove_pk(self, kf_name):
@@ -208,6 +397,7 @@ class TaskEngine():
 
 
     def connect_expect(self, type, host, user, password=None, passphrase=None, key=None, default_prompt=None, debug=False):
+        import pexpect
 
         at_prompt = False
         timeout = 20
@@ -237,17 +427,30 @@ class TaskEngine():
         else:
             verbose = ""
 
-        if key:
+        # shared connections, see sshpool.py
+        pool_opts = ""
+        shared = False
+        max_masters = int(catoconfig.CONFIG["te_ssh_pool_size"])
+        if max_masters:
+            pool_opts, shared = sshpool.ssh_options(host, user, key, password, max_masters,
+                int(catoconfig.CONFIG["te_ssh_pool_idle"]))
+
+        if shared:
+            # the master is already authenticated, the key isn't needed
+            key = None
+            self.insert_audit("new_connection", "Using a shared ssh connection to %s@%s" % (user, host), "")
+            cmd = "ssh %s %s -o ForwardAgent=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s" % (verbose, pool_opts, user, host)
+        elif key:
             kf_name = "%s/%s.pem" % (self.tmpdir, self.new_uuid())
             kf = file(kf_name, "w",)
             kf.write(key)
             kf.close()
             os.chmod(kf_name, 0400)
             self.insert_audit("new_connection", "Attempting ssh private key authentication to %s@%s" % (user, host), "")
-            cmd = "ssh %s -i %s -o ForwardAgent=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s" % (verbose, kf_name, user, host)
+            cmd = "ssh %s %s -i %s -o ForwardAgent=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s" % (verbose, pool_opts, kf_name, user, host)
         else:
             self.insert_audit("new_connection", "Attempting ssh password authentication to %s@%s" % (user, host), "")
-            cmd = "ssh %s -o ForwardAgent=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s" % (verbose, user, host)
+            cmd = "ssh %s %s -o ForwardAgent=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s" % (verbose, pool_opts, user, host)
 
         reattempt = True
         attempt = 1
@@ -287,7 +490,8 @@ class TaskEngine():
                     if attempt != 10:
                         msg = "%s\nssh connection address %s unreachable on attempt %d. %s Sleeping and reattempting" % (buffer, host, attempt, msg)
                         self.insert_audit("new_connection", msg, "")
-                        time.sleep(20)
+                        # back off, 2, 4, 8, 16 then 20 seconds
+                        time.sleep(min(2 ** attempt, 20))
                         attempt += 1
                         break
                     else:
@@ -468,21 +672,32 @@ class TaskEngine():
             raise Exception(msg)
         return newdb
 
-    def get_xml_val(self, xml, path, index=0):
-
+    def get_xml_root(self, xml, key=None):
+        """
+        Returns the parsed root of an xml document, from the document cache if it's there.
+        
+        key identifies the document, see doccache.DocumentCache.
+        """
+        if isinstance(xml, spill.SpillBuffer) and key is None:
+            # without a key the text is the key
+            xml = str(xml)
         try:
-            root = catocommon.ET.fromstring(xml)
+            return self.doc_cache.get(xml, key)
         except Exception as e:
             msg = "Could not parse XML %s, %s" % (xml, e)
             raise Exception(msg)
 
-        self.logger.debug("xpath: looking for %s" % (path.strip()))
+    def get_xml_val(self, xml, path, index=0, key=None):
+
+        root = self.get_xml_root(xml, key)
+
+        self.logger.debug("xpath: looking for %s", path.strip())
         nodes = root.findall(path.strip())
         if nodes:
             try:
                 node = nodes[index]
             except IndexError as ex:
-                self.logger.debug("xpath: ... index error\n%s" % (ex.__str__()))
+                self.logger.debug("xpath: ... index error\n%s", ex.__str__())
                 v = ""
             else:
                 if len(list(node)):
@@ -492,10 +707,9 @@ class TaskEngine():
         else:
             self.logger.debug("xpath: ... no match")
             v = ""
-        del(root)
         return v
 
-    def get_xml_by_path(self, xml, path):
+    def get_xml_by_path(self, xml, path, key=None):
 
         if "," in path:
             comma = path.find(",")
@@ -505,48 +719,47 @@ class TaskEngine():
         else:
             index = 0
 
-        return self.get_xml_val(xml, path, index)
+        return self.get_xml_val(xml, path, index, key)
 
 
-    def get_xml_count(self, xml, node_name):
+    def get_xml_count(self, xml, node_name, key=None):
 
-        root = catocommon.ET.fromstring(xml)
+        root = self.get_xml_root(xml, key)
         nodes = root.findall(node_name)
         if nodes:
             count = len(nodes)
         else:
             count = 0
-        del(root)
         return count
 
 
-    def get_node_list(self, xml, node_name, *args):
+    def get_step_plan(self, step):
+        """
+        Returns the compiled StepPlan for a step.
+        
+        Built-in commands pass the Step itself.  Extensions have always passed the raw
+        step.command xml string, so those are compiled once and kept by string.
+        """
+        if isinstance(step, classes.Step):
+            return step.get_plan()
 
-        return_list = []
-        root = catocommon.ET.fromstring(xml)
-        node_name = "./" + node_name
-        nodes = root.findall(node_name)
+        try:
+            return self.step_plans[step]
+        except KeyError:
+            plan = classes.StepPlan(catocommon.ET.fromstring(step))
+            self.step_plans[step] = plan
+            return plan
 
-        for node in nodes:
-            part_list = []
-            for subnode in args:
-                # self.logger.debug(subnode)
-                subnode = "./" + subnode
-                part_list.append(node.findtext(subnode, ""))
-            return_list.append(part_list)
-        del(root)
-        return return_list
+    def get_node_list(self, xml, node_name, *args):
+
+        return self.get_step_plan(xml).node_list(node_name, *args)
 
     def get_command_params(self, xml, *args):
 
-        return_list = []
-        root = catocommon.ET.fromstring(xml)
-        for node in args:
-            node = "./" + node
-            self.logger.debug("Field: %s" % (node))
-            self.logger.debug("Value: %s" % (root.findtext(node, "")))
-            return_list.append(root.findtext(node, ""))
-        del(root)
+        return_list = self.get_step_plan(xml).args(*args)
+        for node, value in zip(args, return_list):
+            self.logger.debug("Field: ./%s", node)
+            self.logger.debug("Value: %s", value)
         return return_list
 
     def new_uuid(self):
@@ -555,9 +768,7 @@ class TaskEngine():
 
     def add_to_sensitive(self, s):
 
-        if s and len(s) and s not in self.sensitive:
-            self.sensitive.append(s)
-            self.sensitive_re = re.compile("|".join(self.sensitive))
+        self.masker.add(s)
 
 
     def insert_audit(self, command, log, conn=""):
@@ -569,20 +780,75 @@ class TaskEngine():
                     step_id = "NULL"
 
                 # the following masks passwords and the like
-                if self.sensitive_re:
-                    log = re.sub(self.sensitive_re, "********", log)
+                log = self.masker.mask(log)
+
+                # rows from parallel branches are interleaved, so say which one it was
+                if self.branch:
+                    log = "[%s] %s" % (self.branch, log)
 
-                sql = """insert into task_instance_log 
-                    (task_instance, step_id, entered_dt, connection_name, log, command_text) 
-                    values 
-                    (%s, %s, now(), %s, %s, %s)"""
-                self.exec_db(sql, (self.task_instance, step_id, conn, log.decode("utf8", "ignore"), command))
+                row = (self.task_instance, step_id, conn, log.decode("utf8", "ignore"), command)
+                if self.audit_writer:
+                    self.audit_writer.write(row)
+                else:
+                    sql = """insert into task_instance_log 
+                        (task_instance, step_id, entered_dt, connection_name, log, command_text) 
+                        values 
+                        (%s, %s, now(), %s, %s, %s)"""
+                    self.exec_db(sql, row)
 
-                self.logger.critical(log)
+                self.logger.critical(log, extra={"masked": True})
 
             if at == 1:
                 self.audit_trail_on = 0
 
+    def new_db_conn(self):
+        """A new connection to the cato database."""
+        conn = catodb.Db()
+        conn.connect_db(server=catoconfig.CONFIG["server"], port=catoconfig.CONFIG["port"],
+            user=catoconfig.CONFIG["user"],
+            password=catoconfig.CONFIG["password"], database=catoconfig.CONFIG["database"])
+        return conn
+
+    def start_audit_writer(self):
+        """Starts the buffered task log writer, it opens it's own database connection."""
+        self.audit_writer = auditlog.AuditWriter(self.exec_db, self.new_db_conn,
+            batch_size=int(catoconfig.CONFIG["te_audit_batch_size"]),
+            flush_interval=float(catoconfig.CONFIG["te_audit_flush_interval"]),
+            queue_size=int(catoconfig.CONFIG["te_audit_queue_size"]))
+
+    def flush_audit(self):
+        """
+        Makes sure everything sent to insert_audit so far is in the database.
+        If the writer couldn't write something, it's written here instead.  Never raises.
+        """
+        if self.audit_writer:
+            self.write_failed_audit(*self.audit_writer.flush())
+
+    def write_failed_audit(self, error, rows):
+        """Writes the rows the task log writer couldn't, on this engine's own connection."""
+        if not error:
+            return
+        self.logger.critical("The task log writer failed, writing %d rows directly.  %s" % (len(rows), error))
+        try:
+            for ii in range(0, len(rows), auditlog.BATCH_SIZE):
+                batch = rows[ii:ii + auditlog.BATCH_SIZE]
+                params = []
+                for r in batch:
+                    params.extend(r)
+                self.exec_db(auditlog.INSERT_SQL + ",".join([auditlog.ROW_SQL] * len(batch)), params)
+        except Exception as ex:
+            self.logger.critical("The task log may be incomplete.  %s" % (ex))
+
+    def stop_audit_writer(self):
+        if self.audit_writer:
+            w = self.audit_writer
+            # anything logged from here on goes straight to the database
+            self.audit_writer = None
+            w.close()
+            if w.conn:
+                w.conn.close()
+            self.write_failed_audit(*w.take_failed())
+
     def get_node_values(self, xml, path, attribs=[], elems=[], other=""):
         """Given an xml string and path, returns a list of dictionary objects.
 
@@ -695,19 +961,155 @@ class TaskEngine():
                 name = v[0]
                 index = int(v[1]) - 1
                 t_index = ii + 1
-                self.logger.debug("%s, %s, %s, %s" % (name, index, t_index, row))
-                self.logger.debug("rt.set(%s, %s, %s)" % (name, row[index], t_index))
+                self.logger.debug("%s, %s, %s, %s", name, index, t_index, row)
+                self.logger.debug("rt.set(%s, %s, %s)", name, row[index], t_index)
                 self.rt.set(name, row[index], t_index)
 
     def get_step_object(self, step_id, step_xml):
 
-        root = catocommon.ET.fromstring(step_xml)
-        function_name = root.attrib.get("name")
-        parse_method = root.attrib.get("parse_method")
-        row_del = root.attrib.get("row_delimiter")
-        col_del = root.attrib.get("col_delimiter")
-        del(root)
-        return classes.Step(step_id, function_name, step_xml, parse_method, row_del, col_del)
+        return classes.Step.from_element(step_id, catocommon.ET.fromstring(step_xml))
+
+    def get_bracket_var_value(self, found_var):
+        """
+        Resolves the name found inside a [[ ]] variable reference.
+        
+        Shared by the compiled templates (see replace_variables) and the legacy replace_vars.
+        """
+        if found_var.startswith("_"):
+            # it's a global variable, look it up
+            value = self.sub_global(found_var)
+        elif found_var.startswith("#"):
+            # this is a task handle variable
+            value = self.get_handle_var(found_var)
+        elif found_var.startswith("$"):
+            # this is an "object" lookup (likely set by Read JSON)
+            index = 1  # in case no index is explicitly set, so we don't need two lookup blocks in if cases below
+            new_found_var = found_var
+            if "," in found_var:
+                # it's got a comma, so it's either an array value or count
+                comma = found_var.find(",")
+                index = found_var[comma + 1:]
+                new_found_var = found_var[:comma]
+
+            if index == "*":
+                # we want the array count, set that as the value and move on
+                value = self.rt.count(new_found_var)
+            else:
+                # not a count, so set value based on var name and index
+                # if the index is not a valid integer, error
+                try:
+                    int_index = int(index)
+                except ValueError:
+                    msg = "The array index [%s] for variable [%s] is not a valid integer." % (index, new_found_var)
+                    raise Exception(msg)
+                except Exception as ex:
+                    raise Exception(ex)
+
+                parts = new_found_var[1:].split(":", 1)
+                varname = parts[0]
+                keypath = "" if len(parts) == 1 else parts[1]
+
+                var = self.rt.get(varname, int_index)
+                self.logger.debug("Object variable - variable is [%s].", varname)
+
+                if not keypath:
+                    value = var
+                else:
+                    self.logger.debug("Object variable - keypath is [%s].", keypath)
+                    self.logger.debug(type(var))
+
+                    if isinstance(var, str):
+                        # attempt to load it into a dictionary object
+                        var = json.loads(var)
+
+                    # [[objvar:*]] will return the number of keys INSIDE this object
+                    # if the 'keypath' starts with a $, that's a JSONPATH so we'll apply that
+                    # otherwise we'll try a simple root level name.
+                    if keypath == "*":
+                        value = len(var)
+                    else:
+                        try:
+                            value = self._use_jsonpath(varname, var, keypath)
+                        except Exception as ex:
+                            self.logger.critical(ex)
+                            value = ""
+
+        elif "." in found_var:
+            # this is an xpath query
+            period = found_var.find(".")
+            new_found_var = found_var[:period]
+            xpath = found_var[period + 1:]
+            # (get_raw, a spilled command output is only read when it's not in the cache)
+            xml = self.rt.get_raw(new_found_var)
+            if len(xml):
+                # the parsed document is cached until the variable changes
+                key = (new_found_var.upper(), self.rt.version(new_found_var))
+                value = self.aws_get_result_var(xml, xpath, key)
+            else:
+                value = ""
+        else:
+            # it might be a runtime variable
+            new_found_var = found_var
+            # first test if it has a comma
+            if "," in found_var:
+                # it's got a comma, so it's either an array value or count
+                # we'll determine the index
+                comma = found_var.find(",")
+                new_found_var = found_var[:comma]
+                index = found_var[comma + 1:]
+                if index == "*":
+                    # we want the array count, set that as the value and move on
+                    value = self.rt.count(new_found_var)
+                else:
+                    # not a count, so set value based on var name and index
+                    # if the index is not a valid integer, error
+                    try:
+                        int_index = int(index)
+                    except ValueError:
+                        msg = "The array index [%s] for variable [%s] is not a valid integer." % (index, new_found_var)
+                        raise Exception(msg)
+                    except Exception as ex:
+                        raise Exception(ex)
+
+                    value = self.rt.get(new_found_var, int_index)
+            else:
+                # no index, set the value based on var name
+                value = self.rt.get(new_found_var)
+
+        return value
+
+    def get_dollar_var_value(self, varname):
+        """
+        Resolves the expression found inside a [$ $] variable reference.
+        
+        Shared by the compiled templates (see replace_variables) and the legacy replace_vars_new.
+        """
+        if varname.startswith("_"):
+            # it's a global variable, look it up
+            value = self.sub_global(varname)
+        elif varname.startswith("#"):
+            # this is a task handle variable
+            value = self.get_handle_var(varname)
+        elif "^" in varname:
+            # this is an xpath query
+            carat = varname.find("^")
+            new_varname = varname[:carat]
+            xpath = varname[carat + 1:]
+            xml = self.rt.eval_get(new_varname)
+
+            self.logger.debug("VARNAME: %s", new_varname)
+            self.logger.debug("XPATH: %s", xpath)
+            self.logger.debug("XML: %s", xml)
+
+            if len(xml):
+                value = self.aws_get_result_var(xml, xpath)
+            else:
+                value = ""
+        else:
+            # a normal variable expression
+            value = self.rt.eval_get(varname)
+
+        return value
 
     def replace_vars(self, s):
 
@@ -721,103 +1123,7 @@ class TaskEngine():
             found_var = self.find_var(s)
             if found_var:
                 # we found a variable to replace
-                if found_var.startswith("_"):
-                    # it's a global variable, look it up
-                    value = self.sub_global(found_var)
-                elif found_var.startswith("#"):
-                    # this is a task handle variable
-                    value = self.get_handle_var(found_var)
-                elif found_var.startswith("$"):
-                    # this is an "object" lookup (likely set by Read JSON)
-                    index = 1  # in case no index is explicitly set, so we don't need two lookup blocks in if cases below
-                    new_found_var = found_var
-                    if "," in found_var:
-                        # it's got a comma, so it's either an array value or count
-                        comma = found_var.find(",")
-                        index = found_var[comma + 1:]
-                        new_found_var = found_var[:comma]
-
-                    if index == "*":
-                        # we want the array count, set that as the value and move on
-                        value = self.rt.count(new_found_var)
-                    else:
-                        # not a count, so set value based on var name and index
-                        # if the index is not a valid integer, error
-                        try:
-                            int_index = int(index)
-                        except ValueError:
-                            msg = "The array index [%s] for variable [%s] is not a valid integer." % (index, new_found_var)
-                            raise Exception(msg)
-                        except Exception as ex:
-                            raise Exception(ex)
-
-                        parts = new_found_var[1:].split(":", 1)
-                        varname = parts[0]
-                        keypath = "" if len(parts) == 1 else parts[1]
-
-                        var = self.rt.get(varname, int_index)
-                        self.logger.debug("Object variable - variable is [%s]." % (varname))
-
-                        if not keypath:
-                            value = var
-                        else:
-                            self.logger.debug("Object variable - keypath is [%s]." % (keypath))
-                            self.logger.debug(type(var))
-
-                            if isinstance(var, str):
-                                # attempt to load it into a dictionary object
-                                var = json.loads(var)
-
-                            # [[objvar:*]] will return the number of keys INSIDE this object
-                            # if the 'keypath' starts with a $, that's a JSONPATH so we'll apply that
-                            # otherwise we'll try a simple root level name.
-                            if keypath == "*":
-                                value = len(var)
-                            else:
-                                try:
-                                    value = self._use_jsonpath(varname, var, keypath)
-                                except Exception as ex:
-                                    self.logger.critical(ex)
-                                    value = ""
-
-                elif "." in found_var:
-                    # this is an xpath query
-                    period = found_var.find(".")
-                    new_found_var = found_var[:period]
-                    xpath = found_var[period + 1:]
-                    xml = self.rt.get(new_found_var)
-                    if len(xml):
-                        value = self.aws_get_result_var(xml, xpath)
-                    else:
-                        value = ""
-                else:
-                    # it might be a runtime variable
-                    new_found_var = found_var
-                    # first test if it has a comma
-                    if "," in found_var:
-                        # it's got a comma, so it's either an array value or count
-                        # we'll determine the index
-                        comma = found_var.find(",")
-                        new_found_var = found_var[:comma]
-                        index = found_var[comma + 1:]
-                        if index == "*":
-                            # we want the array count, set that as the value and move on
-                            value = self.rt.count(new_found_var)
-                        else:
-                            # not a count, so set value based on var name and index
-                            # if the index is not a valid integer, error
-                            try:
-                                int_index = int(index)
-                            except ValueError:
-                                msg = "The array index [%s] for variable [%s] is not a valid integer." % (index, new_found_var)
-                                raise Exception(msg)
-                            except Exception as ex:
-                                raise Exception(ex)
-
-                            value = self.rt.get(new_found_var, int_index)
-                    else:
-                        # no index, set the value based on var name
-                        value = self.rt.get(new_found_var)
+                value = self.get_bracket_var_value(found_var)
 
                 # now we substitute the variable with the value in the original string
                 sub_string = "[[" + found_var + "]]"
@@ -848,30 +1154,7 @@ class TaskEngine():
             varname = s[begin_pos + 2:end_pos]
 
             if varname:
-                if varname.startswith("_"):
-                    # it's a global variable, look it up
-                    value = self.sub_global(varname)
-                elif varname.startswith("#"):
-                    # this is a task handle variable
-                    value = self.get_handle_var(varname)
-                elif "^" in varname:
-                    # this is an xpath query
-                    carat = varname.find("^")
-                    new_varname = varname[:carat]
-                    xpath = varname[carat + 1:]
-                    xml = self.rt.eval_get(new_varname)
-
-                    self.logger.debug("VARNAME: %s" % (new_varname))
-                    self.logger.debug("XPATH: %s" % (xpath))
-                    self.logger.debug("XML: %s" % (xml))
-
-                    if len(xml):
-                        value = self.aws_get_result_var(xml, xpath)
-                    else:
-                        value = ""
-                else:
-                    # a normal variable expression
-                    value = self.rt.eval_get(varname)
+                value = self.get_dollar_var_value(varname)
 
                 # now we substitute the variable with the value in the original string
                 sub_string = "[$" + varname + "$]"
@@ -978,13 +1261,32 @@ class TaskEngine():
 
 
     def replace_variables(self, s):
+        """
+        Replaces all [$ $] variable references, then all [[ ]] references.
+        
+        Each distinct string is compiled once into a template (see templates.py) and rendered
+        in a single pass.  Anything the templates can't handle with the exact legacy
+        semantics goes through the original replace_vars_new / replace_vars loops.
+        """
 
         # NEW METHOD FIRST
-        while re.search(".*\[\$.*\$\]", s):
-            s = self.replace_vars_new(s)
+        if "[$" in s:
+            try:
+                s = templates.compile_template(s, templates.DOLLAR).render(self.get_dollar_var_value)
+                # values can contain references too, the legacy loop finishes those off
+                s = self.replace_vars_new(s)
+            except templates.Unsafe:
+                pass
+            while "[$" in s and templates.DOLLAR_RE.search(s):
+                s = self.replace_vars_new(s)
 
-        while re.search(".*\[\[.*\]\]", s):
-            s = self.replace_vars(s)
+        if "[[" in s:
+            try:
+                s = templates.compile_template(s, templates.BRACKET).render(self.get_bracket_var_value)
+            except templates.Unsafe:
+                pass
+            while "[[" in s and templates.BRACKET_RE.search(s):
+                s = self.replace_vars(s)
 
         return s
 
@@ -997,15 +1299,23 @@ class TaskEngine():
 
     def process_buffer(self, buff, step):
 
+        variables = self.get_node_list(step, "step_variables/variable", "name", "type", "position",
+            "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
+
+        # the batched parser is the default, a step can ask for the row by row one with buffer_parse="row"
+        mode = step.get_plan().root.attrib.get("buffer_parse") or catoconfig.CONFIG["te_buffer_parse"]
+        if mode != "row":
+            return self.process_buffer_batched(buff, step, variables)
+
+        if isinstance(buff, spill.SpillBuffer):
+            buff = str(buff)
+
         row_count = 1
         if step.row_delimiter:
             r_del = self.tochar(step.row_delimiter)
             buff = buff.split(r_del)
             row_count = len(buff)
 
-        variables = self.get_node_list(step.command, "step_variables/variable", "name", "type", "position",
-            "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
-
         for ii in range(row_count):
 
             if step.row_delimiter:
@@ -1093,6 +1403,35 @@ class TaskEngine():
 
                 self.rt.set(name, value, ii + 1)
 
+    def process_buffer_batched(self, buff, step, variables):
+        """
+        Same results as the row by row process_buffer, but each variable spec is worked out once,
+        each row is split once, and each variable is set as a whole array.  See bufferparse.py.
+        """
+        if not variables:
+            return
+
+        if isinstance(buff, spill.SpillBuffer):
+            # big output is read a row at a time, straight from the file
+            if step.row_delimiter:
+                rows = buff.rows(self.tochar(step.row_delimiter))
+            else:
+                rows = [str(buff)]
+        elif step.row_delimiter:
+            rows = buff.split(self.tochar(step.row_delimiter))
+        else:
+            rows = [buff]
+
+        columns = bufferparse.compile_columns(variables, self.aws_get_result_var)
+
+        def col_delimiter():
+            self.logger.debug("col delim = " + step.col_delimiter)
+            return self.tochar(step.col_delimiter)
+
+        self.logger.debug("parsing rows into %d variables" % (len(columns)))
+        for name, values in bufferparse.parse(rows, columns, col_delimiter):
+            self.rt.set_all(name, values)
+
 
     def retrieve_private_key(self, keyname, cloud):
 
@@ -1184,31 +1523,84 @@ class TaskEngine():
 
     def refresh_handle(self, h):
 
-        ti = h.instance
-        sql = """select ti.task_status, ti.started_dt, ti.completed_dt, ti.ce_node, ti.pid, 
+        self.refresh_handles([h])
+
+    def refresh_handles(self, handles):
+        """Refreshes any number of task handles, in one query."""
+
+        if not handles:
+            return
+
+        by_instance = {}
+        for h in handles:
+            by_instance.setdefault(str(h.instance), []).append(h)
+
+        sql = """select ti.task_instance, ti.task_status, ti.started_dt, ti.completed_dt, ti.ce_node, ti.pid, 
             a.asset_id, a.asset_name, ti.task_id, t.task_name, ti.submitted_by, t.version, 
             t.default_version, ti.submitted_dt
             from task_instance ti 
             join task t on ti.task_id = t.task_id 
             left outer join asset a on a.asset_id = ti.asset_id 
-            where ti.task_instance = %s"""
-        row = self.select_row(sql, (ti))
+            where ti.task_instance in (%s)""" % (",".join(["%s"] * len(by_instance)))
+        rows = self.select_all(sql, by_instance.keys())
+
+        if rows:
+            for row in rows:
+                for h in by_instance.get(str(row[0]), []):
+                    h.status = row[1]
+                    h.started_dt = row[2]
+                    h.completed_dt = row[3]
+                    h.cenode = row[4]
+                    h.pid = row[5]
+                    h.asset = row[6]
+                    h.asset_name = row[7]
+                    h.task_id = row[8]
+                    h.task_name = row[9]
+                    h.submitted_by = row[10]
+                    h.task_version = row[11]
+                    h.is_default = row[12]
+                    h.submitted_dt = row[13]
+                    self.logger.info("Handle %s refreshed ..." % (h.handle_name))
+
+    def wait_for_handles(self, handles):
+        """
+        Waits for task handles to reach a finished status, yielding each one as it does.
 
-        if row:
-            h.status = row[0]
-            h.started_dt = row[1]
-            h.completed_dt = row[2]
-            h.cenode = row[3]
-            h.pid = row[4]
-            h.asset = row[5]
-            h.asset_name = row[6]
-            h.task_id = row[7]
-            h.task_name = row[8]
-            h.submitted_by = row[9]
-            h.task_version = row[10]
-            h.is_default = row[11]
-            h.submitted_dt = row[12]
-            self.logger.info("Handle %s refreshed ..." % (h.handle_name))
+        Task instances we submitted tell us when they finish (see completion.py) so we wake right up.
+        Every te_wait_poll_interval seconds all the unfinished handles are checked in the database anyway,
+        for task instances on other nodes or that we didn't submit.
+        """
+        if not self.completion_listener:
+            # listening BEFORE the first check, so nothing can finish in between unnoticed
+            self.completion_listener = completion.CompletionListener(self.task_instance)
+
+        interval = float(catoconfig.CONFIG["te_wait_poll_interval"])
+        pending = list(handles)
+        to_refresh = pending[:]
+        next_check = time.time() + interval
+
+        while pending:
+            if to_refresh:
+                self.refresh_handles(to_refresh)
+                for h in to_refresh:
+                    if h.status in completion.FINISHED_STATUSES:
+                        pending.remove(h)
+                        yield h
+                if not pending:
+                    break
+
+            notices = self.completion_listener.wait(max(next_check - time.time(), 0), [str(h.instance) for h in pending])
+            if time.time() >= next_check:
+                to_refresh = pending[:]
+                next_check = time.time() + interval
+            else:
+                # only the ones we just heard about
+                to_refresh = [h for h in pending if str(h.instance) in notices]
+
+    def close_completion_listener(self):
+        if self.completion_listener:
+            self.completion_listener.close()
+            self.completion_listener = None
 
     def get_task_status(self, ti):
 
@@ -1275,15 +1667,14 @@ class TaskEngine():
         return str(i)
 
 
-    def aws_get_result_var(self, result, path):
+    def aws_get_result_var(self, result, path, key=None):
 
-        if path.startswith("count(") and path.endswith(")"):
-            path = "." + path[6:-1]
-            value = self.get_xml_count(result, path)
+        # the same few paths get used over and over, they're only normalized once
+        path, index, is_count = self.doc_cache.compile_path(path)
+        if is_count:
+            value = self.get_xml_count(result, path, key)
         else:
-            path = "." + path
-            value = self.get_xml_by_path(result, path)
-            # value = self.get_command_params(result, path)[0]
+            value = self.get_xml_val(result, path, index, key)
         return value
 
 
@@ -1405,28 +1796,60 @@ class TaskEngine():
         else:
             path = cloud.path
 
-        conn = awspy.AWSConn(self.cloud_login_id, self.cloud_login_password, region=cloud_name, product=product,
-            endpoint=cloud.url, path=path, protocol=cloud.protocol, timeout=None, api_version=cloud.api_version)
-        result = conn.aws_query(action, params)
-        del(conn)
+        def new_conn():
+            return awspy.AWSConn(self.cloud_login_id, self.cloud_login_password, region=cloud_name, product=product,
+                endpoint=cloud.url, path=path, protocol=cloud.protocol, timeout=None, api_version=cloud.api_version)
+
+        result = self.aws_query((cloud_name, product, path), cloud, new_conn, lambda conn: conn.aws_query(action, params))
         if result:
             result = self._xml_del_namespace(result)
         return result
 
+    def get_aws_conn(self, key, cloud, new_conn):
+        """
+        An awspy connection from the cache, or a new one.
+
+        Steps that go to the same cloud and product with the same credentials share a connection
+        object (and it's endpoint setup) for the whole task.  Only the object is reused - how awspy
+        makes it's http requests is up to awspy, nothing here keeps a connection open.  The credentials are part of the key,
+        so a different cloud account never gets someone else's connection, and a connection made
+        for a cloud that's since been reloaded into cloud_conns isn't used.
+        """
+        key = key + (self.cloud_login_id, hashlib.sha1(self.cloud_login_password or "").hexdigest())
+        cached = self.aws_conns.get(key)
+        if cached and cached[0] is cloud:
+            return cached[1]
+        conn = new_conn()
+        self.aws_conns[key] = (cloud, conn)
+        return conn
+
+    def aws_query(self, key, cloud, new_conn, query):
+        """Runs query(conn) on a cached awspy connection (see get_aws_conn)."""
+        conn = self.get_aws_conn(key, cloud, new_conn)
+        start = time.time()
+        try:
+            result = query(conn)
+        finally:
+            self.add_remote_wait(start)
+        self.prof_output += len(result or "")
+        return result
+
+    def clear_aws_conns(self):
+        self.aws_conns = {}
+
 
     def aws_cmd(self, step):
 
-        cloud_name, result_var = self.get_command_params(step.command, "aws_region", "result_name")[:]
+        cloud_name, result_var = self.get_command_params(step, "aws_region", "result_name")[:]
         cloud_name = self.replace_variables(cloud_name)
 
         product, action = step.function_name.split("_")[1:]
-        nodes = catocommon.ET.fromstring(step.command)
+        nodes = step.get_plan().root
         params = []
         node_names = {}
         for node in nodes:
             if node.tag not in ["result_name", "aws_region", "instance_role"]:
                 params = self.aws_drill_in(node, node.tag, params, node_names)
-        del(nodes)
 
         num_retries = 5
         result = None
@@ -1457,6 +1880,25 @@ class TaskEngine():
 
     def process_step(self, task, step):
 
+        if not self.profiler:
+            return self._process_step(task, step)
+
+        # a step inside a loop or if is profiled by itself, and counts towards the outer step as well
+        outer = (self.prof_db, self.prof_remote, self.prof_output)
+        self.prof_db = self.prof_remote = 0.0
+        self.prof_output = 0
+        start = time.time()
+        try:
+            return self._process_step(task, step)
+        finally:
+            self.profiler.record(step.step_id, step.function_name, time.time() - start,
+                self.prof_db, self.prof_remote, self.prof_output)
+            self.prof_db += outer[0]
+            self.prof_remote += outer[1]
+            self.prof_output += outer[2]
+
+    def _process_step(self, task, step):
+
         msg = """
         **************************************************************
         **** PROCESSING STEP %s ****
@@ -1465,13 +1907,18 @@ class TaskEngine():
         self.logger.info(msg)
         self.logger.info("function name is %s" % (step.function_name))
 
+        # everything logged by the previous step goes to the database before this one starts
+        self.flush_audit()
+
+        if self.deadline and time.time() > self.deadline:
+            raise Exception("Time limit exceeded, step %s was not run." % (step.step_id))
+
         self.current_step_id = step.step_id
         f = step.function_name
 
         # if the commands module has this function defined, use it
-        cmdfuncname = "%s_cmd" % f
-        if hasattr(commands, cmdfuncname):
-            method_to_call = getattr(commands, cmdfuncname, None)
+        method_to_call = self.command_registry.builtin(f)
+        if method_to_call:
             # we pass a pointer to the TaskEngine instance itself, so the command code has access to everything!
             # also pass in the logger, since it's global and not a TE property
             return method_to_call(self, task, step)
@@ -1486,47 +1933,24 @@ class TaskEngine():
     def process_extension(self, name, step):
         """
         
-        This command will attempt to load an extension module, in the 
-        path defined by "extension", assuming the function name is the, um, function name.
+        Runs an extension command, from the module in the step's "extension" attribute.
+        A step without one uses the module found in startup() (see registry.py).
+        Either way the module is imported the first time one of it's commands is used.
         
         NOTE: we did something *similar* in startup(), but we didn't load every single module.
         There, we just loaded and ran the "augment" function, which modified the TE class instance
         with extension-wide features.
         
-        Here we're going after a specific function.
-        
         """
-        self.logger.info("[%s] Not a built-in command, checking extensions..." % (name))
-        root = catocommon.ET.fromstring(step.command)
-        extension = root.attrib.get("extension")
-        del(root)
-        if not extension:
-            msg = "Unable to get 'extension' property from extension command xml for extension %s" % (name)
-            self.logger.error(msg)
-            raise Exception(msg)
-
-        self.logger.info("loading extension [%s] ..." % (extension))
         try:
-            # mod = importlib.import_module(extension)
-            mod = __import__(extension, fromlist=[''])
-        except ImportError as ex:
+            extension = self.get_step_plan(step).root.attrib.get("extension")
+            method_to_call = self.command_registry.extension(name, extension)
+        except Exception as ex:
             self.logger.error(ex.__str__())
-            msg = "Extension module [%s] does not exist." % (extension)
-            raise Exception(msg)
-
-        # evidently the module exists... try to call the function
-        method_to_call = getattr(mod, name, None)
+            raise
 
-        if method_to_call:
-            if callable(method_to_call):
-                # we pass a pointer to the TaskEngine instance itself, so the extension code has access to everything!
-                return method_to_call(self, step)
-            else:
-                msg = "Extension found, method [%s] found, but not callable." % (name)
-                raise Exception(msg)
-        else:
-            msg = "Extension found, but method [%s] not found." % (name)
-            raise Exception(msg)
+        # we pass a pointer to the TaskEngine instance itself, so the extension code has access to everything!
+        return method_to_call(self, step)
 
     def process_codeblock(self, task, codeblock_name):
 
@@ -1547,20 +1971,32 @@ class TaskEngine():
         try:
             task = self.tasks[task_id]
         except KeyError:
-            task = classes.Task(task_id)
+            task = classes.get_task(task_id, self.db)
             self.tasks[task_id] = task
 
         self.process_codeblock(task, "MAIN")
 
     def get_task_instance(self):
+        """
+        Everything startup needs to know about the task instance, in one query:
+        the task, who submitted it, the parameters, and the cloud account and cloud.
+        """
 
         sql = """select B.task_name, A.asset_id, 
                 C.asset_name, A.submitted_by, 
                 B.task_id, B.version, A.debug_level, A.schedule_instance, A.schedule_id,
-                A.account_id, A.cloud_id, A.options
+                A.account_id, A.cloud_id, A.options, A.submitted_by_instance,
+                U.username, U.email, P.parameter_xml,
+                CA.account_id, CA.provider, CA.login_id, CA.login_password, CA.default_cloud_id,
+                CL.cloud_name
             from task_instance A 
             join task B on A.task_id = B.task_id
             left outer join asset C on A.asset_id = C.asset_id
+            left outer join users U on A.submitted_by = U.user_id
+            left outer join task_instance_parameter P on A.task_instance = P.task_instance
+            left outer join cloud_account CA on A.account_id = CA.account_id
+            left outer join clouds CL on CL.cloud_id = 
+                case when A.cloud_id is null or A.cloud_id = '' then CA.default_cloud_id else A.cloud_id end
             where  A.task_instance = %s"""
 
         row = self.select_row(sql, (self.task_instance))
@@ -1568,16 +2004,26 @@ class TaskEngine():
         if row:
             self.task_name, self.system_id, self.system_name, self.submitted_by, self.task_id, \
                 self.task_version, self.debug_level, self.plan_id, self.schedule_id, \
-                self.cloud_account, self.cloud_id, opts = row[:]
+                self.cloud_account, self.cloud_id, opts, self.submitted_by_instance = row[:13]
+            username, email, self.parameter_xml = row[13:16]
+            account_id, provider, login_id, password, default_cloud_id, cloud_name = row[16:]
 
         # options need to be json loaded
         self.options = json.loads(opts) if opts else {}
 
+        # same as gather_account_info(), get_default_cloud_for_account() and get_cloud_name() would have done
+        self.cloud_name = None
+        if account_id:
+            self.set_account_info(provider, login_id, password)
+        if self.cloud_id:
+            self.cloud_name = cloud_name or ""
+        elif self.cloud_account:
+            self.cloud_id = default_cloud_id
+            self.cloud_name = cloud_name or ""
+
         if self.submitted_by:
-            sql = """select username, email from users where user_id = %s"""
-            row = self.select_row(sql, (self.submitted_by))
-            if row:
-                self.submitted_by_user, self.submitted_by_email = row[:]
+            if username is not None:
+                self.submitted_by_user, self.submitted_by_email = username, email
 
             return 1
         else:
@@ -1589,8 +2035,14 @@ class TaskEngine():
             where ca.account_id=%s"""
         row = self.select_row(sql, (account_id))
         if row:
-            self.provider, self.cloud_login_id, password = row[:]
-            self.cloud_login_password = catocommon.cato_decrypt(password)
+            self.set_account_info(*row)
+
+    def set_account_info(self, provider, login_id, password):
+        self.provider = provider
+        self.cloud_login_id = login_id
+        self.cloud_login_password = catocommon.cato_decrypt(password)
+        # connections made with the old account are no use now
+        self.clear_aws_conns()
 
 
     def release_all(self):
@@ -1598,6 +2050,11 @@ class TaskEngine():
         self.logger.info("Releasing all connections")
         for c in self.connections.keys():
             self.drop_connection(c)
+        self.clear_aws_conns()
+        try:
+            self.datastore.close()
+        except Exception as ex:
+            self.logger.info(ex)
 
     def drop_connection(self, conn_name):
 
@@ -1728,6 +2185,7 @@ class TaskEngine():
         if not conn:
             # to the cato database
             conn = self.db
+        start = time.time()
 
         # only going to try one additional attempt
         for ii in range(2):
@@ -1747,6 +2205,9 @@ class TaskEngine():
                     # not a severed connection or we already tried once
                     raise Exception(e)
 
+        if conn is self.db:
+            self.prof_db += time.time() - start
+
         # all's well
         return result
 
@@ -1756,6 +2217,7 @@ class TaskEngine():
         if not conn:
             # to the cato database
             conn = self.db
+        start = time.time()
 
         # only going to try one additional attempt
         for ii in range(2):
@@ -1775,6 +2237,9 @@ class TaskEngine():
                     # not a severed connection or we already tried once
                     raise Exception(e)
 
+        if conn is self.db:
+            self.prof_db += time.time() - start
+
         # all's well
         return result
 
@@ -1784,6 +2249,7 @@ class TaskEngine():
         if not conn:
             # to the cato database
             conn = self.db
+        start = time.time()
 
         # only going to try one additional attempt
         for ii in range(2):
@@ -1803,6 +2269,9 @@ class TaskEngine():
                     # not a severed connection or we already tried once
                     raise Exception(e)
 
+        if conn is self.db:
+            self.prof_db += time.time() - start
+
         # all's well
         return result
 
@@ -1811,6 +2280,12 @@ class TaskEngine():
 
         self.logger.info("Updating Task Instance [%s] to [%s]" % (self.task_instance, task_status))
 
+        # the log has to be complete before anyone sees the new status
+        self.flush_audit()
+        if task_status in ("Completed", "Error", "Cancelled"):
+            # and the step profile has to be there
+            self.write_step_profile()
+
         # we don't update the completed_dt unless it's actually done.
         if task_status in ("Completed", "Error", "Cancelled"):
             sql = "update task_instance set task_status = %s, completed_dt = now() where task_instance = %s"
@@ -1838,6 +2313,10 @@ class TaskEngine():
             except AttributeError:
                 pass
 
+        # if whoever submitted us is waiting on this node, let them know right away
+        if task_status in completion.FINISHED_STATUSES:
+            completion.notify(self.submitted_by_instance, self.task_instance, task_status)
+
     def update_ti_pid(self):
 
         sql = """update task_instance set pid = %s, started_dt = now() where task_instance = %s"""
@@ -1861,14 +2340,11 @@ class TaskEngine():
 
     def extract_xml_string(self, xml, node_name):
 
-        root = catocommon.ET.fromstring(xml)
-        node_name = "./" + node_name
-        r = root.findall(node_name)
+        r = self.get_step_plan(xml).elements("./" + node_name)
         if r:
             z = catocommon.ET.tostring(r[0])
         else:
             z = None
-        del(root)
         return z
 
     def merge_parameters(self, default_xml, override_xml):
@@ -1981,11 +2457,9 @@ class TaskEngine():
 
     def get_task_params(self):
 
-        sql = "select parameter_xml from task_instance_parameter where task_instance = %s"
-        row = self.select_row(sql, (self.task_instance))
-        if row:
-            self.parameter_xml = row[0]
-            self.parse_input_params(row[0])
+        # the parameter xml was read along with the task instance, see get_task_instance()
+        if self.parameter_xml:
+            self.parse_input_params(self.parameter_xml)
 
 
     def set_debug(self, dl):
@@ -2013,15 +2487,15 @@ class TaskEngine():
             ... 
         """
         try:
-            self.db = catodb.Db()
-            self.db.connect_db(server=catoconfig.CONFIG["server"], port=catoconfig.CONFIG["port"],
-                user=catoconfig.CONFIG["user"],
-                password=catoconfig.CONFIG["password"], database=catoconfig.CONFIG["database"])
+            self.db = self.new_db_conn()
             self.config = catoconfig.CONFIG
+            self.startup_timer.mark("connect")
 
             self.update_ti_pid()
+            self.start_audit_writer()
             self.get_task_instance()
             self.set_debug(self.debug_level)
+            self.startup_timer.mark("task instance")
 
             self.logger.info("""
     #######################################
@@ -2033,16 +2507,7 @@ class TaskEngine():
                 (self.task_name, self.task_version, self.debug_level))
 
             self.get_task_params()
-
-            self.cloud_name = None
-            if self.cloud_account:
-                self.gather_account_info(self.cloud_account)
-            if self.cloud_id:
-                self.cloud_name = self.get_cloud_name(self.cloud_id)
-            elif self.cloud_account:
-                self.cloud_id = self.get_default_cloud_for_account(self.cloud_account)
-                self.cloud_name = self.get_cloud_name(self.cloud_id)
-
+            self.startup_timer.mark("parameters")
 
             self.logger.info("Cloud Account: %s, Cloud Name: %s " % (self.cloud_account, self.cloud_name))
 
@@ -2057,6 +2522,11 @@ class TaskEngine():
                 self.logger.info("Appending extension [%s] path [%s]" % (exname, expath))
                 sys.path.append(expath)
 
+            # and find all the extension commands, so no step has to go looking for one
+            self.command_registry = registry.CommandRegistry(catoconfig.CONFIG["extensions"].values())
+            self.logger.info("%d built-in commands, %d extension commands." %
+                (len(self.command_registry.builtins), len(self.command_registry.extensions)))
+
             # 2) check if any extensions are meant to augment the TE
             augs = self.options.get("Augments", [])
             for exname in augs:
@@ -2067,9 +2537,13 @@ class TaskEngine():
                             if f == "augment_te.py":
                                 self.augment("%s.augment_te" % os.path.basename(root))
 
+            self.startup_timer.mark("extensions")
+
             # NOTE: we do NOT update the status to Processing until any extensions are loaded.
             # why?  Because update_status also calls into extensions own status updater functions
             self.update_status("Processing")
+            self.startup_timer.mark("status")
+            self.logger.info(self.startup_timer.summary())
 
             # print all the attributes of the Task Engine if the debug level is high enough
             # just to keep things safe here, we are ...
@@ -2078,10 +2552,11 @@ class TaskEngine():
             x = self.__dict__
             out = []
             try:
-                for k, v in x.iteritems():
-                    out.append("%s -> %s" % (k, v))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    for k, v in x.iteritems():
+                        out.append("%s -> %s" % (k, v))
 
-                self.logger.debug("TASK ENGINE CONFIGURATION:\n%s" % ("\n".join(out)))
+                    self.logger.debug("TASK ENGINE CONFIGURATION:\n%s", "\n".join(out))
             except Exception as ex:
                 self.logger.error("An exception occured resolving the _DEBUG global variable.\n%s" % (ex.__str__()))
 
@@ -2137,6 +2612,9 @@ class TaskEngine():
 
 
     def end(self):
+        self.close_completion_listener()
+        self.release_spill()
+        self.stop_audit_writer()
         self.db.close()
 
 
@@ -2146,6 +2624,26 @@ class TaskEngine():
             self.insert_audit("result_summary", msg, "")
 
 
+    def write_step_profile(self):
+        """Writes the step profile, once (see update_status).  A failure here is only logged."""
+        if not self.profiler or self.profile_written:
+            return
+        self.profile_written = True
+        try:
+            self.profiler.write(self.exec_db, self.task_instance)
+        except Exception as ex:
+            self.logger.error("Unable to write the step profile.\n%s" % (ex))
+
+    def log_runtime_memory(self):
+        """At debug level, logs how much memory each runtime variable is using, biggest first."""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        try:
+            lines = ["%-40s %8d values %12d bytes" % (name, count, size) for name, count, size in self.rt.memory_report()]
+            self.logger.debug("Runtime variable memory:\n%s", "\n".join(lines))
+        except Exception as ex:
+            self.logger.error("Unable to report runtime variable memory.\n%s" % (ex))
+
     def run(self):
         try:
             self.process_task(self.task_id)
@@ -2168,3 +2666,13 @@ class TaskEngine():
                 self.create_one_like_me()
 
             raise Exception(msg)
+        finally:
+            self.log_runtime_memory()
+            # (if it wasn't already written by update_status)
+            self.write_step_profile()
+            # writes whatever is still buffered, even on an error or exit()
+            self.stop_audit_writer()
+            self.close_completion_listener()
+            self.release_spill()
+            # anything the log is holding back, to check for a secret or on the writer queue
+            catolog.flush()
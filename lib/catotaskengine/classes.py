@@ -14,8 +14,78 @@
 # limitations under the License.
 #########################################################################
 
+import threading
 from catocommon import catocommon
 
+class StepPlan:
+    """
+    The compiled form of a Step's function xml.
+
+    The xml is parsed exactly once, and every lookup a command makes against it
+    (arguments, node lists, nested action steps) is remembered.  A step inside
+    a loop will be asked for the same things on every pass, so after the first
+    pass it's just dictionary lookups.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._args = {}
+        self._node_lists = {}
+        self._elements = {}
+        self._sub_steps = {}
+
+    def arg(self, name):
+        """the text value of a single property, empty string if it doesn't exist"""
+        try:
+            return self._args[name]
+        except KeyError:
+            v = self.root.findtext("./" + name, "")
+            self._args[name] = v
+            return v
+
+    def args(self, *names):
+        return [self.arg(n) for n in names]
+
+    def node_list(self, node_name, *args):
+        """for each node found at node_name, a list of the text values of args"""
+        key = (node_name,) + args
+        try:
+            rows = self._node_lists[key]
+        except KeyError:
+            rows = []
+            for node in self.root.findall("./" + node_name):
+                rows.append([node.findtext("./" + a, "") for a in args])
+            self._node_lists[key] = rows
+
+        # callers are free to mess with what we give them, so hand back copies
+        return [row[:] for row in rows]
+
+    def elements(self, path):
+        """all the elements found at path, in document order"""
+        try:
+            return self._elements[path]
+        except KeyError:
+            nodes = self.root.findall(path)
+            self._elements[path] = nodes
+            return nodes
+
+    def sub_step(self, step_id, path, parent=None):
+        """
+        Nested actions (if, while, loop, exists) contain a complete function.
+        Returns the first function found at path (relative to parent if provided) as a Step,
+        or None if there isn't one.  The Step is built once and reused.
+        """
+        key = (id(parent), path)
+        try:
+            return self._sub_steps[key]
+        except KeyError:
+            pass
+
+        node = (parent if parent is not None else self.root).find(path)
+        sub_step = Step.from_element(step_id, node) if node is not None else None
+        self._sub_steps[key] = sub_step
+        return sub_step
+
+
 class Step:
     def __init__(self, step_id, function_name, function_xml, parse_method, row_delimiter, col_delimiter):
         self.step_id = step_id
@@ -24,14 +94,30 @@ class Step:
         self.parse_method = parse_method
         self.row_delimiter = row_delimiter
         self.col_delimiter = col_delimiter
+        self.plan = None
+
+    @staticmethod
+    def from_element(step_id, root):
+        """builds a Step from an already parsed function element, no reparsing required"""
+        step = Step(step_id, root.attrib.get("name"), catocommon.ET.tostring(root), root.attrib.get("parse_method"),
+                    root.attrib.get("row_delimiter"), root.attrib.get("col_delimiter"))
+        step.plan = StepPlan(root)
+        return step
+
+    def get_plan(self):
+        """the compiled function xml, parsed on first use"""
+        if self.plan is None:
+            self.plan = StepPlan(catocommon.ET.fromstring(self.command))
+        return self.plan
 
 class Codeblock: 
 
-    def __init__(self, task_id, codeblock_name):
+    def __init__(self, task_id, codeblock_name, load=True):
         self.task_id = task_id
         self.codeblock_name = codeblock_name
         self.step_list = []
-        self.get_steps()
+        if load:
+            self.get_steps()
 
     def add_step(self, step):
 
@@ -58,23 +144,102 @@ class Codeblock:
 
 class Task:
 
-    def __init__(self, task_id):
-
+    def __init__(self, task_id, db=None):
+        """
+        Loads every codeblock and step of a task.
+        
+        Pass in a db connection to use, otherwise a new one is opened (and closed) just for this.
+        """
         self.task_id = task_id
         self.codeblocks = {}
-        self.get_codeblocks()
+        self.stamp = None
 
-    def get_codeblocks(self): 
+        if db:
+            self.get_codeblocks(db)
+        else:
+            db = catocommon.new_conn()
+            try:
+                self.get_codeblocks(db)
+            finally:
+                db.close()
 
-        sql = """select distinct upper(codeblock_name) from task_codeblock
-                where task_id = %s"""
-        db = catocommon.new_conn()
+    def get_codeblocks(self, db): 
+        """
+        All the codeblocks and steps, in one query.
+        
+        Codeblocks without any steps still come back, from the left join.
+        """
+        self.stamp = get_task_stamp(self.task_id, db)
+
+        sql = """select upper(cb.codeblock_name), lower(s.step_id), s.function_name, s.function_xml
+            from task_codeblock cb
+            left join task_step s on s.task_id = cb.task_id
+                and s.codeblock_name = cb.codeblock_name
+                and s.commented = 0
+            where cb.task_id = %s
+            order by cb.codeblock_name, s.step_order asc"""
         rows = db.select_all(sql, (self.task_id))
-        db.close()
         if rows:
             for row in rows:
-                cb_name = row[0]
-                self.codeblocks[cb_name] = Codeblock(self.task_id, cb_name)
+                cb_name, step_id, function_name, function_xml = row[:]
+                cb = self.codeblocks.get(cb_name)
+                if not cb:
+                    cb = Codeblock(self.task_id, cb_name, load=False)
+                    self.codeblocks[cb_name] = cb
+
+                if step_id:
+                    cb.add_step(_load_step(step_id, function_name, function_xml))
+
+
+def _load_step(step_id, function_name, function_xml):
+    """
+    A Step from a task_step row.  The xml is parsed here instead of with ExtractValue in the query,
+    and the parsed function becomes the step's plan.
+    """
+    try:
+        root = catocommon.ET.fromstring(function_xml)
+    except Exception:
+        # leave it alone, it will fail if and when the step actually runs
+        return Step(step_id, function_name, function_xml, "", "", "")
+
+    step = Step(step_id, function_name, function_xml, root.attrib.get("parse_method", ""),
+                root.attrib.get("row_delimiter", ""), root.attrib.get("col_delimiter", ""))
+    step.plan = StepPlan(root)
+    return step
+
+
+def get_task_stamp(task_id, db):
+    """
+    There's no modified date on a task, so this is a checksum of everything that goes into the loaded definition.
+    It's all computed in the database, so it's cheap compared to actually loading the task.
+    """
+    sql = """select
+        (select count(*) from task_step where task_id = %s),
+        (select sum(crc32(concat_ws('|', codeblock_name, step_id, step_order, commented, function_name, function_xml)))
+            from task_step where task_id = %s),
+        (select group_concat(codeblock_name order by codeblock_name separator '|')
+            from task_codeblock where task_id = %s)"""
+    row = db.select_row(sql, (task_id, task_id, task_id))
+    return tuple(row) if row else None
+
+
+# loaded task definitions, kept for the life of the process.
+# a pooled Task Engine worker (see worker.py) runs many tasks, usually the same few over and over.
+# task_id: Task
+_task_cache = {}
+
+def get_task(task_id, db):
+    """
+    Returns the loaded Task, from the cache if it hasn't changed since it was loaded.
+    """
+    task = _task_cache.get(task_id)
+    if task:
+        if get_task_stamp(task_id, db) == task.stamp:
+            return task
+
+    task = Task(task_id, db)
+    _task_cache[task_id] = task
+    return task
 
 
 class System:
@@ -131,6 +296,49 @@ class TaskHandle:
         self.is_default = None
 
 
+class Datastore:
+    """
+    The datastore (mongodb) connection for the datastore commands, made the first time one needs it
+    and kept until the task releases it's connections.  pymongo pools it's own sockets and is
+    thread safe, so parallel branches share it too.
+
+    Which collections exist is cached: a name we've seen is trusted, a name we haven't
+    gets the list from the server again (someone else may have just created it).
+    """
+    def __init__(self):
+        self._db = None
+        self._collections = set()
+        self.lock = threading.Lock()
+
+    def db(self):
+        with self.lock:
+            if self._db is None:
+                self._db = catocommon.new_mongo_conn()
+            return self._db
+
+    def collection_exists(self, name):
+        if name in self._collections:
+            return True
+        names = set(self.db().collection_names())
+        with self.lock:
+            self._collections = names
+        return name in names
+
+    def created(self, name):
+        self._collections.add(name)
+
+    def dropped(self, name):
+        self._collections.discard(name)
+
+    def close(self):
+        with self.lock:
+            db = self._db
+            self._db = None
+            self._collections = set()
+        if db is not None:
+            catocommon.mongo_disconnect(db)
+
+
 class Cloud:
     def __init__(self, cloud_name):
         self.cloud_id = None
@@ -23,17 +23,25 @@ import hashlib
 import base64
 import hmac
 import re
-from bson import json_util
+import operator
+from xml.sax import saxutils
 from datetime import datetime, timedelta
-import dateutil.parser as parser
-from bson.objectid import ObjectId
-from pymongo.errors import InvalidName
 from catoconfig import catoconfig
 
 from catocommon import catocommon
+from catoruntimes import runtimes
 from . import classes
+from . import spill
+from . import templates
+from . import parallel
+from . import httpclient
 
 DEPLOYMENT_COLLECTIONS = ["deployments", "services", "serviceinstances"]
+
+# the loop command tests, when a loop is a plain numeric count these are used instead of eval
+LOOP_OPERATORS = {"==": operator.eq, "!=": operator.ne, "<=": operator.le, "<": operator.lt, ">=": operator.ge, ">": operator.gt}
+# a number that means exactly the same thing to int()/float() as it does to eval() (no octal!)
+LOOP_NUMBER = re.compile(r"^-?(0|[1-9][0-9]*)(\.[0-9]+)?$")
 RESERVED_COLLECTIONS = ["default", "system.indexes"]
 
 def _eval(expr):
@@ -46,10 +54,10 @@ def _eval(expr):
         try:
             # we expose only specific objects in our environment and pass it as 'globals' to eval.
             environment = {
-                           'parsedate': parser.parse,
+                           'parsedate': runtimes.parsedate,
                            'datetime': datetime,
                            'timedelta': timedelta,
-                           'ObjectId': ObjectId
+                           'ObjectId': runtimes.object_id
                            }
             s = eval(expr, environment, {})
         except Exception as ex:
@@ -60,7 +68,7 @@ def _eval(expr):
 
 def get_asset_cmd(self, task, step):
 
-    asset, address_out, db_out, port_out, conn_string_out, user_out, pass_out = self.get_command_params(step.command,
+    asset, address_out, db_out, port_out, conn_string_out, user_out, pass_out = self.get_command_params(step,
         "asset", "address_out", "db_out", "port_out", "conn_string_out", "user_out", "pass_out")[:]
     asset = self.replace_variables(asset)
     address_out = self.replace_variables(address_out)
@@ -113,7 +121,7 @@ def get_asset_cmd(self, task, step):
 
 def datastore_drop_collection_cmd(self, task, step):
 
-    collection = self.get_command_params(step.command, "collection")[0]
+    collection = self.get_command_params(step, "collection")[0]
     collection = self.replace_variables(collection)
 
     if len(collection) == 0:
@@ -123,20 +131,20 @@ def datastore_drop_collection_cmd(self, task, step):
         msg = "Datastore Drop Collection error: %s is a reserved collection name" % (collection)
         raise Exception(msg)
 
-    db = catocommon.new_mongo_conn()
-    if collection not in db.collection_names():
+    db = self.datastore.db()
+    if not self.datastore.collection_exists(collection):
         msg = "Datastore Drop Collection warning: a collection named %s does not exist, continuing" % (collection)
     else:
         db.drop_collection(collection)
+        self.datastore.dropped(collection)
         msg = "Collection %s dropped" % (collection)
 
     self.insert_audit(step.function_name, msg, "")
-    catocommon.mongo_disconnect(db)
 
 
 def datastore_create_collection_cmd(self, task, step):
 
-    collection = self.get_command_params(step.command, "collection")[0]
+    collection = self.get_command_params(step, "collection")[0]
     collection = self.replace_variables(collection)
 
     if len(collection) == 0:
@@ -146,22 +154,22 @@ def datastore_create_collection_cmd(self, task, step):
         msg = "Datastore Create Collection error: %s is a reserved collection name" % (collection)
         raise Exception(msg)
 
-    db = catocommon.new_mongo_conn()
-    if collection in db.collection_names():
+    db = self.datastore.db()
+    if self.datastore.collection_exists(collection):
         msg = "Datastore Create Collection warning: a collection named %s already exists, continuing ..." % (collection)
         self.insert_audit(step.function_name, msg, "")
     else:
         db.create_collection(collection)
+        self.datastore.created(collection)
         msg = "Collection %s created" % (collection)
         self.insert_audit(step.function_name, msg, "")
 
-    catocommon.mongo_disconnect(db)
-
 
 def datastore_insert_cmd(self, task, step):
+    from pymongo.errors import InvalidName
 
-    collection, object_id = self.get_command_params(step.command, "collection", "object_id")[:]
-    pairs = self.get_node_list(step.command, "pairs/pair", "name", "value", "json_value")
+    collection, object_id = self.get_command_params(step, "collection", "object_id")[:]
+    pairs = self.get_node_list(step, "pairs/pair", "name", "value", "json_value")
     collection = self.replace_variables(collection)
     docvar = self.replace_variables(object_id)
 
@@ -172,7 +180,7 @@ def datastore_insert_cmd(self, task, step):
         msg = "Datastore Insert Collection error: %s is a reserved collection name" % (collection)
         raise Exception(msg)
 
-    db = catocommon.new_mongo_conn()
+    db = self.datastore.db()
     try:
         coll = db[collection]
     except InvalidName:
@@ -193,15 +201,15 @@ def datastore_insert_cmd(self, task, step):
 
     self.logger.debug(document)
     doc_id = coll.insert(document)
+    self.datastore.created(collection)
     msg = "Collection %s, Insert %s, Document Id %s" % (collection, str(document), doc_id)
     self.rt.set(docvar, doc_id)
     self.insert_audit(step.function_name, msg, "")
 
-    catocommon.mongo_disconnect(db)
 
 def datastore_delete_cmd(self, task, step):
 
-    collection, query_string = self.get_command_params(step.command, "collection", "query")[:]
+    collection, query_string = self.get_command_params(step, "collection", "query")[:]
     collection = self.replace_variables(collection)
     query_string = self.replace_variables(query_string)
 
@@ -217,8 +225,8 @@ def datastore_delete_cmd(self, task, step):
         msg = "Datastore Delete Collection error: %s is a reserved collection name" % (collection)
         raise Exception(msg)
 
-    db = catocommon.new_mongo_conn()
-    if collection in db.collection_names():
+    db = self.datastore.db()
+    if self.datastore.collection_exists(collection):
         coll = db[collection]
     else:
         msg = "Datastore Delete error: a collection named %s does not exist" % (collection)
@@ -226,14 +234,13 @@ def datastore_delete_cmd(self, task, step):
 
     msg = "Collection %s, Delete %s" % (collection, query_dict)
     coll.remove(query_dict)
-    catocommon.mongo_disconnect(db)
     self.insert_audit(step.function_name, msg, "")
 
 
 def datastore_create_index_cmd(self, task, step):
 
-    collection, unique = self.get_command_params(step.command, "collection", "unique")[:]
-    columns = self.get_node_list(step.command, "columns/column", "name")
+    collection, unique = self.get_command_params(step, "collection", "unique")[:]
+    columns = self.get_node_list(step, "columns/column", "name")
     collection = self.replace_variables(collection)
 
     if len(collection) == 0:
@@ -247,11 +254,12 @@ def datastore_create_index_cmd(self, task, step):
         msg = "Datastore Create Index error: %s is a reserved collection name" % (collection)
         raise Exception(msg)
 
-    db = catocommon.new_mongo_conn()
-    if collection in db.collection_names():
+    db = self.datastore.db()
+    if self.datastore.collection_exists(collection):
         coll = db[collection]
     else:
         db.create_collection(collection)
+        self.datastore.created(collection)
         coll = db[collection]
         msg = "Collection %s created" % (collection)
         self.insert_audit(step.function_name, msg, "")
@@ -266,15 +274,14 @@ def datastore_create_index_cmd(self, task, step):
     else:
         unique = False
     coll.create_index(index, unique=unique)
-    catocommon.mongo_disconnect(db)
     self.insert_audit(step.function_name, msg, "")
 
 
 def datastore_find_and_modify_cmd(self, task, step):
 
-    collection, query_string, upsert, remove, sort, limit = self.get_command_params(step.command, "collection", "query", "upsert", "remove", "sort", "limit")[:]
-    pairs = self.get_node_list(step.command, "columns/column", "name", "value", "json_value")
-    outpairs = self.get_node_list(step.command, "outcolumns/column", "name", "value")
+    collection, query_string, upsert, remove, sort, limit = self.get_command_params(step, "collection", "query", "upsert", "remove", "sort", "limit")[:]
+    pairs = self.get_node_list(step, "columns/column", "name", "value", "json_value")
+    outpairs = self.get_node_list(step, "outcolumns/column", "name", "value")
     collection = self.replace_variables(collection)
     query_string = self.replace_variables(query_string)
     sort = self.replace_variables(sort)
@@ -292,8 +299,8 @@ def datastore_find_and_modify_cmd(self, task, step):
         msg = "Datastore Find and Modify error: %s is a reserved collection name" % (collection)
         raise Exception(msg)
 
-    db = catocommon.new_mongo_conn()
-    if collection in db.collection_names():
+    db = self.datastore.db()
+    if self.datastore.collection_exists(collection):
         coll = db[collection]
     else:
         msg = "Datastore Find and Modify error: a collection named %s does not exist" % (collection)
@@ -345,6 +352,7 @@ def datastore_find_and_modify_cmd(self, task, step):
         cols = None
     msg = "Collection %s, Find and Modify %s, Set %s, Columns %s, Upsert %s, Remove %s" % (collection, query_dict, json.dumps(_vars), cols.keys(), upsert, remove)
     row = coll.find_and_modify(query_dict, update=update_json, fields=cols, upsert=upsert, remove=remove, limit=limit, sort=sort)
+    from bson import json_util
     msg = "%s\n%s" % (msg, json.dumps(row, default=json_util.default))
     for v in _outvars:
         self.rt.clear(v[1])
@@ -361,13 +369,12 @@ def datastore_find_and_modify_cmd(self, task, step):
             # print "name %s, value %s" % (name, value)
             self.rt.set(variable, value)
 
-    catocommon.mongo_disconnect(db)
     self.insert_audit(step.function_name, msg, "")
 
 def datastore_update_cmd(self, task, step):
 
-    collection, query_string, upsert, addtoset = self.get_command_params(step.command, "collection", "query", "upsert", "addtoset")[:]
-    pairs = self.get_node_list(step.command, "columns/column", "name", "value", "json_value")
+    collection, query_string, upsert, addtoset = self.get_command_params(step, "collection", "query", "upsert", "addtoset")[:]
+    pairs = self.get_node_list(step, "columns/column", "name", "value", "json_value")
     collection = self.replace_variables(collection)
     query_string = self.replace_variables(query_string)
 
@@ -383,8 +390,8 @@ def datastore_update_cmd(self, task, step):
         msg = "Datastore Update error: %s is a reserved collection name" % (collection)
         raise Exception(msg)
 
-    db = catocommon.new_mongo_conn()
-    if collection in db.collection_names():
+    db = self.datastore.db()
+    if self.datastore.collection_exists(collection):
         coll = db[collection]
     else:
         msg = "Datastore Update error: a collection named %s does not exist" % (collection)
@@ -412,18 +419,25 @@ def datastore_update_cmd(self, task, step):
 
     msg = "Collection %s, Update %s, Set %s, Upsert %s" % (collection, query_dict, json.dumps(_vars), upsert)
     coll.update(query_dict, {modifier: _vars}, multi=True, upsert=upsert)
-    catocommon.mongo_disconnect(db)
     self.insert_audit(step.function_name, msg, "")
 
 
 def datastore_query_cmd(self, task, step):
+    """
+    The cursor is read a batch at a time, straight into the column variables, so the
+    whole result set is only in memory if a Result Variable asks for it.
+    """
 
-    collection, query_string, sort, limit, result_var = self.get_command_params(step.command, "collection", "query", "sort", "limit", "result_var")[:]
-    pairs = self.get_node_list(step.command, "columns/column", "name", "variable")
+    collection, query_string, sort, limit, result_var, batch_size, projection = self.get_command_params(step,
+        "collection", "query", "sort", "limit", "result_var", "batch_size", "projection")[:]
+    pairs = self.get_node_list(step, "columns/column", "name", "variable")
     collection = self.replace_variables(collection)
     query_string = self.replace_variables(query_string)
     limit = self.replace_variables(limit)
     sort = self.replace_variables(sort)
+    result_var = self.replace_variables(result_var)
+    batch_size = self.replace_variables(batch_size)
+    projection = self.replace_variables(projection)
 
     # validate and prepare the query
     query_dict = _eval(query_string)
@@ -433,8 +447,9 @@ def datastore_query_cmd(self, task, step):
     if len(collection) == 0:
         raise Exception("Datastore Query requires a collection name")
 
-    db = catocommon.new_mongo_conn()
-    if collection in db.collection_names():
+    from bson import json_util
+    db = self.datastore.db()
+    if self.datastore.collection_exists(collection):
         coll = db[collection]
     else:
         msg = "Datastore Query error: a collection named %s does not exist" % (collection)
@@ -458,22 +473,40 @@ def datastore_query_cmd(self, task, step):
                 _vars.append([name, variable])
                 self.rt.clear(variable)
             cols[name] = True
+
     msg = "Collection %s, Query %s, Columns %s" % (collection, query_dict, cols.keys())
     if "_id" not in cols.keys():
         cols["_id"] = False
+
+    # an explicit projection replaces the one the columns make
+    if len(projection):
+        cols = _eval(projection)
+        if not isinstance(cols, dict):
+            raise Exception("Datastore Query error: Projection must be a document, like {'name': 1, 'address': 1}.")
+        msg = "Collection %s, Query %s, Projection %s" % (collection, query_dict, cols)
+
     cur = coll.find(query_dict, fields=cols, sort=sort, limit=limit)
-    if cur:
-        rows = list(cur)
-        
-    # if a result var was provided, shove the whole result in there
-    if result_var:
-        self.rt.set(result_var, rows)
-        
-    # spin through any explicitly defined columns
+    if len(batch_size):
+        cur.batch_size(int(batch_size))
+
+    # the log gets the rows, but only so much of them
+    log_limit = int(catoconfig.CONFIG["te_spill_log_limit"])
+    log_size = len(msg)
+    log_rows = [msg]
+
+    rows = [] if result_var else None
     index = 0
-    for row in rows:
+    for row in cur:
         index += 1
-        msg = "%s\n%s" % (msg, json.dumps(row, default=json_util.default))
+        if rows is not None:
+            rows.append(row)
+
+        if log_size < log_limit:
+            line = json.dumps(row, default=json_util.default)
+            log_size += len(line)
+            log_rows.append(line)
+
+        # spin through any explicitly defined columns
         for v in _vars:
             name = v[0]
             variable = v[1]
@@ -483,12 +516,163 @@ def datastore_query_cmd(self, task, step):
                 value = ""
             except Exception as e:
                 raise Exception(e)
-            # print "name %s, value %s" % (name, value)
             self.rt.set(variable, value, index)
 
-    catocommon.mongo_disconnect(db)
+    # if a result var was provided, shove the whole result in there
+    if result_var:
+        self.rt.set(result_var, rows)
+
+    if index > len(log_rows) - 1:
+        log_rows.append("... %d rows in all." % (index))
+    self.insert_audit(step.function_name, "\n".join(log_rows), "")
+
+
+def _datastore_documents(self, source):
+    """the documents for datastore_insert_many, from an array variable or a $ expression"""
+    source = source.strip()
+    if source.startswith("$"):
+        items = self.rt.eval_get(source[1:])
+        if not isinstance(items, (list, tuple)):
+            items = [items]
+    else:
+        items = self.rt.get_all(source)
+
+    docs = []
+    for ii, item in enumerate(items):
+        if isinstance(item, basestring):
+            try:
+                item = _eval(item)
+            except Exception as ex:
+                raise Exception("Datastore Insert Many error: item %d is not a valid document.\n%s" % (ii + 1, ex))
+        if not isinstance(item, dict):
+            raise Exception("Datastore Insert Many error: item %d is not a document." % (ii + 1))
+        # a copy, the _id we add doesn't belong in the variable it came from
+        docs.append(dict(item))
+    return docs
+
+
+def _insert_batch(coll, batch, ordered, new_ids):
+    """
+    Inserts a batch, returns {position in batch: error} for the documents that failed.
+
+    The _ids are already set, so when the insert fails we ask the server which of them are there.
+    new_ids are the ones we made up, if one of those is there it's ours.  An _id that came with the
+    document could have been there already, so those are looked for before the insert.
+
+    Ordered, the server stopped at the first one missing and nothing after it was tried.  Unordered,
+    or when a document couldn't even be encoded (a key with a . or $ in it, say), each one that
+    didn't make it is tried again by itself, to find out what it's problem is.
+    """
+    from pymongo.errors import OperationFailure, AutoReconnect
+    from bson.errors import BSONError
+
+    ids = [d["_id"] for d in batch]
+    given = [_id for _id in ids if _id not in new_ids]
+    existed = set(d["_id"] for d in coll.find({"_id": {"$in": given}}, {"_id": 1})) if given else set()
+
+    # (w=1, the connection doesn't wait to hear about errors by default)
+    try:
+        coll.insert(batch, continue_on_error=not ordered, w=1)
+        return {}
+    except (OperationFailure, AutoReconnect) as ex:
+        error = str(ex)
+        encoded = True
+    except BSONError as ex:
+        # client side, some of the batch may or may not have been sent
+        error = str(ex)
+        encoded = False
+
+    there = set(d["_id"] for d in coll.find({"_id": {"$in": ids}}, {"_id": 1})) - existed
+    missing = [ii for ii, _id in enumerate(ids) if _id not in there]
+
+    errors = {}
+    if ordered and encoded:
+        if missing:
+            errors[missing[0]] = error
+            for ii in missing[1:]:
+                errors[ii] = "not inserted, an earlier document failed"
+        return errors
+
+    for n, ii in enumerate(missing):
+        try:
+            coll.insert(batch[ii], w=1)
+        except (OperationFailure, AutoReconnect, BSONError) as ex:
+            errors[ii] = str(ex)
+            if ordered:
+                for jj in missing[n + 1:]:
+                    errors[jj] = "not inserted, an earlier document failed"
+                break
+    return errors
+
+
+def datastore_insert_many_cmd(self, task, step):
+    """
+    Inserts a whole array of documents, batch_size at a time.
+    Ordered stops at the first failure, unordered inserts all it can.  Either way,
+    every document that wasn't inserted is reported with why.
+    """
+
+    collection, source, ordered, batch_size, result_var, error_var, on_error = self.get_command_params(step,
+        "collection", "documents", "ordered", "batch_size", "result_var", "error_var", "on_error")[:]
+    collection = self.replace_variables(collection)
+    source = self.replace_variables(source)
+    ordered = self.replace_variables(ordered) != "false"
+    batch_size = self.replace_variables(batch_size)
+    try:
+        batch_size = int(batch_size) if len(batch_size) else 1000
+    except ValueError:
+        batch_size = 0
+    if batch_size <= 0:
+        raise Exception("Datastore Insert Many requires Batch Size as a number greater than zero.")
+    result_var = self.replace_variables(result_var)
+    error_var = self.replace_variables(error_var)
+    on_error = self.replace_variables(on_error)
+
+    if len(collection) == 0:
+        raise Exception("Datastore Insert Many requires a collection name")
+
+    if collection in RESERVED_COLLECTIONS:
+        msg = "Datastore Insert Many error: %s is a reserved collection name" % (collection)
+        raise Exception(msg)
+
+    from bson.objectid import ObjectId
+    docs = _datastore_documents(self, source)
+    new_ids = set()
+    for d in docs:
+        if "_id" not in d:
+            d["_id"] = ObjectId()
+            new_ids.add(d["_id"])
+
+    coll = self.datastore.db()[collection]
+    errors = {}
+    for start in range(0, len(docs), batch_size):
+        batch_errors = _insert_batch(coll, docs[start:start + batch_size], ordered, new_ids)
+        for ii, err in batch_errors.iteritems():
+            errors[start + ii] = err
+        if ordered and batch_errors:
+            # nothing after this batch was tried either
+            for ii in range(start + batch_size, len(docs)):
+                errors[ii] = "not inserted, an earlier document failed"
+            break
+    if docs:
+        self.datastore.created(collection)
+
+    if result_var:
+        self.rt.set_all(result_var, ["" if ii in errors else str(d["_id"]) for ii, d in enumerate(docs)])
+    if error_var:
+        self.rt.set_all(error_var, ["%d: %s" % (ii + 1, errors[ii]) for ii in sorted(errors)])
+
+    msg = "Collection %s, Inserted %d of %d documents (%s)." % (collection, len(docs) - len(errors), len(docs),
+        "ordered" if ordered else "unordered")
+    if errors:
+        msg += "\n" + "\n".join("Document %d: %s" % (ii + 1, errors[ii]) for ii in sorted(errors)[:20])
+        if len(errors) > 20:
+            msg += "\n... %d more." % (len(errors) - 20)
     self.insert_audit(step.function_name, msg, "")
 
+    if errors and on_error != "continue":
+        raise Exception("Datastore Insert Many - %d of %d documents were not inserted." % (len(errors), len(docs)))
+
 
 
 def codeblock_cmd(self, task, step):
@@ -496,11 +680,64 @@ def codeblock_cmd(self, task, step):
     Run a codeblock in this task. Variables are all global.
     """
 
-    name = self.get_command_params(step.command, "codeblock")[0]
+    name = self.get_command_params(step, "codeblock")[0]
     name = self.replace_variables(name)
     self.process_codeblock(task, name.upper())
 
 
+def _max_concurrent(self, value):
+    value = self.replace_variables(value) or catoconfig.CONFIG["te_parallel_max_concurrent"]
+    try:
+        return int(value)
+    except ValueError:
+        raise Exception("Max Concurrent must be an integer value... found [%s]." % (value))
+
+
+def parallel_cmd(self, task, step):
+    """
+    Runs each branch (a Codeblock, or an embedded action) at the same time, see parallel.py.
+    """
+
+    scope, max_concurrent, on_error, result_var = self.get_command_params(step,
+        "scope", "max_concurrent", "on_error", "result_var")[:]
+    plan = step.get_plan()
+
+    branches = []
+    for node in plan.elements("./branches/branch"):
+        name = self.replace_variables(node.findtext("codeblock", "")).upper()
+        sub_step = plan.sub_step(step.step_id, "./action/function", node)
+        if not name and not sub_step:
+            continue
+        if name and not task.codeblocks.get(name):
+            raise Exception("Parallel Step references a non-existant Codeblock [%s]." % (name))
+        branches.append(parallel.Branch(len(branches) + 1, name, None if name else sub_step))
+
+    if not branches:
+        raise Exception("Parallel command requires at least one Branch.")
+
+    max_concurrent = _max_concurrent(self, max_concurrent)
+
+    merge = scope == "merged"
+    msg = "Running %d branches, %d at a time, with %s variables." % (len(branches), max_concurrent, "merged" if merge else "isolated")
+    self.insert_audit(step.function_name, msg, "")
+
+    start = time.time()
+    parallel.run_branches(self, task, branches, max_concurrent, merge)
+
+    errors = [b for b in branches if b.status != "Completed"]
+    self.insert_audit(step.function_name, parallel.summarize(branches, time.time() - start), "")
+
+    result_var = self.replace_variables(result_var)
+    if result_var:
+        self.rt.clear(result_var)
+        for b in branches:
+            self.rt.set(result_var, json.dumps(b.result()), b.index)
+
+    if errors and on_error != "continue":
+        raise Exception("%d of %d parallel branches failed.\n%s" % (len(errors), len(branches),
+            "\n".join("%s: %s" % (b.label, b.error) for b in errors)))
+
+
 def _eval_test_expression(self, test):
     """
     The IF, EXISTS and WHILE command all make use of 'eval' to test expressions.
@@ -508,85 +745,79 @@ def _eval_test_expression(self, test):
     To provide some explicit advanced features, we'll parse the test string and open up
         a few things.
     """
-    self.logger.debug("Testing expression: [%s]..." % (test))
+    self.logger.debug("Testing expression: [%s]...", test)
     try:
         # using eval is not the best approach here.
-        return eval(test, {}, {})
+        # (the expression is only compiled the first time this exact text is tested)
+        return eval(runtimes.compile_expression(test), {}, {})
     except Exception as ex:
         raise Exception("Expression [%s] is not valid.\n%s" % (test, str(ex)))
 
+
+def _test(self, test):
+    """
+    Evaluates an IF or WHILE test, before it's variables are replaced.
+
+    The expression is compiled once, with the [[ ]] references as names (see templates.compile_test),
+    so a WHILE doesn't compile it again on every pass just because a counter changed.
+    Anything that can't be done that way exactly is replaced and evaluated as text, like always.
+    """
+    try:
+        t = templates.compile_test(test)
+        namespace = t.bind(self.get_bracket_var_value)
+    except templates.Unsafe:
+        return _eval_test_expression(self, self.replace_variables(test))
+
+    self.logger.debug("Testing expression: [%s] %s...", test, namespace)
+    try:
+        return eval(t.code, {}, namespace)
+    except Exception:
+        # the legacy way has the error message with the values in it
+        return _eval_test_expression(self, self.replace_variables(test))
+
 def if_cmd(self, task, step):
 
-    root = catocommon.ET.fromstring(step.command)
-    test_nodes = root.findall("./tests/test")
-    action_xml = False
-    for test_node in test_nodes:
+    plan = step.get_plan()
+    sub_step = None
+    for test_node in plan.elements("./tests/test"):
         test = test_node.findtext("eval", "")
         test = self.replace_html_chars(test)
-        test = self.replace_variables(test)
 
-        if _eval_test_expression(self, test):
+        if _test(self, test):
             self.logger.debug("... True!")
-            action = test_node.findall("./action/function")
-            if action:
-                action_xml = catocommon.ET.tostring(action[0])
+            sub_step = plan.sub_step(step.step_id, "./action/function", test_node)
             break
         else:
             self.logger.debug("... False.")
 
-    if not action_xml:
-        action = root.findall("./else/function")
-        if action:
-            action_xml = catocommon.ET.tostring(action[0])
+    if not sub_step:
+        sub_step = plan.sub_step(step.step_id, "./else/function")
 
-    if action_xml:
-        sub_step = self.get_step_object(step.step_id, action_xml)
+    if sub_step:
         self.process_step(task, sub_step)
-        del(sub_step)
-    del(root)
 
 
 def while_cmd(self, task, step):
 
-    orig_test = self.get_command_params(step.command, "test")[0]
-    root = catocommon.ET.fromstring(step.command)
-    action = root.findall("./action/function")
-    if action:
-        action_xml = catocommon.ET.tostring(action[0])
-    else:
-        action_xml = False
-    del(root)
-
-    if action_xml:
-        sub_step = self.get_step_object(step.step_id, action_xml)
+    orig_test = self.get_command_params(step, "test")[0]
+    sub_step = step.get_plan().sub_step(step.step_id, "./action/function")
 
-        orig_test = self.replace_html_chars(orig_test)
-        test = self.replace_variables(orig_test)
-        sub_step = self.get_step_object(step.step_id, action_xml)
+    if sub_step:
+        test = self.replace_html_chars(orig_test)
 
-        while _eval_test_expression(self, test):
+        while _test(self, test):
             if self.loop_break:
                 self.loop_break = False
                 break
             self.process_step(task, sub_step)
-            test = self.replace_variables(orig_test)
-            self.logger.debug(test)
-
-        del(sub_step)
 
 
 def loop_cmd(self, task, step):
 
-    initial, counter_v_name, loop_test, orig_compare_to, increment, max_iter = self.get_command_params(step.command,
+    initial, counter_v_name, loop_test, orig_compare_to, increment, max_iter = self.get_command_params(step,
         "start", "counter", "test", "compare_to", "increment", "max")[:]
-    root = catocommon.ET.fromstring(step.command)
-    action = root.findall("./action/function")
-    if action:
-        action_xml = catocommon.ET.tostring(action[0])
-    else:
-        action_xml = False
-    del(root)
-    if action_xml:
+    sub_step = step.get_plan().sub_step(step.step_id, "./action/function")
+    if sub_step:
 
         # initial will be what we set the counter to initally
         initial = int(self.replace_variables(initial))
@@ -600,13 +831,13 @@ def loop_cmd(self, task, step):
         if max_iter:
             max_iter = int(max_iter)
 
-        self.logger.debug("initial is %s" % initial)
-        self.logger.debug("counter_v_name is %s" % counter_v_name)
-        self.logger.debug("loop_test is %s" % loop_test)
-        self.logger.debug("orig_compare_to is %s" % orig_compare_to)
-        self.logger.debug("actual compare_to is %s" % compare_to)
-        self.logger.debug("increment is %s" % increment)
-        self.logger.debug("max_iter is %s" % max_iter)
+        self.logger.debug("initial is %s", initial)
+        self.logger.debug("counter_v_name is %s", counter_v_name)
+        self.logger.debug("loop_test is %s", loop_test)
+        self.logger.debug("orig_compare_to is %s", orig_compare_to)
+        self.logger.debug("actual compare_to is %s", compare_to)
+        self.logger.debug("increment is %s", increment)
+        self.logger.debug("max_iter is %s", max_iter)
 
 
         self.rt.set(counter_v_name, initial)
@@ -615,13 +846,24 @@ def loop_cmd(self, task, step):
         # this part of the test is fixed, such as "<= 10"
         test_part = "%s %s" % (loop_test, compare_to)
 
-        test = "%s %s" % (initial, test_part)
-        self.logger.debug(test)
-        sub_step = self.get_step_object(step.step_id, action_xml)
-        self.logger.debug("counter is %s" % counter)
+        # the usual loop is an integer counter against a number,
+        # which can be tested directly instead of building and evaluating a string every time
+        compare = LOOP_OPERATORS.get(loop_test.strip())
+        compare_num = None
+        if compare and LOOP_NUMBER.match(compare_to.strip()):
+            compare_to = compare_to.strip()
+            compare_num = float(compare_to) if "." in compare_to else int(compare_to)
+
+        def test():
+            if compare_num is not None and type(counter) in (int, long):
+                self.logger.debug("Testing counter: [%s %s]...", counter, test_part)
+                return compare(counter, compare_num)
+            return _eval_test_expression(self, "%s %s" % (counter, test_part))
+
+        self.logger.debug("counter is %s", counter)
 
         loop_num = 1
-        while _eval_test_expression(self, test):
+        while test():
             if max_iter and loop_num > max_iter:
                     break
             if self.loop_break:
@@ -630,61 +872,112 @@ def loop_cmd(self, task, step):
             self.process_step(task, sub_step)
             # we have to get the counter again since it could be changed in a step
             counter = self.rt.get(counter_v_name)
-            self.logger.debug("counter is %s" % counter)
             counter = counter + increment
-            self.logger.debug("counter is %s" % counter)
-            test = "%s %s" % (counter, test_part)
+            self.logger.debug("counter is %s", counter)
             self.rt.set(counter_v_name, counter)
-            self.logger.debug(test)
             loop_num += 1
 
 
+def foreach_cmd(self, task, step):
+    """
+    Runs the action once for every item in an array, several at a time, see parallel.py.
+    Each item runs with it's own copy of the variables, the only thing that comes back is
+    the Result Variable - one value per item, in item order.
+    """
+
+    source, item_var, result_var, max_concurrent, timeout, on_error = self.get_command_params(step,
+        "array", "item_var", "result_var", "max_concurrent", "timeout", "on_error")[:]
+    sub_step = step.get_plan().sub_step(step.step_id, "./action/function")
+    if not sub_step:
+        return
+
+    source = self.replace_variables(source).strip()
+    if source.startswith("$"):
+        # a new style variable (or expression), a list gives one item per element
+        items = self.rt.eval_get(source[1:])
+        if not isinstance(items, (list, tuple)):
+            items = [items]
+    else:
+        items = self.rt.get_all(source)
+
+    item_var = self.replace_variables(item_var).strip()
+    if not item_var:
+        raise Exception("Foreach command requires an Item Variable.")
+    result_var = self.replace_variables(result_var).strip()
+
+    max_concurrent = _max_concurrent(self, max_concurrent)
+    timeout = self.replace_variables(timeout)
+    if timeout:
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            raise Exception("Foreach command requires Timeout as a number of seconds... found [%s]." % (timeout))
+
+    branches = []
+    for ii, item in enumerate(items):
+        b = parallel.Branch(ii + 1, step=sub_step, label="item %d" % (ii + 1))
+        b.variables = [(item_var, item)]
+        if result_var:
+            # an item that doesn't set it gets an empty value, not whatever was there before
+            b.variables.append((result_var, ""))
+            b.collect = result_var
+        b.timeout = timeout or None
+        branches.append(b)
+
+    msg = "Running the action for %d items of [%s], %d at a time." % (len(branches), source, max_concurrent)
+    self.insert_audit(step.function_name, msg, "")
+
+    start = time.time()
+    if branches:
+        parallel.run_branches(self, task, branches, max_concurrent)
+        self.insert_audit(step.function_name, parallel.summarize(branches, time.time() - start), "")
+
+    if result_var:
+        self.rt.set_all(result_var, [b.value for b in branches])
+
+    errors = [b for b in branches if b.status != "Completed"]
+    if errors and on_error != "continue":
+        raise Exception("%d of %d foreach items failed.\n%s" % (len(errors), len(branches),
+            "\n".join("%s: %s" % (b.label, b.error) for b in errors)))
+
+
 def exists_cmd(self, task, step):
 
     all_true = True
-    root = catocommon.ET.fromstring(step.command)
-    variables = root.findall("./variables/variable")
+    plan = step.get_plan()
+    variables = plan.elements("./variables/variable")
     for v in variables:
         variable_name = v.findtext("name", "").upper()
         is_true_flag = v.findtext("is_true", None)
         has_data_flag = v.findtext("has_data", None)
-        self.logger.debug("Checking if [%s] exists ..." % (variable_name))
+        self.logger.debug("Checking if [%s] exists ...", variable_name)
 
         # if result == "1":
         if self.rt.exists(variable_name):
             value = self.rt.get(variable_name)
             if is_true_flag == "1" and not catocommon.is_true(value):
-                self.logger.debug("[%s] is not 'true'." % (variable_name))
+                self.logger.debug("[%s] is not 'true'.", variable_name)
                 all_true = False
             if has_data_flag == "1" and not len(value):
-                self.logger.debug("[%s] has no data." % (variable_name))
+                self.logger.debug("[%s] has no data.", variable_name)
                 all_true = False
         else:
             all_true = False
 
-    self.logger.debug("all_true = %s" % (all_true))
+    self.logger.debug("all_true = %s", all_true)
 
-    action = False
     if all_true:
-        action = root.findall("./actions/positive_action/function")
+        sub_step = plan.sub_step(step.step_id, "./actions/positive_action/function")
     else:
-        action = root.findall("./actions/negative_action/function")
+        sub_step = plan.sub_step(step.step_id, "./actions/negative_action/function")
 
-    if action:
-        action_xml = catocommon.ET.tostring(action[0])
-    else:
-        action_xml = False
-    del(root)
-
-    if action_xml:
-        sub_step = self.get_step_object(step.step_id, action_xml)
+    if sub_step:
         self.process_step(task, sub_step)
-        del(sub_step)
 
 
 def log_msg_cmd(self, task, step):
 
-    msg = self.get_command_params(step.command, "message")[0]
+    msg = self.get_command_params(step, "message")[0]
     msg = self.replace_variables(msg)
     if self.audit_trail_on == 0:
         self.audit_trail_on = 1
@@ -693,7 +986,7 @@ def log_msg_cmd(self, task, step):
 
 def generate_password_cmd(self, task, step):
 
-    length, v_name = self.get_command_params(step.command, "length", "variable")[:]
+    length, v_name = self.get_command_params(step, "length", "variable")[:]
     length = self.replace_variables(length)
     v_name = self.replace_variables(v_name)
     if not len(v_name):
@@ -715,9 +1008,9 @@ def generate_password_cmd(self, task, step):
 
 
 def subtask_cmd(self, task, step):
-    subtask_name, subtask_version = self.get_command_params(step.command, "task_name", "version")[:]
+    subtask_name, subtask_version = self.get_command_params(step, "task_name", "version")[:]
 
-    self.logger.debug("subtask [%s] version [%s]" % (subtask_name, subtask_version))
+    self.logger.debug("subtask [%s] version [%s]", subtask_name, subtask_version)
     if len(subtask_version):
         sql = """select task_id from task where task_name = %s and version = %s"""
         row = self.select_row(sql, (subtask_name, subtask_version))
@@ -732,14 +1025,14 @@ def subtask_cmd(self, task, step):
 
 def run_task_cmd(self, task, step):
 
-    args = self.get_command_params(step.command, "task_name", "version", "handle", "asset_id", "time_to_wait")
+    args = self.get_command_params(step, "task_name", "version", "handle", "asset_id", "time_to_wait")
     task_name = args[0]
     version = args[1]
     handle = args[2].lower()
     asset_id = self.replace_variables(args[3])
     wait_time = self.replace_variables(args[4])
 
-    parameters = self.extract_xml_string(step.command, "parameters")
+    parameters = self.extract_xml_string(step, "parameters")
     parameters = self.replace_variables(parameters)
 
     if not task_name:
@@ -825,17 +1118,134 @@ def run_task_cmd(self, task, step):
     elif sec_wait == -1:
         log = "Waiting until task instance [%s] completes..." % (ti)
         self.insert_audit(step.function_name, log)
-        while True:
-            time.sleep(5)
-            status = self.get_task_status(ti)
-            if status in ["Completed", "Error", "Cancelled"]:
-                self.refresh_handle(h)
-                break
+        for finished in self.wait_for_handles([h]):
+            pass
+
+
+def _xml_text(v):
+    return saxutils.escape(v if isinstance(v, basestring) else str(v))
+
+
+def _child_parameters(item):
+    """parameter xml for one child of run_tasks, from an array item"""
+    if item is None or item == "":
+        return None
+    if isinstance(item, basestring):
+        try:
+            parsed = json.loads(item)
+        except ValueError:
+            parsed = None
+        if not isinstance(parsed, (list, dict)):
+            # parameter xml already, params2xml checks it
+            return catocommon.params2xml(item)
+        item = parsed
+    if isinstance(item, dict):
+        # {"name": value or [values], ...}
+        item = [{"name": k, "values": v if isinstance(v, (list, tuple)) else [v]} for k, v in sorted(item.iteritems())]
+    if isinstance(item, list):
+        # params2xml puts names and values in the xml as they are, a & or < would break it
+        item = [dict(p, name=_xml_text(p["name"]), values=[_xml_text(v) for v in p.get("values") or []])
+            if isinstance(p, dict) and p.get("name") else p for p in item]
+    return catocommon.params2xml(item)
+
+
+def run_tasks_cmd(self, task, step):
+    """
+    Run Task, for a whole array of children at once - one child per item, the item being it's parameters.
+    They're all submitted in one database transaction, and the handles are named <handle>_1, <handle>_2 ...
+    """
+
+    task_name, version, handle, source, wait_time, result_var = self.get_command_params(step,
+        "task_name", "version", "handle", "array", "time_to_wait", "result_var")[:]
+    task_name = self.replace_variables(task_name)
+    version = self.replace_variables(version)
+    handle = self.replace_variables(handle).lower()
+    wait_time = self.replace_variables(wait_time)
+    result_var = self.replace_variables(result_var).strip()
+
+    if not task_name:
+        raise Exception("Run Tasks requires a Task Name.")
+    if not handle:
+        raise Exception("Run Tasks requires a handle name.")
+
+    source = self.replace_variables(source).strip()
+    if source.startswith("$"):
+        items = self.rt.eval_get(source[1:])
+        if not isinstance(items, (list, tuple)):
+            items = [items]
+    else:
+        items = self.rt.get_all(source)
+
+    sql = """select task_id, version, default_version, parameter_xml, now() from task where task_name = %s"""
+    if len(version):
+        sql = sql + " and version = %s"
+        row = self.select_row(sql, (task_name, version))
+    else:
+        sql = sql + " and default_version = 1"
+        row = self.select_row(sql, (task_name))
+    if not row:
+        raise Exception("Run Tasks - Task [%s] version [%s] does not exist." % (task_name, version))
+    task_id, task_version, default_version, task_params, submitted_dt = row
+
+    # everything is worked out before anything is submitted, a bad item submits nothing
+    instances = []
+    for ii, item in enumerate(items):
+        try:
+            instances.append((task_id, self.merge_parameters(task_params, _child_parameters(item))))
+        except Exception as ex:
+            raise Exception("Run Tasks - item %d has invalid parameters.\n%s" % (ii + 1, ex))
+
+    tis = catocommon.add_task_instances(instances, user_id=self.submitted_by, debug_level=self.debug_level,
+        account_id=self.cloud_account, plan_id=self.plan_id, schedule_id=self.schedule_id,
+        submitted_by_instance=self.task_instance, cloud_id=self.cloud_id, options=self.options)
+
+    handles = []
+    for ii, ti in enumerate(tis):
+        h = classes.TaskHandle()
+        h.instance = ti
+        h.handle_name = "%s_%d" % (handle, ii + 1)
+        h.task_id = task_id
+        h.submitted_by = self.submitted_by
+        h.task_name = task_name
+        h.task_version = task_version
+        h.default_version = default_version
+        h.submitted_dt = submitted_dt
+        h.status = "Submitted"
+        self.task_handles[h.handle_name] = h
+        handles.append(h)
+
+    if result_var:
+        self.rt.set_all(result_var, tis)
+
+    if tis:
+        log = "Running %d Task Instances [%s] to [%s] :: ID [%s], Name [%s], Version [%s] using handles [%s_1] to [%s_%d]." % (
+            len(tis), tis[0], tis[-1], task_id, task_name, task_version, handle, handle, len(tis))
+    else:
+        log = "Nothing to run, [%s] is empty." % (source)
+    self.insert_audit(step.function_name, log)
+
+    try:
+        sec_wait = int(wait_time)
+    except:
+        sec_wait = 0
+
+    # same as run_task: 0 doesn't wait, -1 waits for all of them, > 0 waits x seconds
+    if sec_wait > 0:
+        self.insert_audit(step.function_name, "Waiting [%s] seconds before continuing..." % (wait_time))
+        time.sleep(sec_wait)
+    elif sec_wait == -1 and handles:
+        self.insert_audit(step.function_name, "Waiting until all %d task instances complete..." % (len(handles)))
+        statuses = {}
+        for h in self.wait_for_handles(handles):
+            statuses[h.status] = statuses.get(h.status, 0) + 1
+        self.insert_audit(step.function_name, "All task instances finished: %s." % (
+            ", ".join("%d %s" % (n, st) for st, n in sorted(statuses.iteritems()))))
+
 
 def sql_exec_cmd(self, task, step):
     # TODO: add the 'mode' stuff back in for oracle prepared statements, transactions, etc...
 
-    conn_name, sql, mode, handle, result_var = self.get_command_params(step.command, "conn_name", "sql", "mode", "handle", "result_variable")[:]
+    conn_name, sql, mode, handle, result_var = self.get_command_params(step, "conn_name", "sql", "mode", "handle", "result_variable")[:]
     conn_name = self.replace_variables(conn_name)
     sql = self.replace_variables(sql)
 
@@ -849,8 +1259,8 @@ def sql_exec_cmd(self, task, step):
         msg = "A connection named [%s] has not been established." % (conn_name)
         raise Exception(msg)
 
-    self.logger.debug("conn type is %s" % (c.conn_type))
-    variables = self.get_node_list(step.command, "step_variables/variable", "name", "position")
+    self.logger.debug("conn type is %s", c.conn_type)
+    variables = self.get_node_list(step, "step_variables/variable", "name", "position")
     if c.conn_type == "mysql":
         _sql_exec_mysql(self, sql, variables, c.handle, mode, result_var)
     elif c.conn_type in ["sqlanywhere", "sqlserver", "oracle"]:
@@ -907,7 +1317,7 @@ def _sql_exec_mysql(self, sql, variables, conn, mode, result_var=None):
         # add the entire rows collection to a single variable for advanced processing
         # NOTE: switch the tuple to a list 
         if result_var:
-            self.logger.debug("SQL Exec: 'Result Variable' provided, setting [%s]" % (result_var))
+            self.logger.debug("SQL Exec: 'Result Variable' provided, setting [%s]", result_var)
             self.rt.set(result_var, list(rows))
             
         self.process_list_buffer(rows, variables)
@@ -918,7 +1328,7 @@ def _sql_exec_mysql(self, sql, variables, conn, mode, result_var=None):
 
 def store_private_key_cmd(self, task, step):
 
-    key_name, cloud_name, private_key = self.get_command_params(step.command, "name", "cloud_name", "private_key")[:]
+    key_name, cloud_name, private_key = self.get_command_params(step, "name", "cloud_name", "private_key")[:]
     key_name = self.replace_variables(key_name)
     cloud_name = self.replace_variables(cloud_name)
     private_key = self.replace_variables(private_key)
@@ -952,7 +1362,7 @@ def comment_cmd(self, task, step):
 
 def clear_variable_cmd(self, task, step):
 
-    variables = self.get_node_list(step.command, "variables/variable", "name")
+    variables = self.get_node_list(step, "variables/variable", "name")
     for var in variables:
         var = self.replace_variables(var[0])
         if "," in var:
@@ -966,14 +1376,14 @@ def clear_variable_cmd(self, task, step):
 
 def replace_cmd(self, task, step):
 
-    source, v_name = self.get_command_params(step.command, "source", "variable_name")[:]
+    source, v_name = self.get_command_params(step, "source", "variable_name")[:]
     source = self.replace_variables(source)
     v_name = self.replace_variables(v_name)
 
     if len(v_name) == 0:
         raise Exception("Replace command requires a Variable Name.")
 
-    patterns = self.get_node_list(step.command, "patterns/pattern", "old", "new", "regsub")
+    patterns = self.get_node_list(step, "patterns/pattern", "old", "new", "regsub")
     for p in patterns:
         old, new, reg = p[:]
         old = self.replace_variables(old)
@@ -989,7 +1399,7 @@ def replace_cmd(self, task, step):
 
 def set_variable_cmd(self, task, step):
 
-    variables = self.get_node_list(step.command, "variables/variable", "name", "value", "modifier")
+    variables = self.get_node_list(step, "variables/variable", "name", "value", "modifier")
     for var in variables:
         name, value, modifier = var[:]
         name = self.replace_variables(name)
@@ -1038,7 +1448,7 @@ def set_variable_cmd(self, task, step):
         elif modifier == "FROM_JSON":
             # reads a JSON string into a dictionary variable object.
             try:
-                self.logger.debug("Set Variable - Read JSON Modifier : parsing %s" % (value))
+                self.logger.debug("Set Variable - Read JSON Modifier : parsing %s", value)
                 value = json.loads(value)
             except Exception as ex:
                 self.logger.warning("Set Variable - Read JSON Modifier : Unable to parse string. %s" % (ex.__str__))
@@ -1067,7 +1477,7 @@ def set_variable_cmd(self, task, step):
 
 def cancel_task_cmd(self, task, step):
 
-    tis = self.get_command_params(step.command, "task_instance")[0]
+    tis = self.get_command_params(step, "task_instance")[0]
     tis = self.replace_variables(tis)
     for ti in tis.split(" "):
         if ti.isdigit():
@@ -1088,7 +1498,7 @@ def cancel_task_cmd(self, task, step):
 
 def wait_for_tasks_cmd(self, task, step):
 
-    handles = self.get_node_list(step.command, "handles/handle", "name")
+    handles = self.get_node_list(step, "handles/handle", "name")
     # print handles
 
     handle_set = []
@@ -1098,27 +1508,21 @@ def wait_for_tasks_cmd(self, task, step):
         # print handle_name
         handle_set.append(handle_name)
 
-    log = "Waiting for the following task handles to complete: [%s]... will check every 5 seconds." % (" ".join(handle_set))
+    log = "Waiting for the following task handles to complete: [%s]..." % (" ".join(handle_set))
     self.insert_audit(step.function_name, log)
 
-    while len(handle_set) > 0:
+    waiting = []
+    for handle in handle_set:
+        try:
+            waiting.append(self.task_handles[handle])
+        except KeyError:
+            log = "Handle [%s] does not exist, skipping..." % (handle)
+            self.insert_audit(step.function_name, log)
 
-        for handle in handle_set:
-            try:
-                h = self.task_handles[handle]
-                self.refresh_handle(h)
-                if h.status in ["Completed", "Error", "Cancelled"]:
-                    handle_set.remove(handle)
-                    log = "Handle [%s] finished with a status of [%s]." % (handle, h.status)
-                    self.insert_audit(step.function_name, log)
-            except KeyError as ex:
-                log = "Handle [%s] does not exist, skipping..." % (handle)
-                self.insert_audit(step.function_name, log)
-                handle_set.remove(handle)
-            except Exception as ex:
-                raise Exception(ex)
-        if len(handle_set) > 0:
-            time.sleep(5)
+    # all the handles are refreshed together, and we're woken up as soon as any one finishes
+    for h in self.wait_for_handles(waiting):
+        log = "Handle [%s] finished with a status of [%s]." % (h.handle_name, h.status)
+        self.insert_audit(step.function_name, log)
 
     log = "All task handles have a finished status."
     self.insert_audit(step.function_name, log)
@@ -1126,7 +1530,7 @@ def wait_for_tasks_cmd(self, task, step):
 
 def substring_cmd(self, task, step):
 
-    source, v_name, start, end = self.get_command_params(step.command, "source", "variable_name", "start", "end")[:]
+    source, v_name, start, end = self.get_command_params(step, "source", "variable_name", "start", "end")[:]
     source = self.replace_variables(source)
     v_name = self.replace_variables(v_name)
     start = self.replace_variables(start)
@@ -1157,7 +1561,7 @@ def substring_cmd(self, task, step):
     elif end[0:3] == "end" and end[3] == "-":
         end = int(end[3:])
 
-    self.logger.debug("End is [%s]" % (end))
+    self.logger.debug("End is [%s]", end)
     s = source[start:end]
 
     msg = "Substring set variable [%s] to [%s]." % (v_name, s)
@@ -1167,7 +1571,7 @@ def substring_cmd(self, task, step):
 
 def drop_connection_cmd(self, task, step):
 
-    conn_name = self.get_command_params(step.command, "conn_name")[0]
+    conn_name = self.get_command_params(step, "conn_name")[0]
     conn_name = self.replace_variables(conn_name)
     if conn_name in self.connections.keys():
         msg = "Dropping connection named [%s]..." % (conn_name)
@@ -1177,7 +1581,7 @@ def drop_connection_cmd(self, task, step):
 
 def get_shared_cred_cmd(self, task, step):
 
-    alias, u, p, d = self.get_command_params(step.command, "alias", "userid", "password", "domain")[:]
+    alias, u, p, d = self.get_command_params(step, "alias", "userid", "password", "domain")[:]
     alias = self.replace_variables(alias)
     u = self.replace_variables(u)
     p = self.replace_variables(p)
@@ -1207,7 +1611,7 @@ def get_shared_cred_cmd(self, task, step):
 
 def end_cmd(self, task, step):
 
-    message, status = self.get_command_params(step.command, "message", "status")[:]
+    message, status = self.get_command_params(step, "message", "status")[:]
     message = self.replace_variables(message)
     msg = "Ending task with a status of [%s], message:\n%s" % (status, message)
     self.insert_audit(step.function_name, msg, "")
@@ -1222,7 +1626,7 @@ def end_cmd(self, task, step):
 # work in progress, not complete.
 def new_connection_cmd(self, task, step):
 
-    conn_type, conn_name, asset, cloud_name, debug = self.get_command_params(step.command, "conn_type", "conn_name", "asset", "cloud_name", "debug")[:]
+    conn_type, conn_name, asset, cloud_name, debug = self.get_command_params(step, "conn_type", "conn_name", "asset", "cloud_name", "debug")[:]
     conn_name = self.replace_variables(conn_name)
     asset = self.replace_variables(asset).strip()
     cloud_name = self.replace_variables(cloud_name)
@@ -1407,7 +1811,7 @@ def new_connection_cmd(self, task, step):
 
 def send_email_cmd(self, task, step):
 
-    to, cc, bcc, sub, body = self.get_command_params(step.command, "to", "cc", "bcc", "subject", "body")[:]
+    to, cc, bcc, sub, body = self.get_command_params(step, "to", "cc", "bcc", "subject", "body")[:]
     to = self.replace_variables(to)
     cc = self.replace_variables(cc)
     bcc = self.replace_variables(bcc)
@@ -1438,7 +1842,7 @@ def _cato_sign_string(host, method, access_key, secret_key):
 
 def cato_web_service_cmd(self, task, step):
 
-    host, method, userid, password, result_var, error_var, timeout, xpath = self.get_command_params(step.command,
+    host, method, userid, password, result_var, error_var, timeout, xpath = self.get_command_params(step,
         "host", "method", "userid", "password", "result_var", "error_var", "timeout", "xpath")[:]
     host = self.replace_variables(host)
     method = self.replace_variables(method)
@@ -1446,7 +1850,7 @@ def cato_web_service_cmd(self, task, step):
     password = self.replace_variables(password)
     timeout = self.replace_variables(timeout)
     xpath = self.replace_variables(xpath)
-    values = self.get_node_list(step.command, "values/value", "name", "variable", "type")
+    values = self.get_node_list(step, "values/value", "name", "variable", "type")
     try:
         timeout = 5 if not timeout else int(timeout)
     except:
@@ -1465,7 +1869,7 @@ def cato_web_service_cmd(self, task, step):
     if not len(password):
         raise Exception("CSK API call command requires Password value")
 
-    pairs = self.get_node_list(step.command, "pairs/pair", "key", "value")
+    pairs = self.get_node_list(step, "pairs/pair", "key", "value")
 
     args = {}  # a dictionary of any arguments required for 20the method
     for (k, v) in pairs:
@@ -1531,13 +1935,12 @@ def route53_cmd(self, task, step):
     except Exception as e:
         raise Exception(e)
 
-    path, rtype, data, response_v = self.get_command_params(step.command, "path", "type", "data", "result_name")[:]
+    path, rtype, data, response_v = self.get_command_params(step, "path", "type", "data", "result_name")[:]
     path = self.replace_variables(path)
     data = self.replace_variables(data)
     response_v = self.replace_variables(response_v)
-    conn = awspy.AWSConn(self.cloud_login_id, self.cloud_login_password, product="r53")
-    result = conn.aws_query(path, request_type=rtype, data=data)
-    del(conn)
+    new_conn = lambda: awspy.AWSConn(self.cloud_login_id, self.cloud_login_password, product="r53")
+    result = self.aws_query(("", "r53", ""), None, new_conn, lambda conn: conn.aws_query(path, request_type=rtype, data=data))
     if result:
         result = self._xml_del_namespace(result)
         msg = "%s %s\n%s" % ("Route53", path, result)
@@ -1552,8 +1955,9 @@ def route53_cmd(self, task, step):
 
 def http_cmd(self, task, step):
 
-    url, typ, u_data, time_out, retries, stat_code_v, stat_msg_v, header_v, body_v, res_time_v, cook = self.get_command_params(step.command,
-        "url", "type", "data", "timeout", "retries", "status_code", "status_msg", "response_header", "response_body", "response_time_ms","cookie_out")[:]
+    url, typ, u_data, time_out, retries, stat_code_v, stat_msg_v, header_v, body_v, res_time_v, cook, headers_obj_v, timings_v = self.get_command_params(step,
+        "url", "type", "data", "timeout", "retries", "status_code", "status_msg", "response_header", "response_body", "response_time_ms", "cookie_out",
+        "response_headers_obj", "timings")[:]
 
     url = self.replace_variables(url)
     u_data = self.replace_variables(u_data)
@@ -1565,11 +1969,13 @@ def http_cmd(self, task, step):
     body_v = self.replace_variables(body_v)
     res_time_v = self.replace_variables(res_time_v)
     cook = self.replace_variables(cook)
+    headers_obj_v = self.replace_variables(headers_obj_v)
+    timings_v = self.replace_variables(timings_v)
 
     if not len(url):
         raise Exception("HTTP command error, url is empty.")
 
-    headers = self.get_node_list(step.command, "headers/pair", "key", "value")
+    headers = self.get_node_list(step, "headers/pair", "key", "value")
 
     if len(time_out):
         timeout = int(time_out)
@@ -1581,88 +1987,97 @@ def http_cmd(self, task, step):
         retries = 0
     attempt = 0
 
-    req = urllib2.Request(url)
-    req.get_method = lambda: typ
     if not len(u_data):
         u_data = None
 
-    req.add_data(u_data)
+    req_headers = {}
     for (k, v) in headers:
         k = self.replace_variables(k)
         v = self.replace_variables(v)
         if len(k):
-            req.add_header(k, v)
+            req_headers[k] = v
+
+    # a big response body goes to a file instead of memory, the same as cmd_line output
+    # (exact - unlike command output, a body keeps it's trailing newlines)
+    # The body variable holds the file backed buffer then, it's only read if the variable is used.
+    # stream_output="false" on the step keeps the whole body in memory as a string instead.
+    new_sink = (lambda: self.new_spill_file(exact=True)) if self.use_streaming(step) else None
 
     ok = True
+    r = None
+    start = time.time()
     while attempt <= retries:
         try:
-            before = datetime.now()
-            response = urllib2.urlopen(req, None, timeout)
-            after = datetime.now()
-            break
-        except urllib2.HTTPError, e:
-            after = datetime.now()
-            head = e.headers
-            msg = e.msg
-            buff = e.read()
-            code = e.code
-            ok = False
-
-            # raise Exception("HTTPError = %s, %s, %s\n%s" % (str(e.code), e.msg, e.read(), url))
+            r = httpclient.request(typ, url, u_data, req_headers, timeout, int(catoconfig.CONFIG["te_http_pool_size"]),
+                int(catoconfig.CONFIG["te_http_pool_idle"]), new_sink)
+            head = r.headers
+            msg = r.reason
+            buff = self.keep_output(r.body)
+            code = r.status
+            if r.ok():
+                msg = "ok"
+            else:
+                ok = False
+            # time to the response, not including the body - what it's always meant
+            response_ms = r.response_ms
             break
-        except urllib2.URLError, e:
+        except httpclient.HTTPClientError, e:
             attempt += 1
             if str(e.reason) == "timed out" and attempt <= retries:
                 self.insert_audit(step.function_name, "timeout on attempt number %s, retrying" % attempt)
             else:
-                after = datetime.now()
+                response_ms = int(round((time.time() - start) * 1000))
                 head = ""
                 msg = e.reason
                 buff = ""
                 code = e.reason
                 ok = False
-                # raise Exception("URLError = %s\n%s" % (str(e.reason), url))
                 break
         except Exception as e:
             import traceback
             raise Exception("generic exception: " + traceback.format_exc())
 
-    if ok:
-        buff = response.read()
-        head = response.headers
-        code = response.getcode()
-        if len(cook):
-            c = response.info().getheader("Set-Cookie")
+    try:
+        if ok and len(cook):
+            c = head.getheader("Set-Cookie")
             self.rt.set(cook, c)
-        msg = "ok"
-        del(response)
-
-    # response_ms = int(round((after - before).total_seconds() * 1000))
-    response_ms = self.time_diff_ms(after - before)
-    self.http_response = response_ms
-
-    if len(body_v):
-        self.rt.set(body_v, buff)
-    if len(header_v):
-        self.rt.set(header_v, head)
-    if len(stat_msg_v):
-        self.rt.set(stat_msg_v, msg)
-    if len(stat_code_v):
-        self.rt.set(stat_code_v, code)
-    if len(res_time_v):
-        self.rt.set(res_time_v, response_ms)
-
-    log = "http %s %s\012%s - %s\012%s\012Response time = %s ms" % (typ, url, code, msg, buff, response_ms)
-    self.insert_audit(step.function_name, log)
-    variables = self.get_node_list(step.command, "step_variables/variable", "name", "type", "position",
-        "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
-    if len(variables):
-        self.process_buffer(buff, step)
+        self.add_remote_wait(start, buff)
+
+        self.http_response = response_ms
+
+        if len(body_v):
+            self.rt.set(body_v, buff)
+        if len(header_v):
+            self.rt.set(header_v, head)
+        if len(stat_msg_v):
+            self.rt.set(stat_msg_v, msg)
+        if len(stat_code_v):
+            self.rt.set(stat_code_v, code)
+        if len(res_time_v):
+            self.rt.set(res_time_v, response_ms)
+        if len(headers_obj_v):
+            # header name (lower case) : value, for use in expressions
+            self.rt.set(headers_obj_v, dict(head.items()) if head else {})
+        if len(timings_v):
+            self.rt.set(timings_v, r.timings() if r else {"total_ms": response_ms})
+
+        log = "http %s %s\012%s - %s\012%s\012Response time = %s ms" % (typ, url, code, msg, self.summarize_output(buff), response_ms)
+        if r:
+            log += " (connect %s ms%s, first byte %s ms, %s bytes)" % (r.connect_ms, ", reused" if r.reused else "", r.first_byte_ms, r.bytes)
+        self.insert_audit(step.function_name, log)
+        variables = self.get_node_list(step, "step_variables/variable", "name", "type", "position",
+            "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
+        if len(variables):
+            self.process_buffer(buff, step)
+    finally:
+        # a spilled output file nobody kept goes away as soon as the step is done with it
+        if not len(body_v):
+            self.release_output(buff)
 
 
 def get_instance_handle_cmd(self, task, step):
 
-    ti, handle = self.get_command_params(step.command, "instance", "handle")[:]
+    ti, handle = self.get_command_params(step, "instance", "handle")[:]
     ti = self.replace_variables(ti)
     handle = self.replace_variables(handle)
     handle = handle.lower()
@@ -1689,11 +2104,11 @@ def get_instance_handle_cmd(self, task, step):
 
 def parse_text_cmd(self, task, step):
 
-    buff = self.get_command_params(step.command, "text")[0]
+    buff = self.get_command_params(step, "text")[0]
     buff = self.replace_variables(buff)
     log = "%s: %s" % (step.function_name, buff)
     self.insert_audit(step.function_name, log)
-    variables = self.get_node_list(step.command, "step_variables/variable", "name", "type", "position",
+    variables = self.get_node_list(step, "step_variables/variable", "name", "type", "position",
         "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
     if len(variables):
         self.logger.debug(variables)
@@ -1701,7 +2116,7 @@ def parse_text_cmd(self, task, step):
 
 def add_summary_item_cmd(self, task, step):
 
-    name, detail = self.get_command_params(step.command, "name", "detail")[:]
+    name, detail = self.get_command_params(step, "name", "detail")[:]
     name = self.replace_variables(name)
     detail = self.replace_variables(detail)
 
@@ -1713,7 +2128,7 @@ def add_summary_item_cmd(self, task, step):
 
 def set_debug_level_cmd(self, task, step):
 
-    dl = self.get_command_params(step.command, "debug_level")[0]
+    dl = self.get_command_params(step, "debug_level")[0]
     if len(dl):
         # changing the logging level raises a critical message, so it's always seen for clarity.
         msg = "Setting the debug level to [%s]..." % (dl)
@@ -1723,7 +2138,7 @@ def set_debug_level_cmd(self, task, step):
 
 def sleep_cmd(self, task, step):
 
-    seconds = self.get_command_params(step.command, "seconds")[0]
+    seconds = self.get_command_params(step, "seconds")[0]
     seconds = self.replace_variables(seconds)
     try:
         seconds = int(seconds)
@@ -1743,7 +2158,7 @@ def break_loop_cmd(self, task, step):
 
 def winrm_cmd_cmd(self, task, step):
 
-    conn_name, cmd, timeout, return_code, result_var = self.get_command_params(step.command, "conn_name", "command", "timeout", "return_code", "result_variable")[:]
+    conn_name, cmd, timeout, return_code, result_var = self.get_command_params(step, "conn_name", "command", "timeout", "return_code", "result_variable")[:]
     conn_name = self.replace_variables(conn_name)
     cmd = self.replace_variables(cmd)
     return_code = self.replace_variables(return_code)
@@ -1761,41 +2176,83 @@ def winrm_cmd_cmd(self, task, step):
         c.handle.timeout = c.handle.set_timeout(to)
 
     self.logger.info("WinRM - executing:\n%s" % cmd)
+    start = time.time()
     command_id = c.handle.run_command(c.shell_id, cmd)
-    buff, err, r_code = c.handle.get_command_output(c.shell_id, command_id)
+    if self.use_streaming(step):
+        buff, err, r_code = _winrm_output_streaming(self, c, command_id)
+    else:
+        buff, err, r_code = c.handle.get_command_output(c.shell_id, command_id)
 
-    # add stderr to the end of stdout
-    buff += err
+        # add stderr to the end of stdout
+        buff += err
 
-    # replace CRLF with LF for easier processing
-    buff = re.sub("\r\n", "\n", buff).rstrip("\n")
+        # replace CRLF with LF for easier processing
+        buff = re.sub("\r\n", "\n", buff).rstrip("\n")
+    self.add_remote_wait(start, buff)
     self.logger.info("WinRM return code >%s<" % r_code)
-    self.logger.info("Buffer returned is >%s<" % buff)
-    self.logger.info("Error result is >%s<" % err)
+    self.logger.info("Buffer returned is >%s<" % self.summarize_output(buff))
+    self.logger.info("Error result is >%s<" % self.summarize_output(err))
 
     if c.debug:
-        self.logger.info(':'.join(x.encode('hex') for x in buff))
+        self.logger.info(':'.join(x.encode('hex') for x in self.summarize_output(buff)))
 
-    c.handle.cleanup_command(c.shell_id, command_id)
+    try:
+        c.handle.cleanup_command(c.shell_id, command_id)
 
-    if len(return_code):
-        self.rt.set(return_code, r_code)
-    msg = "%s\n%s" % (cmd, buff)
-    self.insert_audit(step.function_name, msg)
+        if len(return_code):
+            self.rt.set(return_code, r_code)
+        msg = "%s\n%s" % (cmd, self.summarize_output(buff))
+        self.insert_audit(step.function_name, msg)
 
-    # if 'result variable' is specified, shove the whole buffer into that variable
-    if result_var:
-        self.rt.set(result_var, buff)
+        # if 'result variable' is specified, shove the whole buffer into that variable
+        # (a spilled output stays open for the rest of the task, it's only read if the variable is used)
+        if result_var:
+            self.rt.set(result_var, buff)
 
-    variables = self.get_node_list(step.command, "step_variables/variable", "name", "type", "position",
-        "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
-    if len(variables):
-        self.process_buffer(buff, step)
+        variables = self.get_node_list(step, "step_variables/variable", "name", "type", "position",
+            "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
+        if len(variables):
+            self.process_buffer(buff, step)
+    finally:
+        # a spilled output file nobody kept goes away as soon as the step is done with it
+        if not result_var:
+            self.release_output(buff)
+
+
+def _winrm_output_streaming(self, c, command_id):
+    """
+    Like pywinrm's get_command_output, but stdout goes to a SpillFile as it arrives.
+    stderr is added at the end, and CRLF is replaced with LF, exactly like the in memory version.
+    """
+    out = self.new_spill_file()
+    out.normalize_crlf()
+    errout = self.new_spill_file()
+    try:
+        r_code = None
+        command_done = False
+        while not command_done:
+            stdout, stderr, r_code, command_done = c.handle._raw_get_command_output(c.shell_id, command_id)
+            out.write(stdout)
+            errout.write(stderr)
+
+        err = errout.result()
+        if isinstance(err, spill.SpillBuffer):
+            for ii in range(0, len(err), spill.MATCH_WINDOW):
+                out.write(err[ii:ii + spill.MATCH_WINDOW])
+            err.close()
+            err = "(%d bytes, included in the output)" % (errout.size)
+        else:
+            out.write(err)
+
+        return self.keep_output(out.result()), err, r_code
+    finally:
+        out.discard()
+        errout.discard()
 
 
 def cmd_line_cmd(self, task, step):
 
-    conn_name, timeout, cmd, pos, neg, result_var = self.get_command_params(step.command,
+    conn_name, timeout, cmd, pos, neg, result_var = self.get_command_params(step,
         "conn_name", "timeout", "command", "positive_response", "negative_response", "result_variable")
     conn_name = self.replace_variables(conn_name)
     timeout = self.replace_variables(timeout)
@@ -1820,16 +2277,25 @@ def cmd_line_cmd(self, task, step):
         timeout = int(timeout)
 
     self.logger.info("Issuing command:\n%s" % (cmd))
-    buff = self.execute_expect(c.handle, cmd, pos, neg, timeout)
-    self.insert_audit(step.function_name, "%s\n%s" % (cmd, buff), conn_name)
-    # print(':'.join(x.encode('hex') for x in buff))
-
-    # if 'result variable' is specified, shove the whole buffer into that variable
-    if result_var:
-        self.rt.set(result_var, buff)
+    if self.use_streaming(step):
+        buff = self.execute_expect_streaming(c.handle, cmd, pos, neg, timeout)
+    else:
+        buff = self.execute_expect(c.handle, cmd, pos, neg, timeout)
+    try:
+        self.insert_audit(step.function_name, "%s\n%s" % (cmd, self.summarize_output(buff)), conn_name)
+        # print(':'.join(x.encode('hex') for x in buff))
 
-    variables = self.get_node_list(step.command, "step_variables/variable", "name", "type", "position",
-        "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
-    if len(variables):
-        # print variables
-        self.process_buffer(buff, step)
+        # if 'result variable' is specified, shove the whole buffer into that variable
+        # (a spilled output stays open for the rest of the task, it's only read if the variable is used)
+        if result_var:
+            self.rt.set(result_var, buff)
+
+        variables = self.get_node_list(step, "step_variables/variable", "name", "type", "position",
+            "range_begin", "prefix", "range_end", "suffix", "regex", "xpath")
+        if len(variables):
+            # print variables
+            self.process_buffer(buff, step)
+    finally:
+        # a spilled output file nobody kept goes away as soon as the step is done with it
+        if not result_var:
+            self.release_output(buff)
@@ -0,0 +1,153 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Task instance completion notices, so a Task Engine waiting on other task instances
+doesn't have to poll the database every few seconds to find out they're done.
+
+A waiting Task Engine binds a unix datagram socket named for it's task instance.
+When a Task Engine (or the Poller) puts a task instance in a finished status,
+it sends a notice to the instance that submitted it.  If that instance isn't
+on this node, or isn't waiting, the notice just goes nowhere.
+
+That's why the waiter still checks the database now and then - a task on another
+node, or one picked up with Get Instance Handle, will never send us anything.
+
+There's one listener per Task Engine, shared by all it's parallel branches.  Whichever
+thread is waiting reads the socket for everyone, and each waiter only takes the notices
+for the task instances it's waiting on.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import threading
+
+from catoconfig import catoconfig
+
+FINISHED_STATUSES = ("Completed", "Error", "Cancelled")
+
+
+def _socket_path(task_instance):
+    return os.path.join(catoconfig.CONFIG["tmpdir"], "cato_te_notify", "%s.sock" % (task_instance))
+
+
+class CompletionListener(object):
+
+    def __init__(self, task_instance):
+        self.path = _socket_path(task_instance)
+
+        d = os.path.dirname(self.path)
+        try:
+            os.makedirs(d)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+        # a leftover from a previous process with this instance (a restarted task) is of no use
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(0)
+
+        # task_instance: status, received but not taken by a waiter yet
+        self.received = {}
+        self.cond = threading.Condition()
+        # a thread is reading the socket
+        self.reading = False
+
+    def _take(self, instances):
+        if instances is None:
+            notices, self.received = self.received, {}
+            return notices
+        return dict((i, self.received.pop(i)) for i in instances if i in self.received)
+
+    def _read(self, timeout):
+        try:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+        except select.error as ex:
+            # a signal, just treat it like a timeout
+            if ex.args[0] == errno.EINTR:
+                return
+            raise
+
+        if readable:
+            while True:
+                try:
+                    msg = self.sock.recv(256)
+                except socket.error:
+                    break
+                parts = msg.split()
+                if len(parts) == 2:
+                    with self.cond:
+                        self.received[parts[0]] = parts[1]
+
+    def wait(self, timeout, instances=None):
+        """
+        Waits up to timeout seconds for notices about any of instances (task instance ids as strings,
+        None for all of them).  Returns a dict of every task_instance: status received, empty if it timed out.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.cond:
+                notices = self._take(instances)
+                remaining = deadline - time.time()
+                if notices or remaining <= 0:
+                    return notices
+                if self.reading:
+                    # another thread is on the socket, it'll wake us when something comes in
+                    self.cond.wait(remaining)
+                    continue
+                self.reading = True
+
+            try:
+                self._read(remaining)
+            finally:
+                with self.cond:
+                    self.reading = False
+                    self.cond.notify_all()
+
+    def close(self):
+        try:
+            self.sock.close()
+            os.unlink(self.path)
+        except Exception:
+            pass
+
+
+def notify(waiter_instance, task_instance, status):
+    """
+    Tells waiter_instance that task_instance is finished.
+    Never raises, the waiter will find out from the database eventually anyway.
+    """
+    if not waiter_instance:
+        return
+    s = None
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        s.setblocking(0)
+        s.sendto("%s %s" % (task_instance, status), _socket_path(waiter_instance))
+    except socket.error:
+        pass
+    finally:
+        if s:
+            s.close()
@@ -0,0 +1,108 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+A cache of parsed xml documents for the Task Engine.
+
+Every [[var.xpath]] and [$var^xpath$] reference, and every xpath step variable,
+used to parse the whole document again.  A big AWS response could be parsed dozens
+of times to pull out a few fields.
+
+Documents are kept by a key the caller provides.  For runtime variables that's the
+variable name plus the version counter Runtimes bumps on every change, so a stale
+tree is never returned.  Without a key, the xml string itself is the key.
+
+Eviction is least recently used, bounded by the total size of the cached documents.
+"""
+
+from collections import OrderedDict
+
+from catocommon import catocommon
+
+# total characters of xml held in the cache
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+
+class DocumentCache(object):
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._docs = OrderedDict()
+        self._paths = {}
+
+    def get(self, xml, key=None):
+        """Returns the parsed root element of xml.  Raises whatever ElementTree raises on bad xml."""
+        if key is None:
+            key = xml
+
+        try:
+            root, size = self._docs.pop(key)
+            # re-inserting makes it the most recently used
+            self._docs[key] = (root, size)
+            self.hits += 1
+            return root
+        except KeyError:
+            pass
+
+        self.misses += 1
+        # (xml can be a spilled command output, only read now that it's needed)
+        root = catocommon.ET.fromstring(xml if isinstance(xml, basestring) else str(xml))
+        size = len(xml)
+        if size > self.max_size:
+            # bigger than the whole cache, don't bother
+            return root
+
+        self._docs[key] = (root, size)
+        self.size += size
+        while self.size > self.max_size:
+            k, (r, s) = self._docs.popitem(last=False)
+            self.size -= s
+
+        return root
+
+    def compile_path(self, path):
+        """
+        Normalizes an xpath as used in variable references, once per distinct path.
+
+        Returns a tuple of (path, index, is_count), where path is ready for findall,
+        index is the zero based match to return, and is_count means count(path) was asked for.
+        (ElementTree caches its own compiled form of the normalized path.)
+        """
+        try:
+            return self._paths[path]
+        except KeyError:
+            pass
+
+        if path.startswith("count(") and path.endswith(")"):
+            compiled = ("." + path[6:-1], 0, True)
+        else:
+            p = "." + path
+            index = 0
+            if "," in p:
+                comma = p.find(",")
+                index = int(p[comma + 1:]) - 1
+                p = p[:comma]
+            compiled = (p.strip(), index, False)
+
+        self._paths[path] = compiled
+        return compiled
+
+    def clear(self):
+        self._docs.clear()
+        self.size = 0
@@ -0,0 +1,353 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+The http client for the http command.
+
+urllib2.urlopen opens (and for https, handshakes) a new connection for every request,
+and a task polling a REST endpoint in a loop does a LOT of requests to the same host.
+
+Here, finished connections go back in a pool for their (scheme, host, port, proxy), and the
+next request to the same place picks one up.  The pools belong to the process, so every step
+of a task (and every task a pooled Task Engine process runs) shares them.  Idle connections
+are thrown away after a while, and a reused connection the server has already closed is
+quietly replaced.
+
+Otherwise it does what urlopen did, so existing tasks don't notice:
+    - redirects are followed the same way (at most 10, a POST becomes a GET)
+    - the http_proxy/https_proxy/no_proxy environment variables are honored
+    - anything but a 2xx is an error status, with the body still available
+
+On top of that it asks for gzip/deflate (unless the step sets it's own Accept-Encoding)
+and unpacks it, and the body can be written to any object with a write() method as it's
+read, like a SpillFile.
+"""
+
+import sys
+import time
+import zlib
+import base64
+import select
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+
+# how many times to follow a redirect, same as urllib2
+MAX_REDIRECTS = 10
+READ_SIZE = 65536
+# what urllib2 sends, some apis want one
+USER_AGENT = "Python-urllib/%s" % sys.version[:3]
+
+# a request with one of these methods can safely be sent again if we don't know whether it arrived
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+_pools = {}
+_lock = threading.Lock()
+
+
+class HTTPClientError(Exception):
+    """The request couldn't be made at all (no response), reason is what urllib2 would have said."""
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+class Response(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.reason = ""
+        # an httplib.HTTPMessage, same as urllib2 gave
+        self.headers = None
+        self.body = ""
+        self.redirects = 0
+        self.reused = False
+        # milliseconds, and bytes as they came over the wire
+        self.connect_ms = 0
+        self.first_byte_ms = 0
+        # from the start until the final response's headers are in (what urlopen() used to take),
+        # and until the whole body has been read
+        self.response_ms = 0
+        self.total_ms = 0
+        self.bytes = 0
+        self.headers_at = None
+
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def timings(self):
+        return {"connect_ms": self.connect_ms, "first_byte_ms": self.first_byte_ms, "response_ms": self.response_ms,
+                "total_ms": self.total_ms,
+                "bytes": self.bytes, "reused": self.reused, "redirects": self.redirects}
+
+
+def _ms(seconds):
+    return int(round(seconds * 1000))
+
+
+def _proxy_for(scheme, host):
+    """the proxy (host, port, auth header) to use, or None"""
+    proxy = urllib.getproxies().get(scheme)
+    if not proxy or urllib.proxy_bypass(host):
+        return None
+    p = urlparse.urlparse(proxy if "://" in proxy else "http://" + proxy)
+    auth = None
+    if p.username:
+        auth = "Basic " + base64.b64encode("%s:%s" % (urllib.unquote(p.username), urllib.unquote(p.password or "")))
+    return p.hostname, p.port or 80, auth
+
+
+def _closed_by_server(conn):
+    """An idle connection has nothing to read... unless the server closed it (or it's broken)."""
+    if not conn.sock:
+        return True
+    try:
+        readable = select.select([conn.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+def _checkout(key, pool_size, idle):
+    """an idle connection from the pool, or None.  Anything idle too long, or closed by the server, is closed."""
+    now = time.time()
+    with _lock:
+        conns = _pools.get(key)
+        while conns:
+            conn, last_used = conns.pop()
+            if now - last_used < idle and not _closed_by_server(conn):
+                return conn
+            conn.close()
+    return None
+
+
+def _checkin(key, conn, pool_size):
+    with _lock:
+        conns = _pools.setdefault(key, [])
+        if len(conns) < pool_size:
+            conns.append((conn, time.time()))
+            return
+    conn.close()
+
+
+def close_all():
+    """Closes every idle connection in every pool."""
+    with _lock:
+        for conns in _pools.values():
+            for conn, _ in conns:
+                conn.close()
+        _pools.clear()
+
+
+def _new_connection(scheme, host, port, proxy, timeout):
+    if proxy:
+        phost, pport, auth = proxy
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(phost, pport, timeout=timeout)
+            conn.set_tunnel(host, port, {"Proxy-Authorization": auth} if auth else None)
+        else:
+            conn = httplib.HTTPConnection(phost, pport, timeout=timeout)
+    elif scheme == "https":
+        conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+    else:
+        conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    return conn
+
+
+class _Decoder(object):
+    """unpacks a gzip or deflate body a chunk at a time"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.d = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+        self.first = True
+
+    def decode(self, data):
+        if self.first and self.encoding == "deflate":
+            self.first = False
+            try:
+                return self.d.decompress(data)
+            except zlib.error:
+                # plenty of servers send raw deflate, without the zlib header
+                self.d = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.d.decompress(data)
+
+    def flush(self):
+        return self.d.flush()
+
+
+def _send(method, url, data, headers, timeout, pool_size, idle, sink, response):
+    """One request, no redirects.  Fills in response, writes the body to sink."""
+    u = urlparse.urlsplit(url)
+    scheme = u.scheme.lower()
+    if scheme not in ("http", "https"):
+        raise HTTPClientError("unknown url type: %s" % (scheme))
+    if not u.hostname:
+        raise HTTPClientError("no host given")
+    port = u.port or (443 if scheme == "https" else 80)
+    proxy = _proxy_for(scheme, u.hostname)
+
+    path = u.path or "/"
+    if u.query:
+        path += "?" + u.query
+    if proxy and scheme == "http":
+        # a plain http proxy gets the whole url
+        path = urlparse.urlunsplit((scheme, u.netloc, u.path or "/", u.query, ""))
+        if proxy[2]:
+            headers = dict(headers, **{"Proxy-Authorization": proxy[2]})
+
+    key = (scheme, u.hostname, port, proxy)
+    ask_compressed = "accept-encoding" not in [k.lower() for k in headers]
+
+    # a reused connection might have been closed by the server while it was idle -
+    # if so it fails before there's any response, and we go again on a new one.
+    # But once the request has gone out, the server may have acted on it, so only
+    # an idempotent request is sent again.
+    for attempt in range(2):
+        sent = None
+        start = time.time()
+        conn = _checkout(key, pool_size, idle) if pool_size and attempt == 0 else None
+        response.reused = conn is not None
+        if not conn:
+            conn = _new_connection(scheme, u.hostname, port, proxy, timeout)
+            try:
+                conn.connect()
+            except socket.timeout:
+                conn.close()
+                raise HTTPClientError("timed out")
+            except (socket.error, httplib.HTTPException) as ex:
+                conn.close()
+                raise HTTPClientError(str(ex))
+        else:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+        response.connect_ms = _ms(time.time() - start)
+
+        try:
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            for k, v in headers.iteritems():
+                conn.putheader(k, v)
+            if ask_compressed:
+                conn.putheader("Accept-Encoding", "gzip, deflate")
+            if "user-agent" not in [k.lower() for k in headers]:
+                conn.putheader("User-Agent", USER_AGENT)
+            if data is not None:
+                conn.putheader("Content-Length", str(len(data)))
+                if "content-type" not in [k.lower() for k in headers]:
+                    # urllib2 did this for any request with data
+                    conn.putheader("Content-Type", "application/x-www-form-urlencoded")
+            if not pool_size:
+                conn.putheader("Connection", "close")
+            conn.endheaders(data)
+            sent = time.time()
+            r = conn.getresponse()
+            break
+        except socket.timeout:
+            conn.close()
+            raise HTTPClientError("timed out")
+        except (socket.error, httplib.HTTPException) as ex:
+            conn.close()
+            if response.reused and (sent is None or method in IDEMPOTENT_METHODS):
+                continue
+            raise HTTPClientError(str(ex))
+
+    response.headers_at = time.time()
+    response.first_byte_ms = _ms(response.headers_at - sent)
+    response.status = r.status
+    response.reason = r.reason
+    response.headers = r.msg
+
+    encoding = (r.getheader("content-encoding") or "").lower()
+    decoder = _Decoder(encoding) if ask_compressed and encoding in ("gzip", "deflate") else None
+    try:
+        while True:
+            chunk = r.read(READ_SIZE)
+            if not chunk:
+                break
+            response.bytes += len(chunk)
+            sink.write(decoder.decode(chunk) if decoder else chunk)
+        if decoder:
+            sink.write(decoder.flush())
+    except Exception:
+        conn.close()
+        raise
+
+    if pool_size and not r.will_close:
+        _checkin(key, conn, pool_size)
+    else:
+        conn.close()
+
+
+class _Buffer(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def result(self):
+        return "".join(self.chunks)
+
+
+def request(method, url, data=None, headers=None, timeout=10, pool_size=4, idle=60, new_sink=None):
+    """
+    Makes a request, following redirects, and returns a Response.
+    Raises HTTPClientError if there was no response at all.
+
+    new_sink returns an object to write the body to, with a result() that returns the body.
+    By default the body is just a string.  pool_size 0 means no connection is kept.
+    """
+    headers = dict(headers or {})
+    new_sink = new_sink or _Buffer
+    response = Response(url)
+    start = time.time()
+
+    while True:
+        sink = new_sink()
+        try:
+            _send(method, url, data, headers, timeout, pool_size, idle, sink, response)
+            location = response.headers.getheader("location") or response.headers.getheader("uri")
+            if not location or response.status not in (301, 302, 303, 307):
+                response.body = sink.result()
+                break
+            if not (method in ("GET", "HEAD") or (method == "POST" and response.status != 307)):
+                # urllib2 doesn't redirect these either, it's an error status
+                response.body = sink.result()
+                break
+            if response.redirects >= MAX_REDIRECTS:
+                response.body = sink.result()
+                break
+        finally:
+            # a SpillFile's result() already owns the file, this only cleans up a redirect body or a failure
+            if hasattr(sink, "discard"):
+                sink.discard()
+
+        # off we go to the new location... same as urllib2, it's a GET without the data
+        url = urlparse.urljoin(url, location)
+        response.url = url
+        response.redirects += 1
+        method = "GET"
+        data = None
+        headers = dict((k, v) for k, v in headers.iteritems() if k.lower() not in ("content-length", "content-type"))
+
+    response.response_ms = _ms(response.headers_at - start)
+    response.total_ms = _ms(time.time() - start)
+    return response
@@ -0,0 +1,298 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Parallel branches, for the parallel command.
+
+Also used by the foreach command, where every item is a branch running the same action.
+
+Each branch runs on a worker thread, on a copy of the Task Engine.  The copy has:
+    - it's own copy of the runtime variables
+    - it's own database connection (one per worker thread, not per branch)
+    - it's own connections dict, starting with the ones that were already open
+        (two branches using the same open connection at the same time is asking for trouble!)
+    - it's own copies of the cloud connections and the compiled step plans
+    - a branch label, which goes on every task log row it writes
+
+Everything else (the task, the task log writer, the logger, the completion listener) is shared.
+
+When every branch is finished, in 'merged' mode the variables, connections, task handles
+and summary items each successful branch changed are copied back, in branch order - so if
+two branches set the same variable, the last branch wins.  In 'isolated' mode all of that
+is thrown away, and only the results are kept.
+
+Commands are mostly waiting on something (a remote host, an api, a database),
+which is why threads are plenty here.
+"""
+
+import copy
+import time
+import Queue
+import threading
+import traceback
+
+from . import doccache
+from . import completion
+
+
+class Branch(object):
+
+    def __init__(self, index, codeblock=None, step=None, label=None):
+        self.index = index
+        self.codeblock = codeblock
+        # an embedded action, instead of a codeblock
+        self.step = step
+        self.label = label or "branch %d%s" % (index, " " + codeblock if codeblock else "")
+
+        # (name, value) set in the branch's variables before it starts
+        self.variables = []
+        # seconds the branch may run, checked before each step
+        self.timeout = None
+        # when it's time is up, set when it starts
+        self.deadline = None
+        # run_branches stopped waiting on it, whatever it does now is thrown away
+        self.abandoned = False
+        # the name of a variable to get from the branch when it's done, in value
+        self.collect = None
+        self.value = ""
+
+        self.status = "Pending"
+        self.error = None
+        self.seconds = 0.0
+        # the end command was run in this branch
+        self.exit = False
+        self.engine = None
+        # the branch's (database, remote, output) step profile totals, added to the parallel step's
+        self.prof = None
+
+    def result(self):
+        return {"branch": self.index, "codeblock": self.codeblock or "", "status": self.status,
+                "error": self.error or "", "seconds": round(self.seconds, 3)}
+
+
+def _new_connections(te, b):
+    """the connections a branch engine opened itself"""
+    return [n for n, c in b.connections.items() if te.connections.get(n) is not c]
+
+
+def _branch_engine(te, branch, base_rt, db):
+    b = copy.copy(te)
+    b.branch = branch.label
+    b.rt = base_rt.copy()
+    b.loop_break = False
+    # the branch's own totals, run_branches adds them to the step that started it
+    b.prof_db = b.prof_remote = 0.0
+    b.prof_output = 0
+    b.doc_cache = doccache.DocumentCache()
+    b.connections = dict(te.connections)
+    b.task_handles = dict(te.task_handles)
+    b.mysql_conns = dict(te.mysql_conns)
+    b.cloud_conns = dict(te.cloud_conns)
+    b.step_plans = dict(te.step_plans)
+    # awspy connections aren't made to be used from more than one thread
+    b.aws_conns = {}
+    b.db = db
+    b.deadline = branch.deadline
+    for name, value in branch.variables:
+        b.rt.set(name, value)
+    return b
+
+
+def _run_branch(te, task, branch, base_rt, merge, db, lock):
+    start = time.time()
+    with lock:
+        branch.status = "Running"
+        if branch.timeout:
+            branch.deadline = start + branch.timeout
+
+    b = None
+    status, error, value, exit = "Completed", None, "", False
+    try:
+        b = branch.engine = _branch_engine(te, branch, base_rt, db)
+        b.insert_audit("parallel", "Starting.", "")
+        if branch.step:
+            b.process_step(task, branch.step)
+        else:
+            b.process_codeblock(task, branch.codeblock)
+        if branch.collect:
+            value = b.rt.get(branch.collect)
+    except SystemExit:
+        # the end command, the status is already set
+        exit = True
+    except Exception as ex:
+        status = "Error"
+        error = str(ex)
+        te.logger.error("[%s] %s" % (branch.label, traceback.format_exc()))
+    finally:
+        seconds = time.time() - start
+        with lock:
+            if not branch.abandoned:
+                if branch.deadline and time.time() > branch.deadline:
+                    # finished, but too late - it's a timeout, and nothing it did counts
+                    if status == "Completed":
+                        error = "Finished after the %s second time limit." % (branch.timeout)
+                    status, value, exit = "Timeout", "", False
+                branch.status, branch.error, branch.value, branch.exit = status, error, value, exit
+                branch.seconds = seconds
+
+        if b:
+            branch.prof = (b.prof_db, b.prof_remote, b.prof_output)
+            # anything this branch opened that won't be merged back is closed here
+            if not merge or branch.status != "Completed":
+                for name in _new_connections(te, b):
+                    b.drop_connection(name)
+            if not merge:
+                # nothing more is needed from it
+                branch.engine = None
+
+
+def _merge(te, branches, base_rt):
+    """copies what each successful branch changed back into te, in branch order"""
+    changed_by = {}
+    base_summary = te.summary
+    for branch in branches:
+        b = branch.engine
+        if not b or branch.status != "Completed":
+            continue
+
+        for name in te.rt.merge(b.rt, base_rt):
+            changed_by.setdefault(name, []).append(branch.index)
+
+        for name in _new_connections(te, b):
+            if name in te.connections:
+                te.drop_connection(name)
+            te.connections[name] = b.connections[name]
+
+        for name, h in b.task_handles.iteritems():
+            if te.task_handles.get(name) is not h:
+                te.task_handles[name] = h
+
+        # summary items the branch added
+        te.summary += b.summary[len(base_summary):]
+
+    for name, indexes in sorted(changed_by.iteritems()):
+        if len(indexes) > 1:
+            te.insert_audit("parallel", "Variable [%s] was changed by branches %s, the value from branch %d is kept."
+                % (name, ", ".join(str(i) for i in indexes), indexes[-1]), "")
+
+
+def run_branches(te, task, branches, workers, merge=False):
+    """
+    Runs the branches, at most workers at a time, and waits for all of them.
+    Each Branch has it's status, error and timing when this returns.
+    """
+    # what every branch starts from, and what the changes are measured against when merging
+    base_rt = te.rt.copy()
+
+    # one listener for everybody, the branches can't each bind the task instance's socket
+    if not te.completion_listener:
+        te.completion_listener = completion.CompletionListener(te.task_instance)
+
+    q = Queue.Queue()
+    for branch in branches:
+        q.put(branch)
+
+    lock = threading.Lock()
+    # set whenever a branch finishes
+    finished = threading.Event()
+
+    def work():
+        db = None
+        try:
+            while True:
+                try:
+                    branch = q.get_nowait()
+                except Queue.Empty:
+                    return
+                if not db:
+                    db = te.new_db_conn()
+                _run_branch(te, task, branch, base_rt, merge, db, lock)
+                finished.set()
+                if branch.abandoned:
+                    # another thread took over the queue when this one was given up on
+                    return
+        except Exception as ex:
+            # couldn't even get a database connection, whatever is left fails
+            te.logger.error(traceback.format_exc())
+            while True:
+                try:
+                    branch = q.get_nowait()
+                except Queue.Empty:
+                    break
+                branch.status = "Error"
+                branch.error = str(ex)
+            finished.set()
+        finally:
+            if db:
+                try:
+                    db.close()
+                except Exception:
+                    pass
+
+    def start_worker():
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+
+    for _ in range(max(min(workers, len(branches)), 1)):
+        start_worker()
+
+    while True:
+        finished.clear()
+        with lock:
+            now = time.time()
+            for branch in branches:
+                if branch.status == "Running" and branch.deadline and now > branch.deadline:
+                    # stop waiting on it.  It stops itself before it's next step (see process_step),
+                    # but a long running command could take a while yet.
+                    branch.abandoned = True
+                    branch.status = "Timeout"
+                    branch.error = "Still running after the %s second time limit." % (branch.timeout)
+                    branch.seconds = now - (branch.deadline - branch.timeout)
+                    if not q.empty():
+                        start_worker()
+            running = [b for b in branches if b.status in ("Pending", "Running")]
+            deadlines = [b.deadline for b in running if b.deadline]
+        if not running:
+            break
+        # a timeout, so the main thread can still be interrupted
+        finished.wait(max(min([1.0] + [d - now for d in deadlines]), 0.01))
+
+    # the database and remote time of every branch counts towards the parallel step
+    # (so with several branches at once it can add up to more than the step took)
+    for branch in branches:
+        if branch.prof and not branch.abandoned:
+            te.prof_db += branch.prof[0]
+            te.prof_remote += branch.prof[1]
+            te.prof_output += branch.prof[2]
+
+    if merge:
+        _merge(te, branches, base_rt)
+
+    for branch in branches:
+        branch.engine = None
+
+    if any(branch.exit for branch in branches):
+        raise SystemExit()
+
+    return branches
+
+
+def summarize(branches, seconds):
+    """A task log message with how each branch went."""
+    failed = len([b for b in branches if b.status != "Completed"])
+    lines = ["%-30s %-10s %8.3fs %s" % (b.label, b.status, b.seconds, b.error or "") for b in branches]
+    return "%d branches finished in %.3f seconds, %d failed.\n%s" % (len(branches), seconds, failed, "\n".join(lines))
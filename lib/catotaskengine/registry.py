@@ -0,0 +1,126 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+The commands a Task Engine can run, by name.
+
+Built-in commands are the *_cmd functions in commands.py.  Extension commands are declared
+in the xml files in each extension path - the same files the UI loads the command toolbox from:
+
+    <function name="s3_copy_file" extension="aws_s3.aws_s3">
+
+A step carries that extension attribute too, and when it does, it's what the step runs.
+The scanned names are for steps without one.
+
+The extension paths are scanned once, when the Task Engine starts, so running a step is a
+dict lookup instead of an import and a getattr every time.  An extension module still isn't
+imported until one of it's commands is actually used (some of them import a lot), but after
+that the function itself is kept.
+
+The scan is kept for the life of the process, so a pooled Task Engine worker doesn't do it
+for every task.  An extension installed while a worker is running is picked up when the
+worker is recycled.
+"""
+
+import os
+import threading
+
+from catocommon import catocommon
+from . import commands
+
+# these never change, so only once per process
+BUILTINS = dict((n[:-4], f) for n, f in vars(commands).iteritems() if n.endswith("_cmd") and callable(f))
+
+# extension path -> {command name: module name}
+_manifests = {}
+_lock = threading.Lock()
+
+
+def scan(path):
+    """{command name: module name} for every extension command declared in the xml files under path."""
+    found = {}
+    for root, subdirs, files in os.walk(path):
+        for f in sorted(files):
+            if os.path.splitext(f)[-1] != ".xml":
+                continue
+            try:
+                xroot = catocommon.ET.parse(os.path.join(root, f)).getroot()
+            except Exception:
+                # same as the UI, a bad file is skipped, it doesn't stop everything else
+                continue
+            for func in xroot.iter("function"):
+                name = func.get("name")
+                mod = func.get("extension")
+                if name and mod:
+                    found.setdefault(name, mod)
+    return found
+
+
+def _manifest(path):
+    with _lock:
+        m = _manifests.get(path)
+        if m is None:
+            m = _manifests[path] = scan(path)
+        return m
+
+
+class CommandRegistry(object):
+
+    def __init__(self, extension_paths):
+        self.builtins = BUILTINS
+        # command name -> module name
+        self.extensions = {}
+        for path in extension_paths:
+            for name, mod in _manifest(path).iteritems():
+                self.extensions.setdefault(name, mod)
+        # (module name, command name) -> function, once it's been imported
+        self.functions = {}
+
+    def builtin(self, name):
+        """The built-in command function, or None."""
+        return self.builtins.get(name)
+
+    def extension(self, name, modname=None):
+        """
+        The extension command function.  Raises an Exception if there isn't one.
+
+        modname is the step's own extension attribute - that's what the step was built from, so
+        it wins.  The scanned xml is only for a step that doesn't say (and two extensions can
+        declare the same command, the first one found there is used).
+        """
+        if not modname:
+            modname = self.extensions.get(name)
+            if not modname:
+                raise Exception("[%s] is not a built-in command, and none of the configured extensions define it." % (name))
+
+        key = (modname, name)
+        func = self.functions.get(key)
+        if func:
+            return func
+
+        try:
+            mod = __import__(modname, fromlist=[''])
+        except ImportError as ex:
+            raise Exception("Extension module [%s] for command [%s] could not be imported.\n%s" % (modname, name, ex))
+
+        func = getattr(mod, name, None)
+        if not func:
+            raise Exception("Extension [%s] found, but method [%s] not found." % (modname, name))
+        if not callable(func):
+            raise Exception("Extension [%s] found, method [%s] found, but not callable." % (modname, name))
+
+        self.functions[key] = func
+        return func
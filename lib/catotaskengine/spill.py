@@ -0,0 +1,191 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Streaming capture of command output.
+
+cmd_line and winrm_cmd used to hold the entire output of a command in memory (more than once),
+which doesn't go well when a command dumps a big log or a database extract.
+
+A SpillFile collects output as it's read.  Small output stays in memory and comes back
+as a plain string, exactly like before.  Once it's bigger than the threshold it goes
+to a file in the task instance's spill directory, and comes back as a SpillBuffer - a
+read only, memory mapped view of the file.
+
+A SpillBuffer can be used most places a string can (str() reads the whole thing),
+but process_buffer reads it a row at a time, and the task log only gets the head and tail.
+
+A result variable holds the SpillBuffer itself, so the output isn't read into memory just
+because it was kept.  It's only made a string when something gets the variable's value
+(see runtimes._text), and it's closed when the task is done.
+"""
+
+import os
+import mmap
+import tempfile
+
+# how much of the end of the output is kept in memory, to look for the prompt in
+MATCH_WINDOW = 65536
+
+
+class SpillFile(object):
+
+    def __init__(self, directory, threshold, exact=False):
+        """exact keeps everything as it was written - by default trailing newlines are dropped, like command output."""
+        self.directory = directory
+        self.threshold = threshold
+        self.exact = exact
+        self.chunks = []
+        self.size = 0
+        self.f = None
+        self.path = None
+        # trailing newlines aren't written until we know more output follows, the result is always rstrip("\n")'d
+        self.newlines = ""
+        # a CR at the end of a chunk might be the start of a CRLF
+        self.cr = False
+        self.crlf = False
+
+    def normalize_crlf(self):
+        """replace CRLF with LF in everything written from now on, even across chunks"""
+        self.crlf = True
+
+    def write(self, data):
+        if not data:
+            return
+        if self.exact:
+            self._write(data)
+            return
+
+        if self.crlf:
+            if self.cr:
+                data = "\r" + data
+                self.cr = False
+            data = data.replace("\r\n", "\n")
+            if data.endswith("\r"):
+                data = data[:-1]
+                self.cr = True
+                if not data:
+                    return
+
+        stripped = data.rstrip("\n")
+        if not stripped:
+            self.newlines += data
+            return
+
+        self._write(self.newlines + stripped)
+        self.newlines = data[len(stripped):]
+
+    def _write(self, data):
+        self.size += len(data)
+        if self.f:
+            self.f.write(data)
+            return
+
+        self.chunks.append(data)
+        if self.threshold and self.size > self.threshold:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, self.path = tempfile.mkstemp(suffix=".out", dir=self.directory)
+            self.f = os.fdopen(fd, "wb")
+            for c in self.chunks:
+                self.f.write(c)
+            self.chunks = None
+
+    def result(self):
+        """A string, or a SpillBuffer if the output went to a file."""
+        if self.cr:
+            self._write(self.newlines + "\r")
+            self.newlines = ""
+            self.cr = False
+
+        if self.f:
+            self.f.close()
+            self.f = None
+            # the file belongs to the SpillBuffer now
+            path = self.path
+            self.path = None
+            return SpillBuffer(path)
+        return "".join(self.chunks)
+
+    def discard(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class SpillBuffer(object):
+    """Read only, memory mapped command output.  The file goes away when the buffer is closed."""
+
+    # runtime variables only read it into a string when the value is asked for
+    lazy_text = True
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.mm.size()
+
+    def __str__(self):
+        return self.mm[:]
+
+    def __getitem__(self, key):
+        return self.mm[key]
+
+    def find(self, sub, start=0):
+        return self.mm.find(sub, start)
+
+    def head(self, n):
+        return self.mm[:n]
+
+    def tail(self, n):
+        return self.mm[max(len(self) - n, 0):]
+
+    def rows(self, delimiter):
+        """Yields the rows one at a time, the same as str.split(delimiter) would return them."""
+        if not delimiter:
+            raise ValueError("empty separator")
+        pos = 0
+        dlen = len(delimiter)
+        while True:
+            ii = self.mm.find(delimiter, pos)
+            if ii == -1:
+                yield self.mm[pos:]
+                break
+            yield self.mm[pos:ii]
+            pos = ii + dlen
+
+    def close(self):
+        try:
+            self.mm.close()
+            self.f.close()
+            os.unlink(self.path)
+        except Exception:
+            pass
+
+
+def summarize(buff, limit):
+    """The head and tail of a SpillBuffer, for the task log."""
+    if len(buff) <= limit:
+        return str(buff)
+    half = limit // 2
+    return "%s\n... [%d bytes not logged] ...\n%s" % (buff.head(half), len(buff) - half * 2, buff.tail(half))
@@ -0,0 +1,108 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Shared ssh connections, using OpenSSH connection multiplexing (ControlMaster / ControlPersist).
+
+The first ssh to a host starts a master connection in the background, and every later
+ssh to the same host, as the same user with the same credentials, just opens a new
+session over it - no tcp connect, no key exchange, no authentication.  Any Task Engine
+on this node can use a master, no matter which one started it.
+
+Masters are identified by a hash of (host, user, key, password), so a task can never
+ride on a connection somebody else authenticated with different credentials.
+OpenSSH itself handles two Task Engines starting the same master at once, and shuts
+a master down once it's been idle for the ControlPersist time.
+
+The number of masters on the node is bounded.  When the pool is full, a new host just
+gets a regular, unshared ssh connection.
+"""
+
+import os
+import errno
+import socket
+import hashlib
+
+from catoconfig import catoconfig
+
+
+def pool_dir():
+    return os.path.join(catoconfig.CONFIG["tmpdir"], "cato_ssh")
+
+
+def control_path(host, user, key=None, password=None):
+    # short and fixed length - a unix socket path can't be very long
+    h = hashlib.sha1("\0".join([host or "", user or "", key or "", password or ""])).hexdigest()[:24]
+    return os.path.join(pool_dir(), h)
+
+
+def is_alive(path):
+    """Is there a master listening on this control socket?"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def live_masters():
+    """The number of live masters.  Sockets left behind by dead ones are cleaned up along the way."""
+    d = pool_dir()
+    n = 0
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return 0
+
+    for name in names:
+        path = os.path.join(d, name)
+        if is_alive(path):
+            n += 1
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return n
+
+
+def ssh_options(host, user, key=None, password=None, max_masters=10, idle=300):
+    """
+    The ssh command line options to use a shared connection.
+
+    Returns (options, shared) - shared is True if a live master is already there,
+    so no authentication will happen.  options is empty if the pool is full.
+    """
+    d = pool_dir()
+    try:
+        os.makedirs(d, 0700)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+    path = control_path(host, user, key, password)
+    opts = "-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%d" % (path, idle)
+
+    if is_alive(path):
+        return opts, True
+
+    if live_masters() >= max_masters:
+        return "", False
+
+    return opts, False
@@ -0,0 +1,180 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Per step timing for a task instance.
+
+The Task Engine records every step it runs: wall time, time spent in the cato database,
+time spent waiting on something remote (a command on a host, an http call, an aws call),
+and how many bytes of output came back.
+
+A step in a loop might run 50,000 times, so there's no row per execution.  Each step gets
+one row per task instance, with totals and a histogram of the wall times.  The histogram
+buckets are small enough (4 per doubling, about 19% wide) that adding up the histograms for
+a step across any number of instances still gives a decent p50/p95.
+
+All of a task instance's rows are written at once, when it finishes.
+
+StartupTimer is the same idea for what happens before the first step, it only goes in the log.
+
+This module is also used outside the Task Engine to read the histograms back, so it
+shouldn't import anything heavy.
+"""
+
+import math
+import time
+import threading
+
+# buckets for every doubling of milliseconds
+BUCKETS_PER_DOUBLING = 4
+
+INSERT_SQL = """insert into task_instance_step_profile
+    (task_instance, step_id, function_name, exec_count, wall_ms, max_wall_ms, db_ms, remote_ms, output_bytes, histogram)
+    values """
+ROW_SQL = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+# rows per insert
+BATCH_SIZE = 200
+
+
+def bucket(ms):
+    """the histogram bucket for a number of milliseconds"""
+    if ms < 1:
+        return 0
+    return 1 + int(math.log(ms, 2) * BUCKETS_PER_DOUBLING)
+
+
+def bucket_bounds(b):
+    """the (low, high) milliseconds of a bucket"""
+    if b == 0:
+        return 0.0, 1.0
+    return 2 ** ((b - 1) / float(BUCKETS_PER_DOUBLING)), 2 ** (b / float(BUCKETS_PER_DOUBLING))
+
+
+def encode_histogram(hist):
+    """'bucket:count,...' - only the buckets with something in them"""
+    return ",".join("%d:%d" % (b, n) for b, n in sorted(hist.iteritems()))
+
+
+def decode_histogram(s, into=None):
+    """the reverse of encode_histogram, added into an existing histogram if one is provided"""
+    hist = into if into is not None else {}
+    for pair in (s or "").split(","):
+        if pair:
+            b, n = pair.split(":")
+            hist[int(b)] = hist.get(int(b), 0) + int(n)
+    return hist
+
+
+def percentile(hist, p, max_ms=None):
+    """
+    Estimates the p (0-100) percentile in milliseconds from a histogram.
+    It's the middle of the bucket it falls in, but never more than max_ms if that's known.
+    """
+    total = sum(hist.itervalues())
+    if not total:
+        return 0
+    want = total * p / 100.0
+    seen = 0
+    for b in sorted(hist):
+        seen += hist[b]
+        if seen >= want:
+            lo, hi = bucket_bounds(b)
+            ms = (lo + hi) / 2.0 if b == 0 else math.sqrt(lo * hi)
+            if max_ms is not None:
+                ms = min(ms, max_ms)
+            return int(round(ms))
+    return max_ms or 0
+
+
+class StepStats(object):
+    __slots__ = ("count", "wall", "max_wall", "db", "remote", "output_bytes", "hist")
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.max_wall = 0.0
+        self.db = 0.0
+        self.remote = 0.0
+        self.output_bytes = 0
+        self.hist = {}
+
+    def add(self, wall, db, remote, output_bytes):
+        self.count += 1
+        self.wall += wall
+        self.max_wall = max(self.max_wall, wall)
+        self.db += db
+        self.remote += remote
+        self.output_bytes += output_bytes
+        b = bucket(wall * 1000)
+        self.hist[b] = self.hist.get(b, 0) + 1
+
+
+class StepProfiler(object):
+    """Collects StepStats by (step id, function name).  Parallel branches share one, so it's locked."""
+
+    def __init__(self):
+        self.steps = {}
+        self.lock = threading.Lock()
+
+    def record(self, step_id, function_name, wall, db, remote, output_bytes):
+        key = (step_id, function_name)
+        with self.lock:
+            s = self.steps.get(key)
+            if s is None:
+                s = self.steps[key] = StepStats()
+            s.add(wall, db, remote, output_bytes)
+
+    def rows(self, task_instance):
+        with self.lock:
+            items = sorted(self.steps.items())
+        return [(task_instance, step_id, function_name, s.count, int(s.wall * 1000), int(s.max_wall * 1000),
+                 int(s.db * 1000), int(s.remote * 1000), s.output_bytes, encode_histogram(s.hist))
+                for (step_id, function_name), s in items]
+
+    def write(self, exec_db, task_instance):
+        """Replaces this task instance's profile rows with what's been collected, in batches."""
+        rows = self.rows(task_instance)
+        if not rows:
+            return
+        # a resubmitted instance starts over
+        exec_db("delete from task_instance_step_profile where task_instance = %s", (task_instance))
+        for ii in range(0, len(rows), BATCH_SIZE):
+            batch = rows[ii:ii + BATCH_SIZE]
+            params = []
+            for r in batch:
+                params.extend(r)
+            exec_db(INSERT_SQL + ",".join([ROW_SQL] * len(batch)), params)
+
+
+class StartupTimer(object):
+    """How long each phase of Task Engine startup took.  mark() ends a phase and starts the next."""
+
+    def __init__(self):
+        self.started = self.last = time.time()
+        self.phases = []
+
+    def add(self, phase, seconds):
+        """a phase that happened before this timer was created"""
+        self.phases.append((phase, seconds))
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def summary(self):
+        total = sum(seconds for _, seconds in self.phases)
+        return "Startup took %.3f seconds: %s" % (total, ", ".join("%s %.3f" % p for p in self.phases))
@@ -0,0 +1,341 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+Compiled variable templates, used by TaskEngine.replace_variables.
+
+The original replacement routines (replace_vars_new and replace_vars) find one variable
+at a time and str.replace it across the whole string, then start over.  That's fine for
+a short command, but it's quadratic on big buffers with lots of references.
+
+Here a string is split ONCE into literal text and variable references, and the compiled
+form is cached by string.  Rendering is a single pass.
+
+The two syntaxes are still handled in two separate phases, exactly like replace_variables
+always has:  first all the [$ $] references, then all the [[ ]] references.
+
+Anything that can't be compiled with *exactly* the legacy semantics (unclosed or empty
+references, a reference broken across lines, nested values that contain brackets)
+raises Unsafe, and the caller falls back to the legacy routine for that phase.
+
+Test expressions (IF and WHILE) get one more step - see compile_test.
+"""
+
+import re
+import token
+import tokenize
+import StringIO
+
+DOLLAR = ("[$", "$]")
+BRACKET = ("[[", "]]")
+
+# these are the tests replace_variables has always used to decide if there's more to do.
+# NOTE: no DOTALL, so the opener and closer have to be on the same line.
+DOLLAR_RE = re.compile(".*\[\$.*\$\]")
+BRACKET_RE = re.compile(".*\[\[.*\]\]")
+
+# big buffers are still compiled, just not kept around
+MAX_CACHED_LENGTH = 65536
+MAX_CACHED_TEMPLATES = 5000
+
+_cache = {}
+
+
+class Unsafe(Exception):
+    """The string can't be compiled with the legacy semantics, use the legacy routine."""
+    pass
+
+
+class Ref(object):
+    """A variable reference.  The name is itself a list of nodes, since references can be nested."""
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Template(object):
+    """
+    A compiled string for one phase of variable replacement.
+
+    nodes is a list of literal strings and Ref objects.
+    """
+    __slots__ = ("nodes", "static")
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        # nothing to replace at all - render is a no-op
+        self.static = not any(isinstance(n, Ref) for n in nodes)
+
+    def render(self, resolve):
+        """
+        Renders the template in one pass.  resolve(name) returns the value for a variable name.
+
+        Every distinct reference is resolved only once per render, just like the legacy
+        str.replace did (which is why [[_UUID]] twice in one string is the same uuid).
+        """
+        if self.static:
+            return "".join(self.nodes)
+
+        memo = {}
+        return "".join(_render_nodes(self.nodes, resolve, memo, False))
+
+
+def _render_nodes(nodes, resolve, memo, in_name):
+    out = []
+    for n in nodes:
+        if isinstance(n, Ref):
+            # the legacy code replaces one reference at a time, left to right.  If what's been
+            # rendered so far ends with a bracket, it would run into the opener of this one.
+            for prev in reversed(out):
+                if prev:
+                    if prev.endswith("["):
+                        raise Unsafe()
+                    break
+
+            name = "".join(_render_nodes(n.name, resolve, memo, True))
+            try:
+                value = memo[name]
+            except KeyError:
+                value = str(resolve(name))
+                memo[name] = value
+
+            # a value spliced into a name could change how the legacy code would
+            # have parsed the outer reference.  Not worth guessing, bail out.
+            if in_name and ("[" in value or "]" in value or "$" in value or "\n" in value):
+                raise Unsafe()
+            out.append(value)
+        else:
+            out.append(n)
+    return out
+
+
+def _parse(s, syntax):
+    """
+    Splits s into literals and (possibly nested) references.
+
+    Finds openers and closers left to right, with the innermost references closing first.
+    A closer with no open reference is just text, same as the legacy code.
+    """
+    opener, closer = syntax
+    if syntax == BRACKET and "[[[" in s:
+        # "[[[" - the legacy code finds the outer opener from the left but nested ones from the right
+        raise Unsafe()
+
+    stack = [[]]
+    pos = 0
+    lit_start = 0
+    length = len(s)
+
+    while pos < length:
+        nxt_open = s.find(opener, pos)
+        nxt_close = s.find(closer, pos) if len(stack) > 1 else -1
+
+        if nxt_close > -1 and (nxt_open == -1 or nxt_close < nxt_open):
+            # closing the innermost open reference
+            if nxt_close > lit_start:
+                stack[-1].append(s[lit_start:nxt_close])
+            name = stack.pop()
+            if not name:
+                # the legacy code never terminates on an empty reference, let it have it's way
+                raise Unsafe()
+            for ii, part in enumerate(name):
+                if not isinstance(part, Ref):
+                    if "\n" in part:
+                        # a reference across lines may or may not be replaced depending on the rest of the string
+                        raise Unsafe()
+                    if syntax == BRACKET and part.endswith("]") and ii < len(name) - 1:
+                        # once the nested reference is replaced this could be the closer
+                        raise Unsafe()
+            stack[-1].append(Ref(name))
+            pos = lit_start = nxt_close + len(closer)
+        elif nxt_open > -1:
+            if nxt_open > lit_start:
+                stack[-1].append(s[lit_start:nxt_open])
+            stack.append([])
+            pos = lit_start = nxt_open + len(opener)
+        else:
+            break
+
+    if len(stack) > 1:
+        # an unclosed reference
+        raise Unsafe()
+
+    if lit_start < length:
+        stack[0].append(s[lit_start:])
+
+    return Template(stack[0])
+
+
+def compile_template(s, syntax):
+    """Returns the compiled Template for s, from the cache if we've seen it before.  Raises Unsafe."""
+    key = (syntax[0], s)
+    try:
+        t = _cache[key]
+    except KeyError:
+        try:
+            t = _parse(s, syntax)
+        except Unsafe:
+            t = None
+
+        if len(s) <= MAX_CACHED_LENGTH:
+            if len(_cache) >= MAX_CACHED_TEMPLATES:
+                _cache.clear()
+            _cache[key] = t
+
+    if t is None:
+        raise Unsafe()
+    return t
+
+
+# a [[ ]] value that can stand in for it's own text in an expression
+_NUMBER_RE = re.compile(r"^(0|[1-9][0-9]*)(\.[0-9]+)?$")
+_CONSTANTS = {"True": True, "False": False, "None": None}
+
+_tests = {}
+
+
+class Test(object):
+    """
+    A test expression with it's [[ ]] references compiled as names.
+
+    The legacy way is to replace the references and eval the resulting text, which means
+    a WHILE compiles a new expression on every pass, since the text changes with the values.
+    Here the expression is compiled once, and each evaluation just binds the current values.
+
+    refs is a list of (placeholder, variable name, quoted).  A quoted reference was the whole
+    of a string literal ("[[x]]"), the others stood for a number or a constant.
+    """
+    __slots__ = ("code", "refs")
+
+    def __init__(self, code, refs):
+        self.code = code
+        self.refs = refs
+
+    def bind(self, resolve):
+        """
+        The namespace to evaluate code in.  resolve(name) returns the value for a variable name.
+
+        Raises Unsafe if any value wouldn't mean the same thing as it's text (a value that is
+        itself an expression, a string with a quote in it...).  The caller uses the legacy way then.
+        """
+        memo = {}
+        namespace = {}
+        for placeholder, name, quote in self.refs:
+            try:
+                value = memo[name]
+            except KeyError:
+                value = memo[name] = str(resolve(name))
+
+            if "[[" in value:
+                # the legacy replacement would go around again on this
+                raise Unsafe()
+            if quote:
+                if quote in value or "\\" in value or "\n" in value or "\r" in value:
+                    raise Unsafe()
+                namespace[placeholder] = value
+            elif value in _CONSTANTS:
+                namespace[placeholder] = _CONSTANTS[value]
+            elif _NUMBER_RE.match(value):
+                namespace[placeholder] = float(value) if "." in value else int(value)
+            else:
+                raise Unsafe()
+        return namespace
+
+
+def _compile_test(s):
+    if "[$" in s:
+        raise Unsafe()
+    t = _parse(s, BRACKET)
+
+    nodes = list(t.nodes)
+    placeholders = {}
+    refs = []
+    src = []
+    for ii, n in enumerate(nodes):
+        if not isinstance(n, Ref):
+            src.append(n)
+            continue
+        if len(n.name) != 1 or isinstance(n.name[0], Ref):
+            # nested references, leave them to the legacy routine
+            raise Unsafe()
+        name = n.name[0]
+
+        before = src[-1] if src else ""
+        after = nodes[ii + 1] if ii + 1 < len(nodes) else ""
+        if before.endswith("["):
+            raise Unsafe()
+        quote = ""
+        if before[-1:] in ("'", '"') and isinstance(after, basestring) and after[:1] == before[-1:]:
+            # "[[x]]" - the quotes go, the placeholder stands for the whole string.
+            # (the tokenizer check below catches it if those quotes weren't really a literal)
+            quote = before[-1]
+            src[-1] = before[:-1]
+            nodes[ii + 1] = after[1:]
+
+        key = (name, quote)
+        placeholder = placeholders.get(key)
+        if not placeholder:
+            placeholder = placeholders[key] = "_cato_v%d_" % len(placeholders)
+            refs.append((placeholder, name, quote))
+        src.append(placeholder)
+
+    # eval() of a string ignores leading blanks, compile() doesn't
+    src = "".join(src).lstrip(" \t")
+
+    # every placeholder has to be a name on it's own - not inside a string, part of
+    # a longer name, or an attribute - or the values can't simply be bound to it.
+    names = set(p[0] for p in refs)
+    try:
+        count = 0
+        prev = None
+        for tok in tokenize.generate_tokens(StringIO.StringIO(src).readline):
+            if tok[0] == token.NAME and tok[1].startswith("_cato_v"):
+                if prev == "." or tok[1] not in names:
+                    raise Unsafe()
+                count += 1
+            if tok[0] not in (tokenize.NL, tokenize.COMMENT):
+                prev = tok[1]
+        if count != src.count("_cato_v"):
+            raise Unsafe()
+        code = compile(src, "<string>", "eval")
+    except (tokenize.TokenError, SyntaxError):
+        raise Unsafe()
+
+    return Test(code, refs)
+
+
+def compile_test(s):
+    """
+    Returns the compiled Test for an IF or WHILE expression (before any variables are replaced),
+    from the cache if we've seen it before.  Raises Unsafe if it has to be done the legacy way.
+    """
+    try:
+        t = _tests[s]
+    except KeyError:
+        try:
+            t = _compile_test(s)
+        except Unsafe:
+            t = None
+
+        if len(s) <= MAX_CACHED_LENGTH:
+            if len(_tests) >= MAX_CACHED_TEMPLATES:
+                _tests.clear()
+            _tests[s] = t
+
+    if t is None:
+        raise Unsafe()
+    return t
@@ -0,0 +1,94 @@
+########################################################################/
+# Copyright 2014 Cloud Sidekick
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#########################################################################
+
+"""
+A warm Task Engine process, for the Poller's worker pool.
+
+Started as 'cato_task_engine --worker <max tasks>'.  Everything the Task Engine needs is
+imported once, up front, then task instance ids are read from stdin one per line.
+Each one is run to completion, exactly as if cato_task_engine had been started for it.
+
+When a task is finished, 'done <task instance>' is written back on the original stdout.
+After max tasks (0 means no limit) the message is 'done <task instance> exit' and the
+worker goes away, so the Poller can start a fresh one.
+"""
+
+import os
+import sys
+import traceback
+
+from catolog import catolog
+from . import catotaskengine
+
+
+def _redirect_output(task_instance):
+    """Points stdout and stderr at the task log, same as the nohup command line always did."""
+    logfile = os.path.join(catolog.LOGPATH, "te", "%s.log" % (task_instance))
+    fd = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+
+
+def run_task(task_instance):
+    _redirect_output(task_instance)
+
+    te = None
+    try:
+        te = catotaskengine.TaskEngine("cato_task_engine", task_instance)
+        te.startup()
+        te.run()
+    except SystemExit:
+        # the end command exits when the task is done
+        pass
+    except Exception:
+        # the Task Engine has already logged it and set the status
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        if te and hasattr(te, "db"):
+            try:
+                te.end()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+
+def main(max_tasks=0):
+    # the Poller is listening on our original stdout, keep it before the task logs take it over
+    control = os.fdopen(os.dup(1), "w")
+    # and nothing else gets written on it
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    done = 0
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            # the Poller went away
+            break
+
+        task_instance = line.strip()
+        if not task_instance:
+            continue
+
+        run_task(task_instance)
+        done += 1
+
+        last = max_tasks and done >= max_tasks
+        control.write("done %s%s\n" % (task_instance, " exit" if last else ""))
+        control.flush()
+        if last:
+            break
@@ -42,6 +42,8 @@ __version__ = '0.54'
 
 import re
 import sys
+import threading
+from collections import OrderedDict
 
 # XXX BUGS:
 # evalx is generally a crock:
@@ -53,11 +55,18 @@ import sys
 # internally keep paths as lists to preserve integer types
 #       (instead of as ';' delimited strings)
 
-__all__ = [ 'jsonpath' ]
+__all__ = [ 'jsonpath', 'compile_path', 'JSONPath' ]
 
-# XXX precompile RE objects on load???
-# re_1 = re.compile(.....)
-# re_2 = re.compile(.....)
+_re_subx = re.compile(r"[\['](\??\(.*?\))[\]']")
+_re_sep = re.compile(r"'?(?<!@)\.'?|\['?")
+_re_dotdot = re.compile(r";;;|;;")
+_re_trail = re.compile(r";$|'?\]|'$")
+_re_placeholder = re.compile(r"#([0-9]+)")
+_re_slice = re.compile(r'(-?[0-9]*):(-?[0-9]*):?(-?[0-9]*)$')
+_re_pieces = re.compile(r"'?,'?")
+_re_notvar = re.compile("!@\.([a-zA-Z@_]+)")
+_re_var = re.compile(r'(?<!\\)(@\.[a-zA-Z@_.]+)')
+_re_at = re.compile(r'(?<!\\)@')
 
 def normalize(x):
     """normalize the path expression; outside jsonpath to allow testing"""
@@ -72,14 +81,14 @@ def normalize(x):
         ret = "[#%d]" % n
 #       print "f1:", g1, ret
         return ret
-    x = re.sub(r"[\['](\??\(.*?\))[\]']", f1, x)
+    x = _re_subx.sub(f1, x)
 
     # added the negative lookbehind -krhodes
-    x = re.sub(r"'?(?<!@)\.'?|\['?", ";", x)
+    x = _re_sep.sub(";", x)
 
-    x = re.sub(r";;;|;;", ";..;", x)
+    x = _re_dotdot.sub(";..;", x)
 
-    x = re.sub(r";$|'?\]|'$", "", x)
+    x = _re_trail.sub("", x)
 
     # put expressions back
     def f2(m):
@@ -87,227 +96,344 @@ def normalize(x):
 #       print "f2:", g1
         return subx[int(g1)]
 
-    x = re.sub(r"#([0-9]+)", f2, x)
+    x = _re_placeholder.sub(f2, x)
 
     return x
 
-def jsonpath(obj, expr, result_type='VALUE', debug=0, use_eval=True):
-    """traverse JSON object using jsonpath expr, returning values or paths"""
+def isint(x):
+    """check if argument represents a decimal integer"""
+    return x.isdigit()
+
+def as_path(path):
+    """convert internal path representation to
+       "full bracket notation" for PATH output"""
+    p = '$'
+    for piece in path.split(';')[1:]:
+        # make a guess on how to index
+        # XXX need to apply \ quoting on '!!
+        if isint(piece):
+            p += "[%s]" % piece
+        else:
+            p += "['%s']" % piece
+    return p
+
+def translate(loc):
+    """turn a filter/index expression into python, for evalx"""
+
+    # a nod to JavaScript. doesn't work for @.name.name.length
+    # Write len(@.name.name) instead!!!
+    loc = loc.replace("@.length", "len(__obj)")
+
+    loc = loc.replace("&&", " and ").replace("||", " or ")
+
+    # replace !@.name with 'name' not in obj
+    # XXX handle !@.name.name.name....
+    def notvar(m):
+        return "'%s' not in __obj" % m.group(1)
+    loc = _re_notvar.sub(notvar, loc)
+
+    # replace @.name.... with __obj['name']....
+    # handle @.name[.name...].length
+    def varmatch(m):
+        def brackets(elts):
+            ret = "__obj"
+            for e in elts:
+                if isint(e):
+                    ret += "[%s]" % e # ain't necessarily so
+                else:
+                    ret += "['%s']" % e # XXX beware quotes!!!!
+            return ret
+        g1 = m.group(1)
+        elts = g1.split('.')
+        if elts[-1] == "length":
+            return "len(%s)" % brackets(elts[1:-1])
+        return brackets(elts[1:])
 
-    def s(x,y):
-        """concatenate path elements"""
-        return str(x) + ';' + str(y)
-
-    def isint(x):
-        """check if argument represents a decimal integer"""
-        return x.isdigit()
-
-    def as_path(path):
-        """convert internal path representation to
-           "full bracket notation" for PATH output"""
-        p = '$'
-        for piece in path.split(';')[1:]:
-            # make a guess on how to index
-            # XXX need to apply \ quoting on '!!
-            if isint(piece):
-                p += "[%s]" % piece
-            else:
-                p += "['%s']" % piece
-        return p
+    loc = _re_var.sub(varmatch, loc)
 
-    def store(path, object):
-        if result_type == 'VALUE':
-            result.append(object)
-        elif result_type == 'IPATH': # Index format path (Python ext)
-            # return list of list of indices -- can be used w/o "eval" or split
-            result.append(path.split(';')[1:])
-        else: # PATH
-            result.append(as_path(path))
-        return path
-
-    def trace(expr, obj, path):
-        if debug: print "trace", expr, "/", path
-        if expr:
-            x = expr.split(';')
-            loc = x[0]
-            x = ';'.join(x[1:])
-            if debug: print "\t", loc, type(obj)
-            if loc == "*":
-                def f03(key, loc, expr, obj, path):
-                    if debug > 1: print "\tf03", key, loc, expr, path
-                    trace(s(key, expr), obj, path)
-                walk(loc, x, obj, path, f03)
-            elif loc == "..":
-                trace(x, obj, path)
-                def f04(key, loc, expr, obj, path):
-                    if debug > 1: print "\tf04", key, loc, expr, path
-                    if isinstance(obj, dict):
-                        if key in obj:
-                            trace(s('..', expr), obj[key], s(path, key))
-                    else:
-                        if key < len(obj):
-                            trace(s('..', expr), obj[key], s(path, key))
-                walk(loc, x, obj, path, f04)
-            elif loc == "!":
-                # Perl jsonpath extension: return keys
-                def f06(key, loc, expr, obj, path):
-                    if isinstance(obj, dict):
-                        trace(expr, key, path)
-                walk(loc, x, obj, path, f06)
-            elif isinstance(obj, dict) and loc in obj:
-                trace(x, obj[loc], s(path, loc))
+    # removed = -> == translation
+    # causes problems if a string contains =
+
+    # replace @  w/ "__obj", but \@ means a literal @
+    return _re_at.sub("__obj", loc).replace(r'\@', '@')
+
+def _is_plain(loc):
+    """a plain member name or list index, nothing trace() would treat specially"""
+    if loc in ("", "*", "..", "!"):
+        return False
+    if ":" in loc or "," in loc or loc.endswith(")"):
+        return False
+    try:
+        # s() does this to every piece, let the regular code raise if it's going to
+        str(loc)
+    except UnicodeError:
+        return False
+    return True
+
+class JSONPath(object):
+    """
+    A compiled jsonpath expression.
+
+    The expression is normalized once, and filter/index expressions are translated
+    and compiled once, the first time they're used.  Plain dotted/indexed paths
+    (like $.store.book[0].title) are walked directly, no recursion and no eval.
+
+    find() returns exactly what jsonpath() always has.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        cleaned_expr = normalize(expr) if expr else expr
+        if cleaned_expr and cleaned_expr.startswith("$;"):
+            cleaned_expr = cleaned_expr[2:]
+        self.cleaned_expr = cleaned_expr
+
+        locs = cleaned_expr.split(';') if cleaned_expr else []
+        self.plain = locs if locs and all(_is_plain(l) for l in locs) else None
+
+        # translated, compiled filter/index expressions by loc, None if it won't compile
+        self._code = {}
+        self._lock = threading.Lock()
+
+    def _compiled(self, loc):
+        try:
+            return self._code[loc]
+        except KeyError:
+            pass
+        src = translate(loc)
+        try:
+            # eval() of a string ignores leading blanks, compile() doesn't
+            code = compile(src.lstrip(" \t"), "<jsonpath>", "eval")
+        except Exception:
+            code = None
+        with self._lock:
+            self._code[loc] = (src, code)
+        return src, code
+
+    def _find_plain(self, obj, result_type):
+        path = '$'
+        for loc in self.plain:
+            if isinstance(obj, dict) and loc in obj:
+                obj = obj[loc]
             elif isinstance(obj, list) and isint(loc):
                 iloc = int(loc)
                 if len(obj) >= iloc:
-                    trace(x, obj[iloc], s(path, loc))
+                    # (an index one past the end raises, same as always)
+                    obj = obj[iloc]
+                else:
+                    return False
             else:
-                # [(index_expression)]
-                if loc.startswith("(") and loc.endswith(")"):
-                    if debug > 1: print "index", loc
-                    e = evalx(loc, obj)
-                    trace(s(e,x), obj, path)
-                    return
-
-                # ?(filter_expression)
-                if loc.startswith("?(") and loc.endswith(")"):
-                    if debug > 1: print "filter", loc
-                    def f05(key, loc, expr, obj, path):
-                        if debug > 1: print "f05", key, loc, expr, path
-                        if isinstance(obj, dict):
-                            eval_result = evalx(loc, obj[key])
-                        else:
-                            eval_result = evalx(loc, obj[int(key)])
-                        if eval_result:
-                            trace(s(key, expr), obj, path)
-
-                    loc = loc[2:-1]
-                    walk(loc, x, obj, path, f05)
-                    return
-
-                m = re.match(r'(-?[0-9]*):(-?[0-9]*):?(-?[0-9]*)$', loc)
-                if m:
-                    if isinstance(obj, (dict, list)):
-                        def max(x,y):
-                            if x > y:
-                                return x
-                            return y
-
-                        def min(x,y):
-                            if x < y:
-                                return x
-                            return y
-
-                        objlen = len(obj)
-                        s0 = m.group(1)
-                        s1 = m.group(2)
-                        s2 = m.group(3)
-
-                        # XXX int("badstr") raises exception
-                        start = int(s0) if s0 else 0
-                        end = int(s1) if s1 else objlen
-                        step = int(s2) if s2 else 1
-
-                        if start < 0:
-                            start = max(0, start+objlen)
-                        else:
-                            start = min(objlen, start)
-                        if end < 0:
-                            end = max(0, end+objlen)
-                        else:
-                            end = min(objlen, end)
-
-                        for i in xrange(start, end, step):
-                            trace(s(i, x), obj, path)
-                    return
-
-                # after (expr) & ?(expr)
-                if loc.find(",") >= 0:
-                    # [index,index....]
-                    for piece in re.split(r"'?,'?", loc):
-                        if debug > 1: print "piece", piece
-                        trace(s(piece, x), obj, path)
-        else:
-            store(path, obj)
-
-    def walk(loc, expr, obj, path, funct):
-        if isinstance(obj, list):
-            for i in xrange(0, len(obj)):
-                funct(i, loc, expr, obj, path)
-        elif isinstance(obj, dict):
-            for key in obj:
-                funct(key, loc, expr, obj, path)
-
-    def evalx(loc, obj):
-        """eval expression"""
-
-        if debug: print "evalx", loc
-
-        # a nod to JavaScript. doesn't work for @.name.name.length
-        # Write len(@.name.name) instead!!!
-        loc = loc.replace("@.length", "len(__obj)")
-
-        loc = loc.replace("&&", " and ").replace("||", " or ")
-
-        # replace !@.name with 'name' not in obj
-        # XXX handle !@.name.name.name....
-        def notvar(m):
-            return "'%s' not in __obj" % m.group(1)
-        loc = re.sub("!@\.([a-zA-Z@_]+)", notvar, loc)
-
-        # replace @.name.... with __obj['name']....
-        # handle @.name[.name...].length
-        def varmatch(m):
-            def brackets(elts):
-                ret = "__obj"
-                for e in elts:
-                    if isint(e):
-                        ret += "[%s]" % e # ain't necessarily so
-                    else:
-                        ret += "['%s']" % e # XXX beware quotes!!!!
-                return ret
-            g1 = m.group(1)
-            elts = g1.split('.')
-            if elts[-1] == "length":
-                return "len(%s)" % brackets(elts[1:-1])
-            return brackets(elts[1:])
-
-        loc = re.sub(r'(?<!\\)(@\.[a-zA-Z@_.]+)', varmatch, loc)
-
-        # removed = -> == translation
-        # causes problems if a string contains =
-
-        # replace @  w/ "__obj", but \@ means a literal @
-        loc = re.sub(r'(?<!\\)@', "__obj", loc).replace(r'\@', '@')
-        if not use_eval:
-            if debug: print "eval disabled"
-            raise Exception("eval disabled")
-        if debug: print "eval", loc
-        try:
-            # eval w/ caller globals, w/ local "__obj"!
-            v = eval(loc, caller_globals, {'__obj': obj})
-        except Exception, e:
-            if debug: print e
-            return False
+                return False
+            if result_type != 'VALUE':
+                path = path + ';' + str(loc)
 
-        if debug: print "->", v
-        return v
+        if result_type == 'VALUE':
+            return [obj]
+        elif result_type == 'IPATH':
+            return [path.split(';')[1:]]
+        return [as_path(path)]
 
-    # body of jsonpath()
+    def find(self, obj, result_type='VALUE', debug=0, use_eval=True, caller_globals=None):
+        """traverse JSON object, returning values or paths"""
 
-    # Get caller globals so eval can pick up user functions!!!
-    caller_globals = sys._getframe(1).f_globals
-    result = []
-    if expr and obj:
-        cleaned_expr = normalize(expr)
-        if cleaned_expr.startswith("$;"):
-            cleaned_expr = cleaned_expr[2:]
+        if not (self.expr and obj):
+            return False
+
+        if self.plain is not None and not debug:
+            return self._find_plain(obj, result_type)
+
+        # so eval can pick up user functions!!!
+        if caller_globals is None:
+            caller_globals = sys._getframe(1).f_globals
+
+        def s(x,y):
+            """concatenate path elements"""
+            return str(x) + ';' + str(y)
+
+        def store(path, object):
+            if result_type == 'VALUE':
+                result.append(object)
+            elif result_type == 'IPATH': # Index format path (Python ext)
+                # return list of list of indices -- can be used w/o "eval" or split
+                result.append(path.split(';')[1:])
+            else: # PATH
+                result.append(as_path(path))
+            return path
+
+        def trace(expr, obj, path):
+            if debug: print "trace", expr, "/", path
+            if expr:
+                x = expr.split(';')
+                loc = x[0]
+                x = ';'.join(x[1:])
+                if debug: print "\t", loc, type(obj)
+                if loc == "*":
+                    def f03(key, loc, expr, obj, path):
+                        if debug > 1: print "\tf03", key, loc, expr, path
+                        trace(s(key, expr), obj, path)
+                    walk(loc, x, obj, path, f03)
+                elif loc == "..":
+                    trace(x, obj, path)
+                    def f04(key, loc, expr, obj, path):
+                        if debug > 1: print "\tf04", key, loc, expr, path
+                        if isinstance(obj, dict):
+                            if key in obj:
+                                trace(s('..', expr), obj[key], s(path, key))
+                        else:
+                            if key < len(obj):
+                                trace(s('..', expr), obj[key], s(path, key))
+                    walk(loc, x, obj, path, f04)
+                elif loc == "!":
+                    # Perl jsonpath extension: return keys
+                    def f06(key, loc, expr, obj, path):
+                        if isinstance(obj, dict):
+                            trace(expr, key, path)
+                    walk(loc, x, obj, path, f06)
+                elif isinstance(obj, dict) and loc in obj:
+                    trace(x, obj[loc], s(path, loc))
+                elif isinstance(obj, list) and isint(loc):
+                    iloc = int(loc)
+                    if len(obj) >= iloc:
+                        trace(x, obj[iloc], s(path, loc))
+                else:
+                    # [(index_expression)]
+                    if loc.startswith("(") and loc.endswith(")"):
+                        if debug > 1: print "index", loc
+                        e = evalx(loc, obj)
+                        trace(s(e,x), obj, path)
+                        return
+
+                    # ?(filter_expression)
+                    if loc.startswith("?(") and loc.endswith(")"):
+                        if debug > 1: print "filter", loc
+                        def f05(key, loc, expr, obj, path):
+                            if debug > 1: print "f05", key, loc, expr, path
+                            if isinstance(obj, dict):
+                                eval_result = evalx(loc, obj[key])
+                            else:
+                                eval_result = evalx(loc, obj[int(key)])
+                            if eval_result:
+                                trace(s(key, expr), obj, path)
+
+                        loc = loc[2:-1]
+                        walk(loc, x, obj, path, f05)
+                        return
+
+                    m = _re_slice.match(loc)
+                    if m:
+                        if isinstance(obj, (dict, list)):
+                            def max(x,y):
+                                if x > y:
+                                    return x
+                                return y
+
+                            def min(x,y):
+                                if x < y:
+                                    return x
+                                return y
+
+                            objlen = len(obj)
+                            s0 = m.group(1)
+                            s1 = m.group(2)
+                            s2 = m.group(3)
+
+                            # XXX int("badstr") raises exception
+                            start = int(s0) if s0 else 0
+                            end = int(s1) if s1 else objlen
+                            step = int(s2) if s2 else 1
+
+                            if start < 0:
+                                start = max(0, start+objlen)
+                            else:
+                                start = min(objlen, start)
+                            if end < 0:
+                                end = max(0, end+objlen)
+                            else:
+                                end = min(objlen, end)
+
+                            for i in xrange(start, end, step):
+                                trace(s(i, x), obj, path)
+                        return
+
+                    # after (expr) & ?(expr)
+                    if loc.find(",") >= 0:
+                        # [index,index....]
+                        for piece in _re_pieces.split(loc):
+                            if debug > 1: print "piece", piece
+                            trace(s(piece, x), obj, path)
+            else:
+                store(path, obj)
+
+        def walk(loc, expr, obj, path, funct):
+            if isinstance(obj, list):
+                for i in xrange(0, len(obj)):
+                    funct(i, loc, expr, obj, path)
+            elif isinstance(obj, dict):
+                for key in obj:
+                    funct(key, loc, expr, obj, path)
+
+        def evalx(loc, obj):
+            """eval expression"""
+
+            if debug: print "evalx", loc
+
+            src, code = self._compiled(loc)
+            if not use_eval:
+                if debug: print "eval disabled"
+                raise Exception("eval disabled")
+            if debug: print "eval", src
+            if code is None:
+                # it didn't compile, which is a False just like any other eval error
+                return False
+            try:
+                # eval w/ caller globals, w/ local "__obj"!
+                v = eval(code, caller_globals, {'__obj': obj})
+            except Exception, e:
+                if debug: print e
+                return False
+
+            if debug: print "->", v
+            return v
+
+        result = []
 
         # XXX wrap this in a try??
-        trace(cleaned_expr, obj, '$')
+        trace(self.cleaned_expr, obj, '$')
 
         if len(result) > 0:
             return result
-    return False
+        return False
+
+# compiled expressions, most recently used last
+CACHE_SIZE = 512
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def compile_path(expr):
+    """a (cached) compiled JSONPath for expr"""
+    with _cache_lock:
+        try:
+            jp = _cache.pop(expr)
+            _cache[expr] = jp
+            return jp
+        except KeyError:
+            pass
+
+    jp = JSONPath(expr)
+    with _cache_lock:
+        _cache[expr] = jp
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return jp
+
+def jsonpath(obj, expr, result_type='VALUE', debug=0, use_eval=True):
+    """traverse JSON object using jsonpath expr, returning values or paths"""
+
+    if not (expr and obj):
+        return False
+
+    # Get caller globals so eval can pick up user functions!!!
+    return compile_path(expr).find(obj, result_type, debug, use_eval, sys._getframe(1).f_globals)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,58 @@
+# compiled expressions (compile_path) must match jsonpath() exactly,
+# plain paths take the fast path, and the cache hands back the same object
+
+import jsonpath
+import jsonmatch
+
+json = \
+{ "store": {
+        "book": [
+                { "category": "reference",
+                      "author": "Nigel Rees",
+                      "price": 8.95
+                },
+                { "category": "fiction",
+                      "author": "Evelyn Waugh",
+                      "isbn": "0-553-21311-3",
+                      "price": 12.99
+                }
+              ],
+              "bicycle": {
+                "color": "red",
+                "price": 19.95
+              }
+        }
+}
+
+tests = [
+        "$.store.book[0].author",
+        "$.store.book.1.isbn",
+        "$['store']['bicycle']['color']",
+        "$.store.book[5].author",
+        "$.store.nothing",
+        "$..author",
+        "$..book[?(@.price<10)].author",
+        "$.store.book[-1:].price",
+]
+
+plain = [True, True, True, True, True, False, False, False]
+
+assert len(tests) == len(plain)
+
+for i in xrange(0, len(tests)):
+    jp = jsonpath.compile_path(tests[i])
+    assert jp is jsonpath.compile_path(tests[i])
+    assert (jp.plain is not None) == plain[i]
+    for result_type in ("VALUE", "PATH", "IPATH"):
+        v = jp.find(json, result_type)
+        if v is False:
+            assert jsonpath.jsonpath(json, tests[i], result_type) is False
+        else:
+            assert jsonmatch.jsonmatch(v, jsonpath.jsonpath(json, tests[i], result_type))
+
+# the fast path still finds what the regular one does
+assert jsonpath.jsonpath(json, "$.store.book[1].isbn") == ["0-553-21311-3"]
+assert jsonpath.jsonpath(json, "$.store.book[1].isbn", "PATH") == ["$['store']['book'][1]['isbn']"]
+assert jsonpath.jsonpath(json, "$.store.book[1].isbn", "IPATH") == [["store", "book", "1", "isbn"]]
+
+print len(tests), "tests passed"